@@ -0,0 +1,337 @@
+'''Benchmarks of the job orchestration, against a local mock TAP/UWS server
+
+The benchmarks run the code of the tutorial and of the helper modules of
+`scripts/` against `mock_uws_server.MockTAPServer`, so they need neither a
+token nor the live www.cosmosim.org service:
+
+- submission: jobs submitted per second, one by one (tutorial) and with
+  `cosmosim_submission.submit_queries()`
+- polling: time and HTTP requests of one status pass over the tracked jobs,
+  one `AsyncTAPJob` per job (tutorial) and with one `get_job_list()`
+- fetch: throughput of `fetch_results_of_complete_jobs()` parsing the
+  results (tutorial), streaming them, and downloading them with workers
+- memory: peak of the python memory while fetching one large result
+- startup: wall time of a script listing its jobs, in a new interpreter,
+  with the preamble of the tutorial and with `cosmosim_client`
+
+Usage:
+------
+
+    python cosmosim_benchmark.py --jobs 50 --rows 20000 --json results.json
+
+    # compare with a previous run, exit with 1 on a regression over 20%
+    python cosmosim_benchmark.py --baseline results.json --tolerance 0.2
+'''
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pyvo
+import requests
+
+SCRIPTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+
+sys.path.insert(0, SCRIPTS_DIRECTORY)
+
+from mock_uws_server import MockTAPServer  # noqa: E402
+
+from cosmosim_fetch import fetch_results_of_complete_jobs, stream_result  # noqa: E402
+from cosmosim_poller import fetch_phases  # noqa: E402
+from cosmosim_submission import submit_queries  # noqa: E402
+
+# One measure: value, unit, and whether more is better
+Metric = collections.namedtuple('Metric', ['value', 'unit', 'higher_is_better'])
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(function):
+    '''Register a benchmark function'''
+    BENCHMARKS[function.__name__.replace('bench_', '')] = function
+    return function
+
+
+def _service(server):
+    '''A TAP service of the mock server, set up the way the tutorial does'''
+    tap_session = requests.Session()
+    tap_session.headers['Authorization'] = 'Token benchmark'
+    return pyvo.dal.TAPService(server.url, session=tap_session)
+
+
+def _queries(njobs, prefix='bench'):
+    return [('%s_%d' % (prefix, i), 'SELECT id, x, y, z, mass FROM mock.halos -- %d' % (i,)) for i in range(njobs)]
+
+
+def _requests(server):
+    return sum(server.requests.values())
+
+
+def _wait_for(server, phases=('COMPLETED', 'ERROR'), timeout=60.0):
+    '''Wait until every job of the mock server reached one of `phases`'''
+    end = time.time() + timeout
+    while time.time() < end:
+        for job in list(server.jobs.values()):
+            job.update(server.httpd)
+        if all(job.phase in phases for job in server.jobs.values()):
+            return
+        time.sleep(0.05)
+    raise RuntimeError('the jobs of the mock server did not finish')
+
+
+@benchmark
+def bench_submission(arguments, directory):
+    '''Jobs submitted per second'''
+
+    metrics = collections.OrderedDict()
+
+    with MockTAPServer(request_latency=arguments.request_latency) as server:
+        tap_service = _service(server)
+
+        # the loop of the tutorial
+        start = time.time()
+        for name, query in _queries(arguments.jobs, 'serial'):
+            job = tap_service.submit_job(query, language='PostgreSQL', runid=name, queue='1m')
+            job.run()
+        metrics['serial'] = Metric(arguments.jobs / (time.time() - start), 'jobs/s', True)
+
+        start = time.time()
+        submit_queries(tap_service, _queries(arguments.jobs, 'pooled'), queue='1m')
+        metrics['pooled'] = Metric(arguments.jobs / (time.time() - start), 'jobs/s', True)
+
+    return metrics
+
+
+@benchmark
+def bench_polling(arguments, directory):
+    '''Cost of one status pass over the tracked jobs'''
+
+    metrics = collections.OrderedDict()
+
+    with MockTAPServer(latency={'1m': (3600.0, 1.0)}, request_latency=arguments.request_latency) as server:
+        tap_service = _service(server)
+        job_urls = [result.url for result in submit_queries(tap_service, _queries(arguments.jobs), queue='1m')]
+
+        # one AsyncTAPJob per job, as in fetch_results_of_complete_jobs of the tutorial
+        server.reset_counters()
+        start = time.time()
+        for job_url in job_urls:
+            pyvo.dal.AsyncTAPJob(job_url, session=tap_service._session).phase
+        metrics['per_job_seconds'] = Metric(time.time() - start, 's/pass', False)
+        metrics['per_job_requests'] = Metric(_requests(server), 'requests/pass', False)
+
+        server.reset_counters()
+        start = time.time()
+        fetch_phases(tap_service, job_urls)
+        metrics['bulk_seconds'] = Metric(time.time() - start, 's/pass', False)
+        metrics['bulk_requests'] = Metric(_requests(server), 'requests/pass', False)
+
+    return metrics
+
+
+@benchmark
+def bench_fetch(arguments, directory):
+    '''Throughput of the download of the results of completed jobs'''
+
+    metrics = collections.OrderedDict()
+    variants = [
+        ('parsed', dict(bulk=False)),
+        ('streamed', dict(stream=True)),
+        ('workers', dict(workers=4)),
+    ]
+
+    with MockTAPServer(latency={'1m': (0.0, 0.0)}, result_rows=arguments.rows,
+                       request_latency=arguments.request_latency, bandwidth=arguments.bandwidth) as server:
+        tap_service = _service(server)
+
+        for name, options in variants:
+            urls_filename = os.path.join(directory, 'jobs_url_%s.txt' % (name,))
+            output = os.path.join(directory, name)
+            os.makedirs(output)
+
+            submit_queries(tap_service, _queries(arguments.jobs, name), queue='1m', urls_filename=urls_filename)
+            _wait_for(server)
+
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                fetch_results_of_complete_jobs(tap_service, urls_filename, directory=output, **options)
+            seconds = time.time() - start
+
+            size = sum(os.path.getsize(os.path.join(output, filename)) for filename in os.listdir(output))
+            metrics[name] = Metric(size / seconds / 1024 ** 2, 'MB/s', True)
+
+    return metrics
+
+
+@benchmark
+def bench_memory(arguments, directory):
+    '''Peak python memory while fetching one large result'''
+
+    metrics = collections.OrderedDict()
+
+    with MockTAPServer(latency={'1m': (0.0, 0.0)}, result_rows=arguments.memory_rows) as server:
+        tap_service = _service(server)
+        job_url = submit_queries(tap_service, _queries(1), queue='1m')[0].url
+        _wait_for(server)
+
+        # the result is generated by the server before the measures start
+        size = len(tap_service._session.get(job_url + '/results/result').content)
+        metrics['result_size'] = Metric(size / 1024 ** 2, 'MB', False)
+
+        def fetch_parsed():
+            job = pyvo.dal.AsyncTAPJob(job_url, session=tap_service._session)
+            job.fetch_result().votable.to_xml(os.path.join(directory, 'parsed.xml'))
+
+        def fetch_streamed():
+            stream_result(tap_service._session, job_url, os.path.join(directory, 'streamed.xml'))
+
+        for name, function in (('parsed_peak', fetch_parsed), ('streamed_peak', fetch_streamed)):
+            tracemalloc.start()
+            try:
+                function()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            metrics[name] = Metric(peak / 1024 ** 2, 'MB', False)
+
+    return metrics
+
+
+# The start of a script listing its jobs: preamble of the tutorial
+STARTUP_TUTORIAL = '''
+from pkg_resources import parse_version
+import pyvo
+if parse_version(pyvo.__version__) < parse_version('1.0'):
+    raise ImportError('pyvo version must be at least than 1.0')
+import requests
+tap_session = requests.Session()
+tap_session.headers['Authorization'] = 'Token benchmark'
+tap_service = pyvo.dal.TAPService(URL, session=tap_session)
+tap_service.get_job_list()
+'''
+
+# The same with cosmosim_client
+STARTUP_CLIENT = '''
+from cosmosim_client import check_version, connect
+check_version('pyvo', '1.0')
+tap_service = connect(URL, 'Token benchmark')
+tap_service.get_job_list()
+'''
+
+
+@benchmark
+def bench_startup(arguments, directory):
+    '''Wall time of a new interpreter setting up the service and listing the jobs'''
+
+    metrics = collections.OrderedDict()
+
+    environment = dict(os.environ, XDG_CACHE_HOME=directory, PYTHONDONTWRITEBYTECODE='1',
+                       PYTHONPATH=os.pathsep.join([SCRIPTS_DIRECTORY] + sys.path))
+
+    with MockTAPServer() as server:
+        for name, code in (('tutorial_start', STARTUP_TUTORIAL), ('client_start', STARTUP_CLIENT)):
+            code = 'import warnings; warnings.simplefilter("ignore")\nURL = %r\n%s' % (server.url, code)
+
+            times = []
+            for i in range(arguments.startup_runs):
+                start = time.time()
+                subprocess.run([sys.executable, '-c', code], env=environment, check=True)
+                times.append(time.time() - start)
+            metrics[name] = Metric(statistics.median(times), 's', False)
+
+        # the client started from the cached VOSI documents still lists the tables
+        from cosmosim_client import VOSICache, connect
+
+        client = connect(server.url, 'Token benchmark', cache=VOSICache(os.path.join(directory, 'cosmosim', 'vosi')))
+        tables = list(client.tables.keys())
+        if tables != ['mdr1.bdmv', 'mdr1.redshifts']:
+            raise RuntimeError('The tables of the cached client are wrong: %r' % (tables,))
+
+        bare = []
+        for i in range(arguments.startup_runs):
+            start = time.time()
+            subprocess.run([sys.executable, '-c', 'pass'], env=environment, check=True)
+            bare.append(time.time() - start)
+        metrics['interpreter_start'] = Metric(statistics.median(bare), 's', False)
+
+    return metrics
+
+
+def compare(results, baseline, tolerance):
+    '''The (benchmark, metric, ratio) of the metrics worse than the baseline by more than `tolerance`'''
+
+    regressions = []
+    for name, metrics in results.items():
+        for metric, measure in metrics.items():
+            reference = baseline.get(name, {}).get(metric)
+            if not reference or not reference['value'] or not measure['value']:
+                continue
+
+            ratio = measure['value'] / reference['value']
+            worse = ratio < 1.0 - tolerance if measure['higher_is_better'] else ratio > 1.0 + tolerance
+            if worse:
+                regressions.append((name, metric, ratio))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the CosmoSim TAP job orchestration')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='the benchmarks to run')
+    parser.add_argument('--jobs', type=int, default=50, help='number of jobs')
+    parser.add_argument('--rows', type=int, default=20000, help='rows of each result of the fetch benchmark')
+    parser.add_argument('--memory-rows', type=int, default=200000, help='rows of the result of the memory benchmark')
+    parser.add_argument('--request-latency', type=float, default=0.01,
+                        help='seconds added to every request (network round trip)')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second of each download')
+    parser.add_argument('--startup-runs', type=int, default=5, help='runs of each script of the startup benchmark')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as regression')
+    arguments = parser.parse_args()
+
+    results = collections.OrderedDict()
+    baseline = {}
+    if arguments.baseline:
+        with open(arguments.baseline, 'r') as fd:
+            baseline = json.load(fd)
+
+    for name in arguments.only or list(BENCHMARKS):
+        directory = tempfile.mkdtemp(prefix='cosmosim_benchmark_')
+        try:
+            metrics = BENCHMARKS[name](arguments, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        results[name] = collections.OrderedDict((metric, measure._asdict()) for metric, measure in metrics.items())
+
+        for metric, measure in metrics.items():
+            line = '%-12s %-18s %12.3f %-14s' % (name, metric, measure.value, measure.unit)
+            reference = baseline.get(name, {}).get(metric)
+            if reference and reference['value']:
+                line += ' (baseline %.3f, x%.2f)' % (reference['value'], measure.value / reference['value'])
+            print(line)
+
+    if arguments.json:
+        with open(arguments.json, 'w') as fd:
+            json.dump(results, fd, indent=2)
+
+    regressions = compare(results, baseline, arguments.tolerance)
+    for name, metric, ratio in regressions:
+        print('REGRESSION %s %s: x%.2f of the baseline' % (name, metric, ratio))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,621 @@
+'''Local stand-in for the CosmoSim TAP/UWS service
+
+The server implements the subset of TAP and UWS used by the tutorial
+scripts and helper modules: sync queries, async job creation, phase,
+parameters, results (with HTTP Range support), deletion (archiving) and job
+listing. Queue latencies, execution times, result sizes and error rates are
+configurable, so the job orchestration can be measured without the live
+service.
+
+Example:
+--------
+
+    from mock_uws_server import MockTAPServer
+
+    with MockTAPServer(result_rows=10000, error_rate=0.05) as server:
+        tap_service = pyvo.dal.TAPService(server.url, session=requests.Session())
+'''
+
+import datetime
+import email.parser
+import email.policy
+import hashlib
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+#
+# Seconds spent waiting in, and executing in, each queue
+#
+QUEUE_LATENCY = {
+    '1m': (0.05, 0.2),
+    '1h': (0.1, 0.5),
+    '5h': (0.2, 1.0),
+}
+
+# Seconds each queue allows a job to execute before it is stopped
+QUEUE_LIMIT = {
+    '1m': 60.0,
+    '1h': 3600.0,
+    '5h': 18000.0,
+}
+
+UWS_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<uws:{tag} xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" '
+              'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1">\n')
+
+# The VOSI capabilities of the service (TAPRegExt)
+CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<vosi:capabilities xmlns:vosi="http://www.ivoa.net/xml/VOSICapabilities/v1.0"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:vr="http://www.ivoa.net/xml/VOResource/v1.0"
+    xmlns:tr="http://www.ivoa.net/xml/TAPRegExt/v1.0">
+<capability standardID="ivo://ivoa.net/std/TAP" xsi:type="tr:TableAccess">
+<interface xsi:type="vs:ParamHTTP" role="std" xmlns:vs="http://www.ivoa.net/xml/VODataService/v1.1">
+<accessURL use="base">{url}</accessURL></interface>
+<language><name>ADQL</name><version ivo-id="ivo://ivoa.net/std/ADQL#v2.0">2.0</version></language>
+<language><name>PostgreSQL</name><version>13</version></language>
+<outputFormat><mime>application/x-votable+xml</mime><alias>votable</alias></outputFormat>
+<outputFormat><mime>text/csv</mime><alias>csv</alias></outputFormat>
+<uploadMethod ivo-id="ivo://ivoa.net/std/TAPRegExt#upload-inline"/>
+<retentionPeriod><default>604800</default></retentionPeriod>
+<outputLimit><default unit="row">{rows}</default><hard unit="row">{rows}</hard></outputLimit>
+<uploadLimit><hard unit="byte">10000000</hard></uploadLimit>
+</capability>
+<capability standardID="ivo://ivoa.net/std/VOSI#capabilities">
+<interface xsi:type="vs:ParamHTTP" xmlns:vs="http://www.ivoa.net/xml/VODataService/v1.1">
+<accessURL use="full">{url}/capabilities</accessURL></interface>
+</capability>
+</vosi:capabilities>
+'''
+
+# The VOSI tables of the service
+TABLES = '''<?xml version="1.0" encoding="UTF-8"?>
+<vosi:tableset xmlns:vosi="http://www.ivoa.net/xml/VOSITables/v1.0"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:vs="http://www.ivoa.net/xml/VODataService/v1.1">
+<schema><name>mdr1</name>
+<table type="table"><name>mdr1.bdmv</name><description>BDM halos</description>
+<column><name>bdmid</name><dataType xsi:type="vs:VOTableType">long</dataType></column>
+<column><name>mvir</name><unit>Msun/h</unit><dataType xsi:type="vs:VOTableType">double</dataType></column>
+</table>
+<table type="table"><name>mdr1.redshifts</name>
+<column><name>snapnum</name><dataType xsi:type="vs:VOTableType">int</dataType></column>
+<column><name>zred</name><dataType xsi:type="vs:VOTableType">double</dataType></column>
+</table>
+</schema>
+</vosi:tableset>
+'''
+
+FIELDS = [
+    ('id', 'long', None, 'meta.id'),
+    ('x', 'double', 'Mpc/h', 'pos.cartesian.x'),
+    ('y', 'double', 'Mpc/h', 'pos.cartesian.y'),
+    ('z', 'double', 'Mpc/h', 'pos.cartesian.z'),
+    ('mass', 'double', 'Msun/h', 'phys.mass'),
+]
+
+RANGE_PATTERN = re.compile(r'(\w+)\s*>=\s*([-+.\deE]+)\s+AND\s+\1\s*(<=?)\s*([-+.\deE]+)', re.IGNORECASE)
+LIMIT_PATTERN = re.compile(r'\bLIMIT\s+(\d+)', re.IGNORECASE)
+
+
+def isoformat(timestamp):
+    '''Format a unix timestamp the way UWS does'''
+    if timestamp is None:
+        return None
+    timestamp = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def default_result_factory(query, rows):
+    '''Generate the rows returned for `query`
+
+    The rows are deterministic for a given query. A `LIMIT n` caps the number
+    of rows, and a `column >= low AND column < high` predicate on `id` or
+    `mass` keeps the generated values within the range.
+    '''
+
+    seed = int(hashlib.sha256(query.encode('utf-8')).hexdigest()[:8], 16)
+    generator = random.Random(seed)
+
+    limit = LIMIT_PATTERN.search(query)
+    if limit:
+        rows = min(rows, int(limit.group(1)))
+
+    low, high = 0.0, 1.0e15
+    match = RANGE_PATTERN.search(query)
+    if match and match.group(1).lower() in ('id', 'mass'):
+        low, high = float(match.group(2)), float(match.group(4))
+
+    step = (high - low) / max(rows, 1)
+    for i in range(rows):
+        value = low + i * step
+        yield (int(value), generator.uniform(0, 1000), generator.uniform(0, 1000),
+               generator.uniform(0, 1000), value)
+
+
+def _cell(value):
+    '''The text of a cell, numpy scalars are converted first (their repr is not a number)'''
+    if hasattr(value, 'item'):
+        value = value.item()
+    return repr(value)
+
+
+def votable(rows, fields=FIELDS, status='OK', message=None):
+    '''Serialize rows into a TABLEDATA VOTable, piece by piece'''
+
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n'
+           '<RESOURCE type="results">\n'
+           '<INFO name="QUERY_STATUS" value="%s">%s</INFO>\n' % (status, escape(message or '')))
+
+    if status == 'OK':
+        yield '<TABLE>\n'
+        for name, datatype, unit, ucd in fields:
+            attributes = 'name="%s" datatype="%s" ucd="%s"' % (name, datatype, ucd)
+            if unit:
+                attributes += ' unit="%s"' % (unit,)
+            yield '<FIELD %s/>\n' % (attributes,)
+        yield '<DATA><TABLEDATA>\n'
+
+        chunk = []
+        for row in rows:
+            chunk.append('<TR>' + ''.join('<TD>%s</TD>' % (_cell(value),) for value in row) + '</TR>\n')
+            if len(chunk) == 1000:
+                yield ''.join(chunk)
+                chunk = []
+        yield ''.join(chunk)
+
+        yield '</TABLEDATA></DATA>\n</TABLE>\n'
+
+    yield '</RESOURCE>\n</VOTABLE>\n'
+
+
+class MockJob(object):
+    '''State of one job of the mock server'''
+
+    def __init__(self, server, parameters):
+        self.jobid = uuid.uuid4().hex[:16]
+        self.parameters = parameters
+        self.runid = parameters.get('runid', '')
+        self.queue = parameters.get('queue', '1m')
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.phase = 'PENDING'
+        self.error = None
+        self.archived = False
+        self.result = None
+
+        queue_wait, execution = server.latency.get(self.queue, QUEUE_LATENCY['1m'])
+        self.queue_wait = queue_wait * server.jitter()
+        self.execution = execution * server.jitter()
+        self.fails = server.random.random() < server.error_rate
+        self.result_rows = server.result_rows
+
+    def run(self, server):
+        if self.phase == 'PENDING':
+            self.phase = 'QUEUED'
+            self.started = time.time() + self.queue_wait
+            self.finished = self.started + self.execution
+
+    def update(self, server):
+        '''Move the job along its phases according to the clock'''
+
+        if self.archived or self.phase in ('PENDING', 'COMPLETED', 'ERROR', 'ABORTED'):
+            return
+
+        now = time.time()
+        if now < self.started:
+            self.phase = 'QUEUED'
+        elif now < self.finished:
+            self.phase = 'EXECUTING'
+        elif self.fails:
+            self.phase = 'ERROR'
+            self.error = 'Simulated server error'
+        elif self.execution > server.limits.get(self.queue, QUEUE_LIMIT['1m']):
+            self.phase = 'ERROR'
+            self.error = 'Query timed out: canceling statement due to statement timeout'
+        else:
+            self.phase = 'COMPLETED'
+
+        if self.phase == 'COMPLETED' and self.result is None:
+            query = self.parameters.get('query', '')
+            rows = server.result_factory(query, self.result_rows)
+            self.result = ''.join(votable(rows)).encode('utf-8')
+
+    def xml(self, base_url):
+        '''The UWS job document'''
+
+        url = '%s/async/%s' % (base_url, self.jobid)
+        phase = 'ARCHIVED' if self.archived else self.phase
+
+        parts = [UWS_HEADER.format(tag='job'),
+                 '<uws:jobId>%s</uws:jobId>\n' % (self.jobid,),
+                 '<uws:runId>%s</uws:runId>\n' % (escape(self.runid),),
+                 '<uws:ownerId>mock</uws:ownerId>\n',
+                 '<uws:phase>%s</uws:phase>\n' % (phase,),
+                 '<uws:creationTime>%s</uws:creationTime>\n' % (isoformat(self.created),)]
+
+        if self.started is not None and time.time() >= self.started:
+            parts.append('<uws:startTime>%s</uws:startTime>\n' % (isoformat(self.started),))
+        if phase in ('COMPLETED', 'ERROR', 'ARCHIVED') and self.finished is not None:
+            parts.append('<uws:endTime>%s</uws:endTime>\n' % (isoformat(self.finished),))
+
+        parts.append('<uws:executionDuration>%d</uws:executionDuration>\n' % (QUEUE_LIMIT.get(self.queue, 60),))
+        parts.append('<uws:parameters>\n')
+        for key, value in sorted(self.parameters.items()):
+            parts.append('<uws:parameter id="%s">%s</uws:parameter>\n' % (escape(key), escape(value)))
+        parts.append('</uws:parameters>\n')
+
+        parts.append('<uws:results>\n')
+        if phase == 'COMPLETED':
+            parts.append('<uws:result id="result" xlink:type="simple" xlink:href="%s/results/result" size="%d"/>\n'
+                         % (url, len(self.result)))
+        parts.append('</uws:results>\n')
+
+        if phase == 'ERROR':
+            parts.append('<uws:errorSummary type="fatal" hasDetail="false">'
+                         '<uws:message>%s</uws:message></uws:errorSummary>\n' % (escape(self.error),))
+
+        parts.append('</uws:job>\n')
+        return ''.join(parts)
+
+    def jobref(self, base_url):
+        phase = 'ARCHIVED' if self.archived else self.phase
+        return ('<uws:jobref id="%s" xlink:href="%s/async/%s">'
+                '<uws:phase>%s</uws:phase><uws:runId>%s</uws:runId><uws:ownerId>mock</uws:ownerId>'
+                '<uws:creationTime>%s</uws:creationTime></uws:jobref>\n'
+                % (self.jobid, base_url, self.jobid, phase, escape(self.runid), isoformat(self.created)))
+
+
+class MockTAPHandler(BaseHTTPRequestHandler):
+    '''HTTP handler for the TAP/UWS endpoints of the mock server'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    #
+    # Helpers
+    #
+
+    def _send(self, status, body=b'', content_type='text/xml', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _redirect(self, location):
+        self._send(303, b'', headers={'Location': location})
+
+    def _form(self):
+        '''Parse url-encoded and multipart form data'''
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        content_type = self.headers.get('Content-Type', '')
+
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+            form, files = {}, {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                if part.get_filename():
+                    files[name] = payload
+                else:
+                    form[name] = payload.decode('utf-8')
+            return form, files
+
+        form = urllib.parse.parse_qs(body.decode('utf-8'), keep_blank_values=True)
+        return {key: values[-1] for key, values in form.items()}, {}
+
+    def _route(self):
+        '''Split the path into (endpoint, jobid, rest)'''
+
+        path = urllib.parse.urlsplit(self.path).path
+        prefix = urllib.parse.urlsplit(self.server.base_url).path
+        parts = path[len(prefix):].strip('/').split('/')
+        return parts[0], (parts[1] if len(parts) > 1 else None), '/'.join(parts[2:])
+
+    def _job(self, jobid):
+        job = self.server.jobs.get(jobid)
+        if job is None:
+            self._send(404, 'job not found', content_type='text/plain')
+        return job
+
+    def _count(self):
+        with self.server.lock:
+            key = (self.command, self._route()[2].split('/')[0] or self._route()[0])
+            self.server.requests[key] = self.server.requests.get(key, 0) + 1
+
+    def _authorized(self):
+        if self.server.token and self.headers.get('Authorization') != self.server.token:
+            self._send(401, 'Invalid token', content_type='text/plain')
+            return False
+        return True
+
+    #
+    # Verbs
+    #
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self._count()
+        if not self._authorized():
+            return
+        time.sleep(self.server.request_latency)
+        endpoint, jobid, rest = self._route()
+
+        if endpoint == 'capabilities':
+            return self._send(200, CAPABILITIES.format(url=self.server.base_url, rows=10000000))
+        if endpoint == 'tables':
+            return self._send(200, TABLES)
+        if endpoint == 'availability':
+            return self._send(200, '<availability/>')
+
+        if endpoint != 'async':
+            return self._send(404, 'not found', content_type='text/plain')
+
+        if jobid is None:
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            phases = set(query.get('PHASE', []))
+            last = int(query['LAST'][0]) if 'LAST' in query else None
+            after = None
+            if 'AFTER' in query:
+                after = datetime.datetime.fromisoformat(query['AFTER'][0].rstrip('Z'))
+                after = after.replace(tzinfo=datetime.timezone.utc).timestamp()
+            jobs = sorted(self.server.jobs.values(), key=lambda job: job.created)
+            refs = []
+            for job in jobs:
+                job.update(self.server)
+                phase = 'ARCHIVED' if job.archived else job.phase
+                if (phases and phase not in phases) or (not phases and phase == 'ARCHIVED'):
+                    continue
+                if after is not None and job.created <= after:
+                    continue
+                refs.append(job.jobref(self.server.base_url))
+            if last is not None:
+                refs = refs[-last:]
+            return self._send(200, UWS_HEADER.format(tag='jobs') + ''.join(refs) + '</uws:jobs>\n')
+
+        job = self._job(jobid)
+        if job is None:
+            return
+        job.update(self.server)
+
+        if rest == '':
+            return self._send(200, job.xml(self.server.base_url))
+        if rest == 'phase':
+            return self._send(200, 'ARCHIVED' if job.archived else job.phase, content_type='text/plain')
+        if rest == 'parameters':
+            xml = job.xml(self.server.base_url)
+            start, end = xml.index('<uws:parameters>'), xml.index('</uws:parameters>')
+            return self._send(200, UWS_HEADER.format(tag='parameters') +
+                              xml[start + len('<uws:parameters>'):end] + '</uws:parameters>\n')
+        if rest == 'results/result':
+            if job.phase != 'COMPLETED' or job.archived:
+                return self._send(404, 'no result', content_type='text/plain')
+            return self._send_result(job.result)
+
+        return self._send(404, 'not found', content_type='text/plain')
+
+    def _send_result(self, body):
+        '''Send a result honouring `Range: bytes=start-` requests'''
+
+        headers = {'Accept-Ranges': 'bytes'}
+        requested = self.headers.get('Range')
+        if requested:
+            match = re.match(r'bytes=(\d+)-(\d*)', requested)
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            if start >= len(body):
+                return self._send(416, b'', headers={'Content-Range': 'bytes */%d' % (len(body),)})
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(body))
+            return self._send(206, body[start:end + 1], content_type='application/x-votable+xml',
+                              headers=headers)
+
+        if self.server.bandwidth:
+            return self._send_throttled(body, headers)
+        return self._send(200, body, content_type='application/x-votable+xml', headers=headers)
+
+    def _send_throttled(self, body, headers):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-votable+xml')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        chunk = 64 * 1024
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start:start + chunk])
+            time.sleep(chunk / float(self.server.bandwidth))
+
+    def do_POST(self):
+        self._count()
+        if not self._authorized():
+            return
+        time.sleep(self.server.request_latency)
+        endpoint, jobid, rest = self._route()
+        form, files = self._form()
+        form = {key.lower() if key.upper() in ('QUERY', 'LANG', 'QUEUE', 'RUNID', 'PHASE', 'REQUEST', 'MAXREC',
+                                               'UPLOAD', 'ACTION') else key: value
+                for key, value in form.items()}
+        if 'lang' in form:
+            form['query_language'] = form.pop('lang')
+        self.server.uploads.append(files)
+
+        if endpoint == 'sync':
+            query = form.get('query', '')
+            if self.server.sync_factory is not None:
+                return self._send(200, self.server.sync_factory(query), content_type='application/x-votable+xml')
+            rows = self.server.result_factory(query, self.server.result_rows)
+            return self._send(200, ''.join(votable(rows)), content_type='application/x-votable+xml')
+
+        if endpoint != 'async':
+            return self._send(404, 'not found', content_type='text/plain')
+
+        if jobid is None:
+            run = form.pop('phase', '') == 'RUN'
+            form.pop('request', None)
+            job = MockJob(self.server, form)
+            with self.server.lock:
+                self.server.jobs[job.jobid] = job
+            if run:
+                job.run(self.server)
+            return self._redirect('%s/async/%s' % (self.server.base_url, job.jobid))
+
+        job = self._job(jobid)
+        if job is None:
+            return
+
+        if rest == 'phase':
+            if form.get('phase') == 'RUN':
+                job.run(self.server)
+            elif form.get('phase') == 'ABORT':
+                job.phase = 'ABORTED'
+        elif rest == '' and form.get('action') == 'DELETE':
+            job.archived = True
+            return self._redirect('%s/async' % (self.server.base_url,))
+        return self._redirect('%s/async/%s' % (self.server.base_url, job.jobid))
+
+    def do_DELETE(self):
+        self._count()
+        if not self._authorized():
+            return
+        time.sleep(self.server.request_latency)
+        endpoint, jobid, rest = self._route()
+        job = self._job(jobid)
+        if job is None:
+            return
+        job.archived = True
+        self._redirect('%s/async' % (self.server.base_url,))
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    '''Threaded HTTP server ignoring clients closing their keep-alive connections'''
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+class MockTAPServer(object):
+    '''A threaded mock TAP/UWS server listening on localhost
+
+    Parameters:
+    -----------
+    latency: dict, default: QUEUE_LATENCY
+        (queue wait, execution) seconds for each queue
+
+    limits: dict, default: QUEUE_LIMIT
+        Seconds each queue lets a job execute before it fails with a timeout
+
+    result_rows: int, default: 1000
+        The number of rows of each result
+
+    error_rate: float, default: 0
+        The fraction of jobs ending in phase ERROR
+
+    request_latency: float, default: 0
+        Seconds added to each HTTP request (network round trip)
+
+    bandwidth: float, default: None
+        Bytes per second at which results are sent
+
+    token: str, default: None
+        If given, requests without this `Authorization` header get a 401
+
+    result_factory: callable, default: default_result_factory
+        Called with (query, rows) to generate the rows of a result
+
+    sync_factory: callable, default: None
+        Called with the query to build the body of a sync response
+
+    seed: int, default: 0
+        Seed of the random numbers used for jitter and errors
+    '''
+
+    def __init__(self, latency=None, limits=None, result_rows=1000, error_rate=0.0, request_latency=0.0,
+                 bandwidth=None, token=None, result_factory=None, sync_factory=None, seed=0, port=0):
+        self.httpd = QuietHTTPServer(('127.0.0.1', port), MockTAPHandler)
+        self.url = 'http://127.0.0.1:%d/tap' % (self.httpd.server_address[1],)
+
+        httpd = self.httpd
+        httpd.base_url = self.url
+        httpd.latency = dict(QUEUE_LATENCY, **(latency or {}))
+        httpd.limits = dict(QUEUE_LIMIT, **(limits or {}))
+        httpd.result_rows = result_rows
+        httpd.error_rate = error_rate
+        httpd.request_latency = request_latency
+        httpd.bandwidth = bandwidth
+        httpd.token = token
+        httpd.result_factory = result_factory or default_result_factory
+        httpd.sync_factory = sync_factory
+        httpd.random = random.Random(seed)
+        httpd.jitter = lambda: httpd.random.uniform(0.5, 1.5)
+        httpd.jobs = {}
+        httpd.lock = threading.Lock()
+        httpd.requests = {}
+        httpd.uploads = []
+
+        self.thread = None
+
+    @property
+    def jobs(self):
+        return self.httpd.jobs
+
+    @property
+    def requests(self):
+        '''Number of requests received, by (HTTP verb, endpoint)'''
+        return self.httpd.requests
+
+    def reset_counters(self):
+        with self.httpd.lock:
+            self.httpd.requests.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the mock TAP/UWS server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--rows', type=int, default=1000, help='rows of each result')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of failing jobs')
+    arguments = parser.parse_args()
+
+    server = MockTAPServer(result_rows=arguments.rows, error_rate=arguments.error_rate, port=arguments.port)
+    print('Mock TAP service listening on %s' % (server.url,))
+    server.httpd.serve_forever()
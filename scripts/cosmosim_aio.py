@@ -0,0 +1,381 @@
+'''An asyncio client for the CosmoSim TAP service
+
+pyvo and the tutorial scripts are blocking: embedding them in an asyncio
+application needs a thread per call, and a thread per job waiting for its
+phase. `AsyncTAPService` and `AsyncJob` mirror the operations used in the
+scripts (`run_sync`, `submit_job`, `run`, `phase`, `wait`, `fetch_result`,
+`delete`) as coroutines over a single `aiohttp` session, so thousands of
+jobs can be submitted, waited for and fetched in one event loop.
+
+A job is awaitable: `phase = await job` waits until it is COMPLETED, ERROR,
+ABORTED or ARCHIVED, checking its phase with the backoff of its queue. The
+results are streamed without blocking the loop; only the parsing of a
+VOTable into `pyvo.dal.TAPResults` is done in a thread.
+
+The client needs aiohttp (`pip install aiohttp`).
+
+Example:
+--------
+
+    import asyncio
+    from cosmosim_aio import AsyncTAPService, run_queries
+
+    async def main():
+        async with AsyncTAPService('https://www.cosmosim.org/tap', token='Token <your-token>') as tap_service:
+            tap_result = await tap_service.run_sync('SELECT * FROM mdr1.redshifts', language='PostgreSQL')
+
+            job = await tap_service.submit_job(query, language='PostgreSQL', runid='bdmv', queue='1m')
+            await job.run()
+            if await job == 'COMPLETED':
+                await job.fetch_result('bdmv.xml')
+
+            outcomes = await run_queries(tap_service, queries, directory='results')
+
+    asyncio.run(main())
+'''
+
+import asyncio
+import collections
+import io
+import os
+import re
+import urllib.parse
+
+from cosmosim_poller import QUEUE_BACKOFF, TERMINAL_PHASES
+from cosmosim_submission import QUEUE_CONCURRENCY
+
+# Connections kept open to the service
+CONNECTION_LIMIT = 64
+
+# Bytes read at once from a result
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds to connect, and seconds without data from the service: the whole
+# request is not bounded, the transfer of a large result may last hours
+CONNECT_TIMEOUT = 60
+TIMEOUT = 300
+
+# The message of the errorSummary of a UWS job document
+ERROR_MESSAGE = re.compile(r'<(?:\w+:)?message>(.*?)</(?:\w+:)?message>', re.DOTALL)
+
+# Outcome of one query of `run_queries()`
+JobOutcome = collections.namedtuple('JobOutcome', ['name', 'url', 'phase', 'filename', 'error'])
+
+
+def _parse_votable(data, url):
+    '''Parse a VOTable into TAPResults (blocking: run in a thread)'''
+
+    import pyvo
+    from astropy.io import votable
+
+    return pyvo.dal.TAPResults(votable.parse(io.BytesIO(data)), url=url)
+
+
+class AsyncTAPService(object):
+    '''A TAP service driven from asyncio
+
+    Parameters:
+    -----------
+    baseurl: str
+        The url of the TAP service
+
+    token: str, default: None
+        The `Authorization` header, e.g. `Token <your-token>`
+
+    session: aiohttp.ClientSession, default: None
+        The session to use (a new one by default, closed with the service)
+
+    concurrency: dict, default: QUEUE_CONCURRENCY
+        The maximum number of job creations running at the same time per queue
+
+    limit: int, default: CONNECTION_LIMIT
+        The maximum number of connections open at the same time
+    '''
+
+    def __init__(self, baseurl, token=None, session=None, concurrency=None, limit=CONNECTION_LIMIT):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError('aiohttp is required for the asyncio client: pip install aiohttp')
+
+        self.baseurl = baseurl.rstrip('/')
+        self.concurrency = dict(QUEUE_CONCURRENCY, **(concurrency or {}))
+
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=TIMEOUT)
+
+        self._own_session = session is None
+        if session is None:
+            headers = {'Authorization': token} if token is not None else {}
+            session = aiohttp.ClientSession(headers=headers, timeout=self.timeout,
+                                            connector=aiohttp.TCPConnector(limit=limit))
+        self.session = session
+        self._semaphores = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        '''Close the session, if it was created by the service'''
+        if self._own_session:
+            await self.session.close()
+
+    def _semaphore(self, queue):
+        if queue not in self._semaphores:
+            self._semaphores[queue] = asyncio.Semaphore(self.concurrency.get(queue, 1))
+        return self._semaphores[queue]
+
+    async def run_sync(self, query, language='ADQL', maxrec=None, **keywords):
+        '''Run a sync query
+
+        Returns:
+        --------
+        pyvo.dal.TAPResults
+        '''
+
+        data = dict({key.upper(): value for key, value in keywords.items()},
+                    REQUEST='doQuery', LANG=language, QUERY=query)
+        if maxrec:
+            data['MAXREC'] = str(maxrec)
+
+        async with self.session.post(self.baseurl + '/sync', data=data) as response:
+            response.raise_for_status()
+            body = await response.read()
+
+        return await asyncio.get_running_loop().run_in_executor(None, _parse_votable, body, self.baseurl)
+
+    async def submit_job(self, query, language='ADQL', runid=None, queue='1m', maxrec=None, **keywords):
+        '''Create an async job (in the PENDING phase)
+
+        Returns:
+        --------
+        AsyncJob
+        '''
+
+        data = dict({key.upper(): value for key, value in keywords.items()},
+                    REQUEST='doQuery', LANG=language, QUERY=query, QUEUE=queue)
+        if runid is not None:
+            data['RUNID'] = runid
+        if maxrec:
+            data['MAXREC'] = str(maxrec)
+
+        async with self._semaphore(queue):
+            async with self.session.post(self.baseurl + '/async', data=data, allow_redirects=False) as response:
+                response.raise_for_status()
+                location = response.headers.get('Location')
+
+        if not location:
+            raise IOError('The service did not return the url of the job (HTTP %d)' % (response.status,))
+
+        return AsyncJob(self, urllib.parse.urljoin(str(response.url), location), queue=queue)
+
+    def job(self, url, queue='1m'):
+        '''The handle of an existing job'''
+        return AsyncJob(self, url, queue=queue)
+
+
+class AsyncJob(object):
+    '''An async job, awaitable until it reaches a final phase
+
+    Parameters:
+    -----------
+    service: AsyncTAPService
+        The service of the job
+
+    url: str
+        The url of the job
+
+    queue: str, default: 1m
+        The queue of the job, sets the backoff of `wait()`
+    '''
+
+    def __init__(self, service, url, queue='1m'):
+        self.service = service
+        self.url = url
+        self.queue = queue
+        self.last_phase = None
+
+    def __repr__(self):
+        return '<AsyncJob %s (%s)>' % (self.url, self.last_phase)
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    @property
+    def result_url(self):
+        return self.url + '/results/result'
+
+    async def run(self):
+        '''Start the job'''
+        async with self.service.session.post(self.url + '/phase', data={'PHASE': 'RUN'},
+                                             allow_redirects=False) as response:
+            response.raise_for_status()
+
+    async def abort(self):
+        '''Abort the job'''
+        async with self.service.session.post(self.url + '/phase', data={'PHASE': 'ABORT'},
+                                             allow_redirects=False) as response:
+            response.raise_for_status()
+
+    async def phase(self):
+        '''The current phase of the job'''
+
+        async with self.service.session.get(self.url + '/phase') as response:
+            response.raise_for_status()
+            self.last_phase = (await response.text()).strip()
+
+        return self.last_phase
+
+    async def wait(self, phases=TERMINAL_PHASES, timeout=None):
+        '''Wait until the job reaches one of `phases`
+
+        The delay between two checks grows as for `cosmosim_poller.JobPoller`.
+
+        Returns:
+        --------
+        str
+            The phase reached
+
+        Raises:
+        -------
+        asyncio.TimeoutError
+            If `timeout` seconds passed first
+        '''
+
+        async def poll():
+            delay, growth, maximum = QUEUE_BACKOFF.get(self.queue, QUEUE_BACKOFF['1m'])
+            while True:
+                phase = await self.phase()
+                if phase in phases:
+                    return phase
+                await asyncio.sleep(delay)
+                delay = min(delay * growth, maximum)
+
+        return await asyncio.wait_for(poll(), timeout)
+
+    async def error_summary(self):
+        '''The error message of the job, from its UWS document'''
+
+        async with self.service.session.get(self.url) as response:
+            response.raise_for_status()
+            match = ERROR_MESSAGE.search(await response.text())
+
+        return match.group(1).strip() if match else ''
+
+    async def iter_result(self, chunk_size=CHUNK_SIZE):
+        '''Yield the raw result of the job, chunk by chunk'''
+
+        # not bounded by the total timeout of a session given by the caller
+        async with self.service.session.get(self.result_url, timeout=self.service.timeout) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def fetch_result(self, filename=None, chunk_size=CHUNK_SIZE):
+        '''Fetch the result of the (COMPLETED) job
+
+        Parameters:
+        -----------
+        filename: str, default: None
+            Stream the raw VOTable to this file (through `<filename>.part`)
+            instead of parsing it
+
+        Returns:
+        --------
+        int or pyvo.dal.TAPResults
+            The number of bytes written to `filename`, or the parsed result
+        '''
+
+        if filename is None:
+            chunks = [chunk async for chunk in self.iter_result(chunk_size)]
+            return await asyncio.get_running_loop().run_in_executor(None, _parse_votable, b''.join(chunks),
+                                                                    self.url)
+
+        # the file is written in a thread: a slow disk does not block the loop,
+        # and the next chunk is downloaded while the previous one is written
+        loop = asyncio.get_running_loop()
+        size = 0
+        part_filename = filename + '.part'
+        fd = await loop.run_in_executor(None, open, part_filename, 'wb')
+        writing = None
+        try:
+            async for chunk in self.iter_result(chunk_size):
+                if writing is not None:
+                    await writing
+                writing = loop.run_in_executor(None, fd.write, chunk)
+                size += len(chunk)
+            if writing is not None:
+                await writing
+        finally:
+            if writing is not None and not writing.done():
+                await asyncio.wait([writing])
+            await loop.run_in_executor(None, fd.close)
+        await loop.run_in_executor(None, os.replace, part_filename, filename)
+
+        return size
+
+    async def delete(self):
+        '''Delete (archive) the job'''
+        async with self.service.session.delete(self.url, allow_redirects=False) as response:
+            response.raise_for_status()
+
+
+async def run_queries(service, queries, directory='.', language='PostgreSQL', queue='1m', timeout=None,
+                      delete=False):
+    '''Submit, wait for and fetch many queries concurrently
+
+    Parameters:
+    -----------
+    service: AsyncTAPService
+        The service
+
+    queries: list((str, str)) or list((str, str, str)) or list((str, str, str, str))
+        The (name, query), (name, query, queue) or (name, query, queue,
+        language) of the jobs; the name is the runid of the job and the name
+        of its result `<directory>/<name>.xml`
+
+    directory: str, default: .
+        Where the results are written
+
+    timeout: float, default: None
+        The maximum number of seconds to wait for a job
+
+    delete: bool, default: False
+        Delete the jobs once their result is fetched
+
+    Returns:
+    --------
+    list(JobOutcome)
+        The outcome of each query, in the order of `queries`
+    '''
+
+    async def run_one(name, query, job_queue, job_language):
+        job = None
+        try:
+            job = await service.submit_job(query, language=job_language, runid=name, queue=job_queue)
+            await job.run()
+            phase = await job.wait(timeout=timeout)
+            if phase != 'COMPLETED':
+                message = await job.error_summary() if phase == 'ERROR' else ''
+                return JobOutcome(name, job.url, phase, None, message or phase)
+
+            filename = os.path.join(directory, name + '.xml')
+            await job.fetch_result(filename)
+            if delete:
+                await job.delete()
+            return JobOutcome(name, job.url, phase, filename, None)
+
+        except Exception as e:
+            return JobOutcome(name, job.url if job is not None else None,
+                              job.last_phase if job is not None else None, None, '%s: %s' % (type(e).__name__, e))
+
+    coroutines = []
+    for item in queries:
+        name, query = item[0], item[1]
+        job_queue = item[2] if len(item) > 2 else queue
+        job_language = item[3] if len(item) > 3 else language
+        coroutines.append(run_one(name, query, job_queue, job_language))
+
+    return await asyncio.gather(*coroutines)
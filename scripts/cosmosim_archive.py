@@ -0,0 +1,506 @@
+'''Archive many jobs at once, and keep the results below the quota
+
+The tutorial archives the COMPLETED jobs one after another, recreating an
+`AsyncTAPJob` (one request) before deleting it (another request, which
+follows a redirect to the full job list). `archive_jobs()` sends the DELETE
+requests directly, without following the redirect, through a bounded pool
+of threads and reports the progress and the failures.
+
+`QuotaArchiver` watches the total size of the results kept on the server
+against the quota (100 GB) and, when it gets close, archives the oldest
+jobs whose results were already downloaded (as recorded in a
+`cosmosim_ledger.JobLedger`), so new submissions never stall on quota.
+Results which were not downloaded yet are never archived.
+
+`rerun_archived()` re-materializes archived jobs selected by a runid pattern
+and/or a creation date range: their parameters (query, language, queue) are
+fetched concurrently from the small `<job>/parameters` documents, identical
+queries are submitted once, and the jobs are resubmitted through the pool of
+`cosmosim_submission` into their original queue.
+
+Example:
+--------
+
+    from cosmosim_archive import QuotaArchiver, archive_jobs
+
+    # archive all COMPLETED jobs
+    results = archive_jobs(tap_service)
+
+    # keep archiving in the background
+    archiver = QuotaArchiver(tap_service, ledger).start()
+
+    # rerun a whole archived campaign
+    results = rerun_archived(tap_service, runid='mvir_*', after='2022-11-01')
+'''
+
+import collections
+import concurrent.futures
+import datetime
+import fnmatch
+import threading
+import xml.etree.ElementTree as ElementTree
+
+from cosmosim_fetch import CHUNK_SIZE, result_url
+from cosmosim_poller import job_id
+from cosmosim_submission import pool_session, submit_queries
+
+# The quota of the results of each user
+QUOTA = 100 * 1024 ** 3
+
+# Outcome of the archiving of one job, `error` is None on success
+ArchiveResult = collections.namedtuple('ArchiveResult', ['url', 'error'])
+
+# What is needed to rerun an archived job
+ArchivedJob = collections.namedtuple('ArchivedJob', ['url', 'jobid', 'runid', 'created', 'query', 'language',
+                                                     'queue'])
+
+
+def job_url(tap_service, jobid):
+    '''The url of a job from its jobid'''
+    return tap_service.baseurl + '/async/' + jobid
+
+
+def archive_job(session, url):
+    '''Archive (DELETE) one job, without following the redirect to the job list'''
+
+    response = session.delete(url, allow_redirects=False, timeout=60)
+    response.raise_for_status()
+
+
+def archive_jobs(tap_service, job_urls=None, phases='COMPLETED', workers=8, ledger=None, progress=100):
+    '''Archive many jobs concurrently
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    job_urls: list(str), default: None
+        The jobs to archive, by default all the jobs in `phases`
+
+    phases: str or list(str), default: COMPLETED
+        The phases of the jobs to archive when `job_urls` is not given
+
+    workers: int, default: 8
+        The number of jobs archived at the same time
+
+    ledger: cosmosim_ledger.JobLedger, default: None
+        If given, the archived jobs are marked as ARCHIVED in the ledger
+
+    progress: int, default: 100
+        Print the progress every `progress` jobs (never if 0)
+
+    Returns:
+    --------
+    list(ArchiveResult)
+        One result per job, in the order of `job_urls`
+    '''
+
+    session = tap_service._session
+
+    if job_urls is None:
+        job_urls = [job_url(tap_service, job.jobid) for job in tap_service.get_job_list(phases=phases)]
+
+    pool_session(session, workers)
+
+    lock = threading.Lock()
+    counts = {'done': 0, 'failed': 0}
+
+    def archive(url):
+        try:
+            archive_job(session, url)
+            error = None
+        except Exception as e:
+            error = str(e)
+
+        with lock:
+            counts['done'] += 1
+            counts['failed'] += error is not None
+            if progress and (counts['done'] % progress == 0 or counts['done'] == len(job_urls)):
+                print('Archived %d/%d jobs (%d failed)' % (counts['done'] - counts['failed'], len(job_urls),
+                                                          counts['failed']))
+
+        return ArchiveResult(url, error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(archive, job_urls))
+
+    for result in results:
+        if result.error is not None:
+            print('FAILED %s: %s' % (result.url, result.error))
+
+    if ledger is not None:
+        # the ledger knows the jobs by their own urls
+        urls = {entry.jobid: entry.url for entry in ledger.jobs()}
+        ledger.update_phases({urls[job_id(result.url)]: 'ARCHIVED' for result in results
+                              if result.error is None and job_id(result.url) in urls})
+
+    return results
+
+
+def result_size(session, url, count=False):
+    '''The size in bytes of the result of a job, from the headers of a HEAD request (None if unknown)
+
+    With `count`, a result served without Content-Length (chunked) is
+    downloaded and its bytes counted.
+    '''
+
+    try:
+        response = session.head(result_url(url), allow_redirects=True, timeout=60)
+        if response.status_code < 400 and 'Content-Length' in response.headers:
+            return int(response.headers['Content-Length'])
+        if not count or response.status_code in (403, 404, 410):
+            return None
+
+        with session.get(result_url(url), headers={'Accept-Encoding': 'identity'}, stream=True,
+                         timeout=60) as response:
+            if response.status_code >= 400:
+                return None
+            if 'Content-Length' in response.headers:
+                return int(response.headers['Content-Length'])
+            return sum(len(chunk) for chunk in response.iter_content(chunk_size=CHUNK_SIZE))
+    except Exception as e:
+        print('JOB %s: the size of the result is unknown (%s)' % (url, e))
+        return None
+
+
+class QuotaArchiver(object):
+    '''Archive the oldest downloaded jobs when the results get close to the quota
+
+    The size of each result is asked once to the server (HEAD request) and
+    remembered: the local files may have another size (compressed,
+    converted). When the server does not tell it, the size recorded in the
+    ledger is used, or else the result is downloaded to count its bytes.
+    Sizes still unknown are asked again at the next check.
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    ledger: cosmosim_ledger.JobLedger
+        The ledger telling which results were already downloaded
+
+    quota: int, default: QUOTA
+        The quota in bytes
+
+    high: float, default: 0.9
+        Start archiving above this fraction of the quota
+
+    low: float, default: 0.75
+        Archive until the results are below this fraction of the quota
+
+    interval: float, default: 300
+        Seconds between two checks in the background
+
+    workers: int, default: 8
+        The number of concurrent requests
+    '''
+
+    def __init__(self, tap_service, ledger, quota=QUOTA, high=0.9, low=0.75, interval=300.0, workers=8):
+        self.tap_service = tap_service
+        self.ledger = ledger
+        self.quota = quota
+        self.high = high
+        self.low = low
+        self.interval = interval
+        self.workers = workers
+
+        self._sizes = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sizes(self):
+        '''The size of the result of each COMPLETED job on the server, by url
+
+        Returns:
+        --------
+        collections.OrderedDict
+            The sizes, the jobs ordered from the oldest to the newest (the
+            jobs whose size is unknown are left out)
+        '''
+
+        jobs = sorted(self.tap_service.get_job_list(phases='COMPLETED'), key=lambda job: str(job.creationtime))
+        urls = [job_url(self.tap_service, job.jobid) for job in jobs]
+
+        unknown = [url for url in urls if job_id(url) not in self._sizes]
+        if unknown:
+            recorded = {entry.jobid: entry.result_bytes for entry in self.ledger.jobs(fetched=True)}
+
+            def size(url):
+                # the server first, then the ledger, then the bytes of the result
+                size = result_size(session, url)
+                if size is None:
+                    size = recorded.get(job_id(url))
+                if size is None:
+                    size = result_size(session, url, count=True)
+                return size
+
+            session = self.tap_service._session
+            pool_session(session, self.workers)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for url, size in zip(unknown, executor.map(size, unknown)):
+                    if size is not None:
+                        self._sizes[job_id(url)] = size
+
+        missing = [url for url in urls if job_id(url) not in self._sizes]
+        if missing:
+            print('WARNING: the result size of %d jobs is unknown, they are not counted' % (len(missing),))
+
+        return collections.OrderedDict((url, self._sizes[job_id(url)]) for url in urls if job_id(url) in self._sizes)
+
+    def check(self):
+        '''Archive jobs if the results are above `high` * quota
+
+        Returns:
+        --------
+        list(ArchiveResult)
+            The archived jobs
+        '''
+
+        sizes = self.sizes()
+        usage = sum(sizes.values())
+        print('Results on the server: %.1f GB of %.1f GB' % (usage / 1024.0 ** 3, self.quota / 1024.0 ** 3))
+
+        if usage <= self.high * self.quota:
+            return []
+
+        # the oldest downloaded jobs go first
+        downloaded = {entry.jobid: entry for entry in self.ledger.jobs(fetched=True)}
+        candidates = sorted((url for url in sizes if job_id(url) in downloaded),
+                            key=lambda url: downloaded[job_id(url)].finished or 0)
+
+        selected = []
+        planned = usage
+        for url in candidates:
+            if planned <= self.low * self.quota:
+                break
+            selected.append(url)
+            planned -= sizes[url]
+
+        if planned > self.high * self.quota:
+            print('WARNING: still %.1f GB after archiving all downloaded results, fetch the others'
+                  % (planned / 1024.0 ** 3,))
+
+        results = archive_jobs(self.tap_service, selected, workers=self.workers, progress=0)
+        archived = [result for result in results if result.error is None]
+
+        # the ledger knows the jobs by their own urls
+        urls = {entry.jobid: entry.url for entry in downloaded.values()}
+        self.ledger.update_phases({urls[job_id(result.url)]: 'ARCHIVED' for result in archived})
+        for result in archived:
+            usage -= sizes[result.url]
+            self._sizes.pop(job_id(result.url), None)
+
+        print('Archived %d jobs, %.1f GB left' % (len(archived), usage / 1024.0 ** 3))
+        return archived
+
+    def run(self):
+        '''Check the quota every `interval` seconds until `stop()` is called'''
+
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                print('quota check failed: %s' % (e,))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        '''Run in a background thread'''
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='quota-archiver', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the background thread'''
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def _datetime(value):
+    '''A naive UTC datetime from a datetime or an ISO 8601 string'''
+
+    if value is None or isinstance(value, datetime.datetime) and value.tzinfo is None:
+        return value
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def list_archived(tap_service, runid=None, after=None, before=None, last=None):
+    '''The ARCHIVED jobs matching a runid pattern and a creation date range
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    runid: str, default: None
+        A shell-style pattern of the runids, e.g. `radial_prof_*`
+
+    after: datetime or str, default: None
+        Only the jobs created after this (UTC) date, filtered by the server
+
+    before: datetime or str, default: None
+        Only the jobs created before this (UTC) date
+
+    last: int, default: None
+        Only the most recent jobs, filtered by the server
+
+    Returns:
+    --------
+    list(pyvo.io.uws.tree.JobSummary)
+        The jobs, from the oldest to the newest
+    '''
+
+    after, before = _datetime(after), _datetime(before)
+    jobs = tap_service.get_job_list(phases='ARCHIVED', after=after, last=last)
+
+    selected = []
+    for job in jobs:
+        created = _datetime(job.creationtime)
+        if runid is not None and not fnmatch.fnmatchcase(job.runid or '', runid):
+            continue
+        if created is not None and ((after is not None and created < after) or
+                                    (before is not None and created >= before)):
+            continue
+        selected.append(job)
+
+    return sorted(selected, key=lambda job: str(job.creationtime))
+
+
+def job_parameters(session, url):
+    '''The parameters of a job (query, query_language, queue, ...), from `<job>/parameters`'''
+
+    response = session.get(url + '/parameters', timeout=60)
+    if response.status_code == 404:
+        # the parameters are part of the job document too
+        response = session.get(url, timeout=60)
+    response.raise_for_status()
+
+    root = ElementTree.fromstring(response.content)
+    return {element.get('id'): element.text or '' for element in root.iter()
+            if element.tag.rsplit('}', 1)[-1] == 'parameter'}
+
+
+def fetch_archived_jobs(tap_service, jobs, workers=8):
+    '''Fetch the parameters of archived jobs concurrently
+
+    Parameters:
+    -----------
+    jobs: list(pyvo.io.uws.tree.JobSummary)
+        The jobs, e.g. from `list_archived()`
+
+    Returns:
+    --------
+    list(ArchivedJob)
+        In the order of `jobs`, without the jobs whose parameters could
+        not be read
+    '''
+
+    session = tap_service._session
+    pool_session(session, workers)
+
+    def fetch(job):
+        url = job_url(tap_service, job.jobid)
+        try:
+            parameters = job_parameters(session, url)
+        except Exception as e:
+            print('FAILED %s: %s' % (url, e))
+            return None
+
+        # parameter names are case insensitive
+        parameters = {key.lower(): value for key, value in parameters.items()}
+        return ArchivedJob(url, job.jobid, job.runid, str(job.creationtime), parameters.get('query'),
+                           parameters.get('query_language') or parameters.get('lang') or 'PostgreSQL',
+                           parameters.get('queue') or '1m')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        archived = list(executor.map(fetch, jobs))
+
+    return [job for job in archived if job is not None and job.query]
+
+
+def rerun_archived(tap_service, runid=None, after=None, before=None, last=None, queue=None, prefix='',
+                   dedupe=True, ledger=None, workers=8, concurrency=None, dry_run=False):
+    '''Resubmit archived jobs in bulk
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    runid, after, before, last:
+        The selection of the archived jobs (see `list_archived()`)
+
+    queue: str, default: None
+        Resubmit into this queue instead of the original one of each job
+
+    prefix: str, default: ''
+        Prepended to the runids of the new jobs
+
+    dedupe: bool, default: True
+        Submit identical queries (same normalized text and language) once
+
+    ledger: cosmosim_ledger.JobLedger, default: None
+        Record the new jobs, and skip the queries having a job neither
+        archived nor failed in the ledger
+
+    workers: int, default: 8
+        The number of parameter documents fetched at the same time
+
+    concurrency: dict, default: QUEUE_CONCURRENCY
+        The maximum number of submissions at the same time per queue
+
+    dry_run: bool, default: False
+        Only print the jobs which would be resubmitted
+
+    Returns:
+    --------
+    list(SubmissionResult)
+    '''
+
+    from cosmosim_ledger import query_hash
+
+    jobs = list_archived(tap_service, runid=runid, after=after, before=before, last=last)
+    archived = fetch_archived_jobs(tap_service, jobs, workers=workers)
+    print('Found %d archived jobs' % (len(archived),))
+
+    queries = []
+    seen = set()
+    active = 0
+    for job in archived:
+        key = query_hash(job.query, job.language)
+
+        if dedupe and key in seen:
+            continue
+        seen.add(key)
+
+        if ledger is not None and any(entry.phase not in ('ARCHIVED', 'ERROR', 'ABORTED')
+                                      for entry in ledger.jobs(query_hash=key)):
+            active += 1
+            continue
+
+        queries.append((prefix + (job.runid or job.jobid), job.query, queue or job.queue, job.language))
+
+    if active:
+        print('%d queries already rerun, skipped' % (active,))
+
+    if dry_run:
+        for name, query, job_queue, language in queries:
+            print('> %s (%s, %s):\n%s\n' % (name, language, job_queue, query))
+        return []
+
+    results = submit_queries(tap_service, queries, concurrency=concurrency, ledger=ledger)
+    for result in results:
+        if result.error is not None:
+            print('FAILED %s: %s' % (result.name, result.error))
+
+    return results
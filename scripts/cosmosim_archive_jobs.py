@@ -25,16 +25,14 @@
 #
 # It is useful to always print the version of pyvo you are using. Most of non-working scripts fail because of an old version of `pyvo`.
 
-from pkg_resources import parse_version
-import pyvo
+from cosmosim_client import check_version
 
 #
-# Verify the version of pyvo
+# Verify the version of pyvo (without importing it)
 #
-if parse_version(pyvo.__version__) < parse_version('1.0'):
-    raise ImportError('pyvo version must be at least than 1.0')
+pyvo_version = check_version('pyvo', '1.0')
 
-print('\npyvo version %s \n' % (pyvo.__version__,))
+print('\npyvo version %s \n' % (pyvo_version,))
 # # Authentication
 # ---
 #
@@ -50,8 +48,7 @@ print('\npyvo version %s \n' % (pyvo.__version__,))
 #
 # The connection to the TAP service can be done that way:
 
-import requests
-import pyvo
+from cosmosim_client import connect
 
 #
 # Setup tap_service connection
@@ -62,11 +59,9 @@ token = 'Token <your-token>'
 
 print('TAP service %s \n' % (service_name,))
 
-# Setup authorization
-tap_session = requests.Session()
-tap_session.headers['Authorization'] = token
-
-tap_service = pyvo.dal.TAPService(url, session=tap_session)
+# Setup authorization: pyvo is only imported when a query is run
+tap_service = connect(url, token)
+tap_session = tap_service.session
 # # Archiving your jobs
 #
 # If you submit several large queries you may go over quota: set to 100 GB. In order to avoid to get over quota you may consider archiving your jobs. Archiving removes the data from the server side but keeps the SQL query. This allows to resubmit a query at a later time.
@@ -83,23 +78,23 @@ job.delete()
 # Archiving all COMPLETED jobs
 #
 
-# obtain the list of completed job_descriptions
-completed_job_descriptions = tap_service.get_job_list(phases='COMPLETED')
-
-# Archiving each of them
-for job_description in completed_job_descriptions:
-    
-    # get the jobid
-    jobid = job_description.jobid
-    
-    # recreate the url by hand
-    job_url = tap_service.baseurl + '/async/' + jobid
-    
-    # recreate the job
-    job = pyvo.dal.AsyncTAPJob(job_url, session=tap_session)
-    
-    print('Archiving: {url}'.format(url=job_url))
-    job.delete() # archive job
+from cosmosim_archive import archive_jobs
+
+# obtain the list of completed jobs and archive them, 8 at a time
+results = archive_jobs(tap_service, phases='COMPLETED', workers=8)
+
+# If the results of your jobs are downloaded by a script using a `JobLedger` (see `cosmosim_ledger`), the archiving can be done automatically: the `QuotaArchiver` checks the size of the results on the server every few minutes and, above 90% of the quota, archives the oldest jobs whose results were already downloaded.
+
+#
+# Archiving automatically before going over quota
+#
+
+from cosmosim_archive import QuotaArchiver
+from cosmosim_ledger import JobLedger
+
+archiver = QuotaArchiver(tap_service, JobLedger('jobs.sqlite'), high=0.9, low=0.75, interval=300)
+archiver.check()        # once, or
+# archiver.start()      # in the background until archiver.stop()
 
 # ## Rerunning `ARCHIVED` jobs
 #
@@ -109,36 +104,15 @@ for job_description in completed_job_descriptions:
 # Rerunning Archived jobs
 #
 
-# obtain the list of the two last ARCHIVED job_descriptions
-archived_job_descriptions = tap_service.get_job_list(phases='ARCHIVED', last=2)
-
-# rerunning the two last Archived jobs
-for job_description in archived_job_descriptions:
-    
-    # get jobid
-    jobid = job_description.jobid
-    
-    # recreate the url by hand
-    job_url = tap_service.baseurl + '/async/' + jobid
-    
-    # recreate the archived job
-    archived_job = pyvo.dal.AsyncTAPJob(job_url, session=tap_session)
-
-    # get the language (with a bit of magic)
-    lang = [parameter._content for parameter in archived_job._job.parameters if parameter._id == 'query_language'][0]
-
-    # extract the query
-    query = archived_job.query
-    
-    # resubmit the query with corresponding parameters
-    job = tap_service.submit_job(query, language=lang, runid='rerun', queue='1m')
-    print('%(url)s :\n%(query)s\n' % {"url": job_url, "query": query})
-    
-    # start the job
-    try:
-        job.run()
-    except pyvo.dal.DALServiceError:
-        raise ValueError("Please check that the SQL query is valid, and that the SQL language is correct.")    
+from cosmosim_archive import rerun_archived
+
+# rerun the two last ARCHIVED jobs, each into its original queue
+results = rerun_archived(tap_service, last=2, prefix='rerun_')
+
+for result in results:
+    if result.error is not None:
+        raise ValueError("Please check that the SQL query is valid, and that the SQL language is correct.\n%s"
+                         % (result.error,))
 
 # Retrieving the results is done alike explained above.
 #
@@ -148,37 +122,8 @@ for job_description in archived_job_descriptions:
 # Filtering by runid
 #
 
+# a pattern selects a whole campaign, e.g. 'radial_prof_*', and a date range narrows it down;
+# identical queries are submitted once
 target_runid = 'radial_prof_massive_bdmv'
 
-# obtain the list of completed job_descriptions
-archived_job_descriptions = tap_service.get_job_list(phases='ARCHIVED')
-
-for job_description in archived_job_descriptions:
-    
-    # select the job with runid fitting target_runid
-    if job_description.runid == target_runid:
-        
-        # get jobid
-        jobid = job_description.jobid
-    
-        # recreate the url by hand
-        job_url = tap_service.baseurl + '/async/' + jobid
-    
-        # recreate the archived job
-        archived_job = pyvo.dal.AsyncTAPJob(job_url, session=tap_session)
-
-        # get the language (with a bit of magic)
-        lang = [parameter._content for parameter in archived_job._job.parameters if parameter._id == 'query_language'][0]
-
-        # extract the query
-        query = archived_job.query
-    
-        # resubmit the query with corresponding parameters
-        job = tap_service.submit_job(query, language=lang, runid='rerun', queue='1m')
-        print('%(url)s :\n%(query)s\n' % {"url": job_url, "query": query})
-    
-        # start the job
-        try:
-            job.run()
-        except pyvo.dal.DALServiceError:	
-            raise ValueError("Please check that the SQL query is valid, and that the SQL language is correct.")
+results = rerun_archived(tap_service, runid=target_runid, after='2022-01-01', prefix='rerun_')
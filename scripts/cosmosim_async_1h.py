@@ -25,16 +25,14 @@
 #
 # It is useful to always print the version of pyvo you are using. Most of non-working scripts fail because of an old version of `pyvo`.
 
-from pkg_resources import parse_version
-import pyvo
+from cosmosim_client import check_version
 
 #
-# Verify the version of pyvo
+# Verify the version of pyvo (without importing it)
 #
-if parse_version(pyvo.__version__) < parse_version('1.0'):
-    raise ImportError('pyvo version must be at least than 1.0')
+pyvo_version = check_version('pyvo', '1.0')
 
-print('\npyvo version %s \n' % (pyvo.__version__,))
+print('\npyvo version %s \n' % (pyvo_version,))
 # # Authentication
 # ---
 #
@@ -50,8 +48,7 @@ print('\npyvo version %s \n' % (pyvo.__version__,))
 #
 # The connection to the TAP service can be done that way:
 
-import requests
-import pyvo
+from cosmosim_client import connect
 
 #
 # Setup tap_service connection
@@ -62,11 +59,9 @@ token = 'Token <your-token>'
 
 print('TAP service %s \n' % (service_name,))
 
-# Setup authorization
-tap_session = requests.Session()
-tap_session.headers['Authorization'] = token
-
-tap_service = pyvo.dal.TAPService(url, session=tap_session)
+# Setup authorization: pyvo is only imported when a query is run
+tap_service = connect(url, token)
+tap_session = tap_service.session
 # ## The 1 hour queue
 #
 # If you want to extract information on specific stars from various tables you have to `JOIN` tables. Your query may need more than a few seconds. For that, the **1 hour queue** provide a good balance. It should be noticed that for such a queue the wait method should not be used to prevent an overload of the server at peak usage. Therefore using the script with the `sleep()` method is recommended.
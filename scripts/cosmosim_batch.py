@@ -0,0 +1,298 @@
+'''Batched sync queries for many small lookups
+
+`cosmosim_sync_query.py` looks for the halos around one point with one
+`run_sync`. Repeated for tens of thousands of centres, the time goes into
+the HTTP round trips and the start of each query, not into the search.
+`run_lookups()` packs many lookups into a few sync queries, runs them
+concurrently, and splits the merged result back per lookup.
+
+The lookup query is written with `{name}` placeholders, filled with the
+parameters of each lookup. Two ways of packing are available:
+
+- `union` (default): each lookup becomes a subquery tagged with its key,
+  the subqueries of a batch are joined with UNION ALL. Any query works,
+  including a LIMIT per lookup.
+
+      SELECT bdmid, x, y, z, rvir, mvir FROM mdr1.bdmv
+       WHERE pdist(1000, x, y, z, {x}, {y}, {z}) < {radius}
+
+- `values` (PostgreSQL): the parameters of a batch form a VALUES list
+  replacing the `{values}` placeholder, aliased `lookups(lookup_key, x,
+  y, z, ...)`. The query joins it and selects `lookups.lookup_key`.
+
+      SELECT lookups.lookup_key, h.bdmid, h.x, h.y, h.z, h.rvir, h.mvir
+        FROM {values}
+        JOIN mdr1.bdmv AS h ON pdist(1000, h.x, h.y, h.z, lookups.x, lookups.y, lookups.z) < lookups.radius
+
+A batch failing or stopped by the output limit is cut in two and run again,
+down to single lookups.
+
+Example:
+--------
+
+    from cosmosim_batch import run_lookups
+
+    centres = {bdmid: {'x': x, 'y': y, 'z': z, 'radius': 5} for bdmid, x, y, z in halos}
+    results = run_lookups(tap_service, query, centres, language='PostgreSQL', batch_size=200, workers=4)
+
+    neighbours = results.groups[bdmid]      # astropy Table of the lookup
+    table = results.table                   # all the rows, with a lookup_key column
+'''
+
+import collections
+import concurrent.futures
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from cosmosim_merge import merge_chunks
+from cosmosim_store import download_query
+
+# The column holding the key of the lookup of each row
+KEY_COLUMN = 'lookup_key'
+
+# Lookups packed in one query
+BATCH_SIZE = 200
+
+# The maximum length of a batched query, in characters
+MAX_QUERY_LENGTH = 200000
+
+# Sync queries running at the same time
+WORKERS = 4
+
+# The output limit of the service was reached
+QUERY_OVERFLOW = re.compile(rb'<INFO[^>]*name="QUERY_STATUS"[^>]*value="OVERFLOW"')
+
+# Placeholders of a lookup query
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+# Outcome of `run_lookups()`: the merged table, a table per key, and the errors per key
+LookupResults = collections.namedtuple('LookupResults', ['table', 'groups', 'errors'])
+
+
+def sql_literal(value):
+    '''A python value as an SQL literal'''
+
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (bool, np.bool_)):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)):
+        if not np.isfinite(value):
+            raise ValueError('%r can not be used in a query' % (value,))
+        return repr(float(value))
+    return "'%s'" % (str(value).replace("'", "''"),)
+
+
+def batch_query(query, lookups, mode='union', key_column=KEY_COLUMN):
+    '''The query of a batch of lookups
+
+    Parameters:
+    -----------
+    query: str
+        The lookup query, with `{name}` placeholders (and `{values}` in values mode)
+
+    lookups: list((int, dict))
+        The index and the parameters of each lookup
+
+    mode: str, default: union
+        `union` or `values` (see the module documentation)
+
+    key_column: str, default: KEY_COLUMN
+        The column holding the index of the lookup
+
+    Returns:
+    --------
+    str
+    '''
+
+    if mode == 'union':
+        parts = []
+        for index, parameters in lookups:
+            subquery = query.strip().rstrip(';').format(**{name: sql_literal(value)
+                                                            for name, value in parameters.items()})
+            parts.append('SELECT %d AS %s, q%d.* FROM (\n%s\n) AS q%d' % (index, key_column, index, subquery, index))
+        return '\nUNION ALL\n'.join(parts)
+
+    if mode == 'values':
+        names = sorted(lookups[0][1])
+        rows = ',\n'.join('(%d, %s)' % (index, ', '.join(sql_literal(parameters[name]) for name in names))
+                          for index, parameters in lookups)
+        values = '(VALUES\n%s\n) AS lookups(%s)' % (rows, ', '.join([key_column] + names))
+        return query.strip().rstrip(';').replace('{values}', values)
+
+    raise ValueError('Unknown mode %r, use union or values' % (mode,))
+
+
+def plan_batches(query, lookups, mode='union', batch_size=BATCH_SIZE, max_length=MAX_QUERY_LENGTH):
+    '''Cut the lookups into batches of at most `batch_size` lookups and `max_length` characters'''
+
+    batches = []
+    batch = []
+    length = len(query)
+    for lookup in lookups:
+        size = len(batch_query(query, [lookup], mode)) - (len(query) if mode == 'values' else 0)
+        if batch and (len(batch) >= batch_size or length + size > max_length):
+            batches.append(batch)
+            batch = []
+            length = len(query)
+        batch.append(lookup)
+        length += size
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def split_by_key(table, keys, key_column=KEY_COLUMN):
+    '''The rows of a table for each key, in one stable sort
+
+    Parameters:
+    -----------
+    table: astropy.table.Table
+        The rows, with an integer `key_column` holding the index of their key
+
+    keys: list
+        The keys, by index
+
+    Returns:
+    --------
+    OrderedDict
+        key -> astropy.table.Table, in the order of `keys` (empty tables for
+        the keys without rows)
+    '''
+
+    indices = np.asarray(table[key_column], dtype=np.int64)
+    order = np.argsort(indices, kind='stable')
+    if len(order) and np.any(order[1:] < order[:-1]):
+        table = table[order]
+        indices = indices[order]
+
+    starts = np.searchsorted(indices, np.arange(len(keys)), side='left')
+    ends = np.searchsorted(indices, np.arange(len(keys)), side='right')
+
+    return collections.OrderedDict((key, table[start:end]) for key, start, end in zip(keys, starts, ends))
+
+
+def run_lookups(tap_service, query, lookups, language='PostgreSQL', mode='union', batch_size=BATCH_SIZE,
+                workers=WORKERS, max_length=MAX_QUERY_LENGTH, key_column=KEY_COLUMN, directory=None):
+    '''Run many lookups in batched, concurrent sync queries
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    query: str
+        The lookup query, with `{name}` placeholders for the parameters
+
+    lookups: dict or list((key, dict))
+        The parameters of each lookup, by key
+
+    language: str, default: PostgreSQL
+        The query language (the values mode needs PostgreSQL)
+
+    mode: str, default: union
+        How the lookups of a batch are packed: `union` or `values`
+
+    batch_size: int, default: BATCH_SIZE
+        The maximum number of lookups in one query
+
+    workers: int, default: WORKERS
+        The number of sync queries running at the same time
+
+    max_length: int, default: MAX_QUERY_LENGTH
+        The maximum length of one query
+
+    key_column: str, default: KEY_COLUMN
+        The column holding the index of the lookups in the batched queries
+
+    directory: str, default: None
+        Where the results of the batches are written (a temporary directory
+        removed at the end by default)
+
+    Returns:
+    --------
+    LookupResults
+        The merged table (with `key_column` holding the index of the key),
+        the table of each key, and the error of the keys which failed
+    '''
+
+    if mode == 'values' and language.lower() != 'postgresql':
+        raise ValueError('The values mode needs PostgreSQL')
+
+    items = list(lookups.items()) if isinstance(lookups, dict) else list(lookups)
+    keys = [key for key, parameters in items]
+    indexed = list(enumerate(parameters for key, parameters in items))
+    if not indexed:
+        return LookupResults(None, collections.OrderedDict(), {})
+
+    names = set(PLACEHOLDER.findall(query)) - set(['values'])
+    if mode == 'union':
+        for index, parameters in indexed:
+            if not names <= set(parameters):
+                raise ValueError('The lookup %r misses the parameters %s'
+                                 % (keys[index], ', '.join(sorted(names - set(parameters)))))
+
+    own_directory = directory is None
+    if own_directory:
+        directory = tempfile.mkdtemp(prefix='cosmosim_batch_')
+
+    filenames = {}
+    errors = {}
+
+    def run(batch):
+        filename = os.path.join(directory, 'batch_%08d_%d.xml' % (batch[0][0], len(batch)))
+        download_query(tap_service, batch_query(query, batch, mode, key_column), filename, language=language)
+        with open(filename, 'rb') as fd:
+            fd.seek(max(0, os.path.getsize(filename) - 64 * 1024))
+            if QUERY_OVERFLOW.search(fd.read()):
+                raise OverflowError('The output limit of the service was reached')
+        return filename
+
+    try:
+        batches = plan_batches(query, indexed, mode, batch_size, max_length)
+        print('Running %d lookups in %d batches' % (len(indexed), len(batches)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(run, batch): batch for batch in batches}
+
+            while pending:
+                done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    batch = pending.pop(future)
+                    try:
+                        filenames[batch[0][0]] = future.result()
+                    except Exception as e:
+                        # cut the failed batches in two, down to single lookups
+                        if len(batch) > 1:
+                            middle = len(batch) // 2
+                            print('Batch of %d lookups failed (%s), splitting it in two' % (len(batch), e))
+                            for half in (batch[:middle], batch[middle:]):
+                                pending[executor.submit(run, half)] = half
+                        else:
+                            errors[keys[batch[0][0]]] = '%s: %s' % (type(e).__name__, e)
+
+        ordered = [filenames[index] for index in sorted(filenames)]
+        if not ordered:
+            return LookupResults(None, collections.OrderedDict(), errors)
+
+        table = merge_chunks(ordered)
+    finally:
+        if own_directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if key_column not in table.colnames:
+        raise ValueError('The result has no %s column: select it in the query' % (key_column,))
+
+    groups = split_by_key(table, keys, key_column)
+    for key in errors:
+        del groups[key]
+
+    return LookupResults(table, groups, errors)
@@ -0,0 +1,350 @@
+'''Local cache of query results, keyed on the normalized query text
+
+Pipelines often run the very same queries many times a day (e.g. the
+snapshot table `mdr1.redshifts`). `CachedTAPService` wraps a
+`pyvo.dal.TAPService` so that `run_sync()` and `run_async()` (submit, wait
+and fetch) are answered from an on-disk store when the same query was
+already run. The key is a hash of the service url, the query language and
+the query text normalized (comments and extra white spaces removed).
+
+The store is bounded in size: the least recently used results are evicted
+first. An optional time-to-live expires results of tables which change.
+
+Example:
+--------
+
+    from cosmosim_cache import CachedTAPService, QueryCache
+
+    cache = QueryCache('~/.cache/cosmosim', max_bytes=5 * 1024**3, ttl=24 * 3600)
+    tap_service = CachedTAPService(pyvo.dal.TAPService(url, session=tap_session), cache)
+
+    tap_result = tap_service.run_sync(query, language='PostgreSQL')       # server
+    tap_result = tap_service.run_sync(query, language='PostgreSQL')       # cache
+    tap_results = tap_service.run_async(query, language='PostgreSQL', queue='1m')
+
+    print(cache.stats())
+'''
+
+import hashlib
+import os
+import re
+import threading
+import time
+
+from cosmosim_fetch import stream_result
+
+# Default maximum size of the cache: 10 GB
+MAX_BYTES = 10 * 1024 ** 3
+
+# Tokens of SQL text: string literals, quoted identifiers, comments, white spaces
+SQL_TOKENS = re.compile(r"""('(?:[^']|'')*')|("(?:[^"]|"")*")|(--[^\n]*)|(/\*.*?\*/)|(\s+)""", re.DOTALL)
+
+
+def _normalize_code(text):
+    '''Normalize SQL text holding no literal'''
+    text = re.sub(r'\s+', ' ', text.lower())
+    return re.sub(r' ?([(),;=<>+*/-]) ?', r'\1', text)
+
+
+def normalize_query(query):
+    '''Normalize a query so that equivalent texts share a cache key
+
+    Comments are removed, white spaces collapsed, the text outside string
+    literals and quoted identifiers lower-cased, and a trailing `;` dropped.
+    '''
+
+    parts = []
+    code = []
+    position = 0
+
+    for match in SQL_TOKENS.finditer(query):
+        code.append(query[position:match.start()])
+        literal, identifier, line_comment, block_comment, space = match.groups()
+        if literal or identifier:
+            # literals are kept as they are
+            parts.append(_normalize_code(''.join(code)))
+            parts.append(literal or identifier)
+            code = []
+        else:
+            code.append(' ')
+        position = match.end()
+
+    code.append(query[position:])
+    parts.append(_normalize_code(''.join(code)))
+
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def cache_key(service_url, query, language='ADQL', **parameters):
+    '''The cache key of a query: a sha256 of the url, language, parameters and normalized query'''
+
+    text = '\n'.join([service_url.rstrip('/'), language.lower()] +
+                     ['%s=%s' % (key.lower(), value) for key, value in sorted(parameters.items())
+                      if value is not None] +
+                     [normalize_query(query)])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class QueryCache(object):
+    '''On-disk store of raw VOTable results with LRU eviction and TTL
+
+    The results are plain files `<directory>/<key[:2]>/<key>.xml`. The time
+    of the last access (atime) orders the eviction, the time of the write
+    (mtime) the expiration, so no index is needed and several processes can
+    share a cache directory.
+
+    Parameters:
+    -----------
+    directory: str
+        The directory of the cache
+
+    max_bytes: int, default: MAX_BYTES
+        The maximum total size of the cached results
+
+    ttl: float, default: None
+        Seconds after which a result expires (never by default)
+    '''
+
+    def __init__(self, directory, max_bytes=MAX_BYTES, ttl=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._size = sum(size for path, size, atime in self._entries())
+
+    def path(self, key):
+        '''The file holding the result of a key'''
+        return os.path.join(self.directory, key[:2], key + '.xml')
+
+    def get(self, key):
+        '''The file of a cached result, or None (counted as hit or miss)'''
+
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return self._miss()
+
+        now = time.time()
+        if self.ttl is not None and now - stat.st_mtime > self.ttl:
+            self.discard(key)
+            return self._miss()
+
+        # mark as recently used, keep the time of the write
+        os.utime(path, (now, stat.st_mtime))
+
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += stat.st_size
+
+        return path
+
+    def put(self, key, filename):
+        '''Move a downloaded result into the cache, then evict if needed
+
+        Returns:
+        --------
+        str
+            The file of the cached result
+        '''
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(filename)
+        os.replace(filename, path)
+
+        with self._lock:
+            self._size += size
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+        return path
+
+    def discard(self, key):
+        '''Remove a result from the cache'''
+
+        path = self.path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+
+        with self._lock:
+            self._size -= size
+
+    def evict(self):
+        '''Remove the least recently used results until the cache fits in max_bytes'''
+
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+
+        for path, entry_size, atime in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+        with self._lock:
+            self._size = size
+
+    def stats(self):
+        '''Hit and miss counters, and the size of the cache'''
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / float(lookups) if lookups else 0.0,
+                'bytes_served': self.bytes_served,
+                'bytes': self._size,
+            }
+
+    def _miss(self):
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _entries(self):
+        '''(path, size, atime) of all cached results'''
+        for root, directories, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.xml'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_size, stat.st_atime
+
+
+class CachedTAPService(object):
+    '''A TAPService answering repeated queries from a `QueryCache`
+
+    Every other attribute is the one of the wrapped service, so the object
+    can be used in place of a `pyvo.dal.TAPService`.
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The wrapped TAP service
+
+    cache: QueryCache
+        The store of the results
+    '''
+
+    def __init__(self, tap_service, cache):
+        self.tap_service = tap_service
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.tap_service, name)
+
+    def run_sync(self, query, language='ADQL', maxrec=None, uploads=None, **keywords):
+        '''Run a sync query, or read its result from the cache
+
+        Queries with uploads are never cached.
+
+        Returns:
+        --------
+        pyvo.dal.TAPResults
+        '''
+
+        if uploads:
+            return self.tap_service.run_sync(query, language=language, maxrec=maxrec, uploads=uploads, **keywords)
+
+        key = cache_key(self.tap_service.baseurl, query, language, maxrec=maxrec, **keywords)
+        path = self.cache.get(key)
+        if path is not None:
+            return self._results(path)
+
+        # imported here: cosmosim_store imports this module
+        from cosmosim_store import download_query
+
+        #
+        # Stream the result of the sync query to a temporary file
+        #
+        filename = self.cache.path(key) + '.%d.part' % (threading.get_ident(),)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        try:
+            download_query(self.tap_service, query, filename, language=language, maxrec=maxrec, **keywords)
+        except Exception:
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
+
+        return self._store(key, filename)
+
+    def run_async(self, query, language='ADQL', queue='1m', runid=None, maxrec=None, timeout=None, **keywords):
+        '''Submit an async job, wait for it and fetch its result, or read it from the cache
+
+        Parameters:
+        -----------
+        query: str
+            The query string
+
+        language: str, default: ADQL
+            The query language
+
+        queue: str, default: 1m
+            The queue to use
+
+        runid: str, default: None
+            The runid of the job
+
+        timeout: float, default: None
+            Seconds to wait for the job (pyvo's default if None)
+
+        Returns:
+        --------
+        pyvo.dal.TAPResults
+        '''
+
+        key = cache_key(self.tap_service.baseurl, query, language, maxrec=maxrec, **keywords)
+        path = self.cache.get(key)
+        if path is not None:
+            return self._results(path)
+
+        job = self.tap_service.submit_job(query, language=language, runid=runid, queue=queue, maxrec=maxrec,
+                                          **keywords)
+        job.run()
+        if timeout is None:
+            job.wait(phases=['COMPLETED', 'ERROR', 'ABORTED'])
+        else:
+            job.wait(phases=['COMPLETED', 'ERROR', 'ABORTED'], timeout=timeout)
+        job.raise_if_error()
+
+        filename = self.cache.path(key) + '.%d.part' % (threading.get_ident(),)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        stream_result(self.tap_service._session, job.url, filename)
+
+        return self._store(key, filename)
+
+    def _store(self, key, filename):
+        '''Parse a downloaded result and cache it, unless it is an error'''
+
+        try:
+            results = self._results(filename)
+        except Exception:
+            os.remove(filename)
+            raise
+
+        self.cache.put(key, filename)
+        return results
+
+    def _results(self, path):
+        import pyvo
+        from astropy.io import votable
+
+        return pyvo.dal.TAPResults(votable.parse(path), url=self.tap_service.baseurl)
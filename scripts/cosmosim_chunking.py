@@ -0,0 +1,357 @@
+'''Automatic range chunking of long queries ("Chunk it!")
+
+The tutorial suggests to cut a query that is too long for a queue into a
+list of shorter queries, by hand, on a column like `mtot`, `mvir` or
+`foftreeid`. The functions of this module do it automatically:
+
+1. `sample_distribution()` measures the distribution of the chunking column
+   with cheap sync queries (COUNT/MIN/MAX, then histograms with
+   `width_bucket`),
+2. `plan_ranges()` cuts it into ranges holding about the same number of
+   rows, sized so that each chunk fits in the time limit of the queue,
+3. `run_chunked()` submits one job per range, splits again any chunk which
+   times out, and merges the results in the order of the ranges.
+
+The query is written with a `{chunk}` placeholder where the range condition
+goes:
+
+    from cosmosim_chunking import run_chunked
+
+    query = \'\'\'
+    SELECT bdmid, mvir, rvir FROM mdr1.bdmv
+     WHERE snapnum=416 AND {chunk}
+     ORDER BY mvir
+    \'\'\'
+
+    table, filenames = run_chunked(tap_service, query, 'mdr1.bdmv', 'mvir', where='snapnum=416', queue='1m')
+'''
+
+import collections
+import concurrent.futures
+import os
+import re
+
+import numpy as np
+
+from cosmosim_fetch import stream_result
+from cosmosim_merge import merge_chunks
+from cosmosim_poller import JobPoller
+from cosmosim_submission import submit_queries
+
+#
+# Time limit of each queue in seconds
+#
+QUEUE_TIME_LIMIT = {
+    '1m': 60.0,
+    '1h': 3600.0,
+    '5h': 18000.0,
+}
+
+# Rows a job is assumed to process per second (tune it for your query)
+ROWS_PER_SECOND = 100000.0
+
+# Fraction of the time limit a chunk is planned to use
+SAFETY = 0.5
+
+# Messages of jobs stopped by the time limit of their queue
+TIMEOUT_PATTERN = re.compile(r'time ?out|timed out|time limit|statement timeout|execution ?duration', re.IGNORECASE)
+
+# Distribution of a column: total rows, histogram edges and counts
+Distribution = collections.namedtuple('Distribution', ['count', 'edges', 'counts', 'integer'])
+
+# One chunk of a chunked query
+Chunk = collections.namedtuple('Chunk', ['name', 'low', 'high', 'last'])
+
+
+def _histogram(tap_service, table, column, condition, low, high, bins, lang):
+    '''Count the rows of `bins` equal-width bins between low and high'''
+
+    histogram = tap_service.run_sync('SELECT width_bucket({column}, {low!r}, {high!r}, {bins}) AS bucket, '
+                                     'COUNT(*) AS n FROM {table} WHERE {condition} '
+                                     'GROUP BY bucket ORDER BY bucket'.format(column=column, low=low, high=high,
+                                                                              bins=bins, table=table,
+                                                                              condition=condition),
+                                     language=lang).to_table()
+
+    # width_bucket puts the maximum in the bucket bins + 1
+    counts = np.zeros(bins, dtype=np.int64)
+    buckets = np.clip(np.asarray(histogram['bucket'], dtype=np.int64), 1, bins) - 1
+    np.add.at(counts, buckets, np.asarray(histogram['n'], dtype=np.int64))
+
+    return counts
+
+
+def sample_distribution(tap_service, table, column, where=None, bins=100, max_bin_rows=None, lang='PostgreSQL'):
+    '''Measure the distribution of a column with a few sync queries
+
+    A first query counts the rows and finds the extent of the column, a
+    second one builds a histogram with `width_bucket`. Bins holding more than
+    `max_bin_rows` rows are refined with a histogram of their own, so that
+    skewed distributions (e.g. halo masses) are measured precisely where the
+    rows are.
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    table: str
+        The table holding the column, e.g. `mdr1.bdmv`
+
+    column: str
+        The chunking column, e.g. `mvir`
+
+    where: str, default: None
+        The condition of the query, the distribution is measured on the
+        matching rows only
+
+    bins: int, default: 100
+        The number of bins of the histogram
+
+    max_bin_rows: int, default: None
+        Refine (once) the bins holding more rows than this
+
+    Returns:
+    --------
+    Distribution
+    '''
+
+    where = where or 'TRUE'
+
+    summary = tap_service.run_sync('SELECT COUNT(*) AS n, MIN({column}) AS low, MAX({column}) AS high '
+                                   'FROM {table} WHERE {where}'.format(column=column, table=table, where=where),
+                                   language=lang).to_table()
+
+    count = int(summary['n'][0])
+    if count == 0:
+        return Distribution(0, np.array([]), np.array([]), False)
+
+    low, high = summary['low'][0].item(), summary['high'][0].item()
+    integer = np.issubdtype(summary['low'].dtype, np.integer)
+    if low == high:
+        return Distribution(count, np.array([low, high]), np.array([count]), integer)
+
+    counts = _histogram(tap_service, table, column, where, low, high, bins, lang)
+    edges = np.linspace(float(low), float(high), bins + 1)
+
+    if max_bin_rows is None:
+        return Distribution(count, edges, counts, integer)
+
+    #
+    # Refine the crowded bins
+    #
+    refined_edges, refined_counts = [edges[:1]], []
+    for i in np.arange(bins):
+        if counts[i] <= max_bin_rows:
+            refined_edges.append(edges[i + 1:i + 2])
+            refined_counts.append(counts[i:i + 1])
+            continue
+
+        condition = '({where}) AND {column} >= {low!r} AND {column} {op} {high!r}'.format(
+            where=where, column=column, low=edges[i].item(), high=edges[i + 1].item(),
+            op='<=' if i == bins - 1 else '<')
+        refined_edges.append(np.linspace(edges[i], edges[i + 1], bins + 1)[1:])
+        refined_counts.append(_histogram(tap_service, table, column, condition, edges[i].item(),
+                                         edges[i + 1].item(), bins, lang))
+
+    return Distribution(count, np.concatenate(refined_edges), np.concatenate(refined_counts), integer)
+
+
+def rows_per_chunk(queue, rows_per_second=ROWS_PER_SECOND, safety=SAFETY):
+    '''The number of rows a chunk may hold to fit in the time limit of a queue'''
+    return max(1, int(QUEUE_TIME_LIMIT[queue] * rows_per_second * safety))
+
+
+def plan_ranges(distribution, max_rows):
+    '''Cut a distribution into ranges holding at most about `max_rows` rows
+
+    The cuts are placed on the cumulative histogram, so dense regions get
+    narrow ranges and sparse regions wide ones.
+
+    Returns:
+    --------
+    list((low, high))
+        Contiguous ranges covering the whole distribution, the low bound
+        is included, the high bound excluded (except for the last range)
+    '''
+
+    if distribution.count == 0:
+        return []
+
+    edges = distribution.edges
+    nchunks = int(np.ceil(distribution.count / float(max_rows)))
+    if nchunks <= 1 or len(edges) < 3:
+        return [(edges[0], edges[-1])]
+
+    # place the cuts where the (linearly interpolated) cumulative count crosses k * count / nchunks
+    cumulative = np.concatenate([[0], np.cumsum(distribution.counts)])
+    targets = np.arange(1, nchunks) * distribution.count / float(nchunks)
+    cuts = np.interp(targets, cumulative, edges)
+
+    if distribution.integer:
+        cuts = np.ceil(cuts)
+
+    bounds = np.unique(np.concatenate([[edges[0]], cuts, [edges[-1]]]))
+    if distribution.integer:
+        bounds = bounds.astype(np.int64)
+
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def chunk_condition(column, chunk):
+    '''The SQL condition selecting the rows of a chunk'''
+    return '{column} >= {low!r} AND {column} {op} {high!r}'.format(column=column, low=chunk.low, high=chunk.high,
+                                                                  op='<=' if chunk.last else '<')
+
+
+def chunk_queries(query, column, chunks):
+    '''Build the (name, query) pairs of the chunks of a query with a `{chunk}` placeholder'''
+    return [(chunk.name, query.replace('{chunk}', '(%s)' % (chunk_condition(column, chunk),)))
+            for chunk in chunks]
+
+
+def split_chunk(chunk, integer=False):
+    '''Cut a chunk in two halves'''
+
+    middle = (chunk.low + chunk.high) / 2.0
+    if integer:
+        middle = int(np.ceil(middle))
+        if middle <= chunk.low or (middle >= chunk.high and not chunk.last):
+            return [chunk]
+
+    return [Chunk(chunk.name + 'a', chunk.low, middle, False),
+            Chunk(chunk.name + 'b', middle, chunk.high, chunk.last)]
+
+
+def run_chunked(tap_service, query, table, column, where=None, queue='1m', name='chunk', lang='PostgreSQL',
+                directory='.', rows_per_second=ROWS_PER_SECOND, max_splits=4, bins=100, poller=None, output=None):
+    '''Plan, submit and merge a chunked query
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    query: str
+        The query, with a `{chunk}` placeholder for the range condition
+
+    table: str
+        The table holding the chunking column
+
+    column: str
+        The chunking column
+
+    where: str, default: None
+        The condition of the query, used to measure the distribution
+
+    queue: str, default: 1m
+        The queue every chunk must fit in
+
+    name: str, default: chunk
+        The prefix of the runids of the chunks
+
+    directory: str, default: .
+        Where the results of the chunks are written (`<runid>.xml`)
+
+    rows_per_second: float, default: ROWS_PER_SECOND
+        The speed assumed to size the chunks
+
+    max_splits: int, default: 4
+        How many times a chunk timing out may be cut in two
+
+    poller: cosmosim_poller.JobPoller, default: None
+        The poller used to wait for the jobs (a new one by default)
+
+    output: str, default: None
+        Write the merged result to this file (see `cosmosim_merge.merge_chunks()`)
+
+    Returns:
+    --------
+    (astropy.table.Table, list(str))
+        The merged result, and the filenames of the results of the chunks
+    '''
+
+    max_rows = rows_per_chunk(queue, rows_per_second)
+    distribution = sample_distribution(tap_service, table, column, where=where, bins=bins,
+                                       max_bin_rows=max_rows // 2, lang=lang)
+    ranges = plan_ranges(distribution, max_rows)
+    chunks = [Chunk('%s_%04d' % (name, i), low, high, i == len(ranges) - 1) for i, (low, high) in enumerate(ranges)]
+    print('Submitting %d chunks of %d rows' % (len(chunks), distribution.count))
+
+    session = tap_service._session
+    own_poller = poller is None
+    if own_poller:
+        poller = JobPoller(session, tap_service=tap_service).start()
+
+    filenames = {}
+    pending = {}
+    failed = []
+
+    def submit(chunks):
+        by_name = {chunk.name: chunk for chunk in chunks}
+        for result in submit_queries(tap_service, chunk_queries(query, column, chunks), lang=lang, queue=queue):
+            if result.error:
+                failed.append((by_name[result.name], result.error))
+                continue
+            pending[poller.track(result.url, queue=queue)] = by_name[result.name]
+
+    try:
+        submit(chunks)
+
+        while pending:
+            done, _ = concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    job_url, phase = future.result()
+                except Exception as e:
+                    # the job could not be polled (e.g. it does not exist anymore)
+                    failed.append((chunk, e))
+                    continue
+
+                if phase == 'COMPLETED':
+                    filename = os.path.join(directory, chunk.name + '.xml')
+                    try:
+                        stream_result(session, job_url, filename)
+                    except Exception as e:
+                        failed.append((chunk, e))
+                        continue
+                    filenames[chunk] = filename
+                    continue
+
+                # split again the chunks stopped by the time limit of the queue,
+                # each split appends a letter to the name of the chunk
+                halves = split_chunk(chunk, distribution.integer)
+                depth = len(chunk.name) - len(chunks[0].name)
+                if (phase == 'ERROR' and len(halves) == 2 and depth < max_splits
+                        and TIMEOUT_PATTERN.search(error_summary(session, job_url))):
+                    print('JOB %s: timed out, splitting it in two' % (chunk.name,))
+                    submit(halves)
+                else:
+                    failed.append((chunk, phase))
+    finally:
+        if own_poller:
+            poller.stop()
+
+    if failed:
+        raise RuntimeError('The following chunks failed: %s' % (', '.join('%s (%s)' % (chunk.name, reason)
+                                                                         for chunk, reason in failed),))
+
+    #
+    # Merge the results in the order of the ranges, then of the ORDER BY
+    #
+    ordered = sorted(filenames, key=lambda chunk: chunk.low)
+    merged = merge_chunks([filenames[chunk] for chunk in ordered], order_by=query, output=output) if ordered else None
+
+    return merged, [filenames[chunk] for chunk in ordered]
+
+
+def error_summary(session, job_url):
+    '''The error message of a job, from its UWS document'''
+
+    import pyvo
+
+    job = pyvo.dal.AsyncTAPJob(job_url, session=session)
+    summary = job.job.errorsummary
+    return summary.message.content if summary is not None and summary.message is not None else ''
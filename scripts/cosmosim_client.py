@@ -0,0 +1,383 @@
+'''Shared, fast-starting set-up of the TAP client of the scripts
+
+Every script starts with the same preamble: `pkg_resources` to check the
+version of pyvo, `import pyvo`, a `requests.Session` holding the token and
+a `pyvo.dal.TAPService`. Importing `pkg_resources` takes a few hundred
+milliseconds and pyvo (with astropy) close to a second, even in the
+scripts which never parse a table: for short cron jobs run thousands of
+times a day, the start-up costs more than the work. This module:
+
+- checks the versions with `importlib.metadata`, without importing the
+  packages (`check_version()`),
+- builds a `TAPClient`, which can be used wherever a `pyvo.dal.TAPService`
+  is expected: the session (`cosmosim_session.tap_session()`), the url and
+  the listing of the jobs are available at once, pyvo is imported on the
+  first call needing it,
+- keeps the VOSI documents of the service (capabilities, tables) in an
+  on-disk cache, used by pyvo instead of requesting them on every run.
+
+Example:
+--------
+
+    from cosmosim_client import check_version, connect
+
+    pyvo_version = check_version('pyvo', '1.0')
+    tap_service = connect('https://www.cosmosim.org/tap', 'Token <your-token>')
+
+    jobs = tap_service.get_job_list(phases='COMPLETED')     # no pyvo import
+    job = tap_service.submit_job(query, language='PostgreSQL', queue='1m')     # pyvo imported here
+'''
+
+import collections
+import hashlib
+import io
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+from importlib import metadata
+
+from cosmosim_session import tap_session
+
+SERVICE_NAME = 'CosmoSim'
+
+URL = 'https://www.cosmosim.org/tap'
+
+# The minimum versions of the dependencies
+REQUIREMENTS = {
+    'pyvo': '1.0',
+}
+
+CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join('~', '.cache')), 'cosmosim', 'vosi')
+
+# Seconds the VOSI documents are kept: one day
+VOSI_TTL = 24 * 3600.0
+
+VOSI_DOCUMENTS = ('capabilities', 'tables')
+
+# The short description of a job, as listed by the service
+JobRef = collections.namedtuple('JobRef', ['jobid', 'runid', 'ownerid', 'phase', 'creationtime'])
+
+
+def version_tuple(version):
+    '''The leading numbers of a version, e.g. "1.5.2rc1" -> (1, 5, 2)'''
+    match = re.match(r'\d+(?:\.\d+)*', version.strip())
+    return tuple(int(part) for part in match.group(0).split('.')) if match else ()
+
+
+def check_version(package='pyvo', minimum=None):
+    '''Check the installed version of a package without importing it
+
+    Returns:
+    --------
+    str
+        The installed version
+
+    Raises:
+    -------
+    ImportError
+        If the package is missing or older than `minimum`
+    '''
+
+    minimum = minimum or REQUIREMENTS.get(package)
+    try:
+        version = metadata.version(package)
+    except metadata.PackageNotFoundError:
+        raise ImportError('%s is not installed: pip install "%s>=%s"' % (package, package, minimum or 0))
+
+    if minimum is not None and version_tuple(version) < version_tuple(minimum):
+        raise ImportError('%s version must be at least %s, not %s' % (package, minimum, version))
+
+    return version
+
+
+class VOSICache(object):
+    '''On-disk cache of the VOSI documents of TAP services
+
+    The documents are plain files `<directory>/<hash of the url>/<name>.xml`,
+    expired `ttl` seconds after they were written. An expired document is
+    still used when the service can not be reached.
+
+    Parameters:
+    -----------
+    directory: str, default: CACHE_DIRECTORY
+        The directory of the cache
+
+    ttl: float, default: VOSI_TTL
+        The seconds a document is kept
+    '''
+
+    def __init__(self, directory=CACHE_DIRECTORY, ttl=VOSI_TTL):
+        self.directory = os.path.expanduser(directory)
+        self.ttl = ttl
+
+    def path(self, baseurl, name):
+        '''The file of a document'''
+        key = hashlib.sha256(baseurl.rstrip('/').encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, key, name + '.xml')
+
+    def get(self, session, baseurl, name, refresh=False):
+        '''The content of a document, from the cache or from the service
+
+        Returns:
+        --------
+        bytes
+        '''
+
+        path = self.path(baseurl, name)
+        try:
+            fresh = not refresh and time.time() - os.path.getmtime(path) < self.ttl
+        except OSError:
+            fresh = False
+
+        if fresh:
+            with open(path, 'rb') as fd:
+                return fd.read()
+
+        try:
+            response = session.get('%s/%s' % (baseurl.rstrip('/'), name), timeout=60)
+            response.raise_for_status()
+        except Exception:
+            if os.path.exists(path):
+                print('WARNING: %s of %s unavailable, using the cached copy' % (name, baseurl))
+                with open(path, 'rb') as fd:
+                    return fd.read()
+            raise
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = '%s.%d.part' % (path, os.getpid())
+        with open(part_path, 'wb') as fd:
+            fd.write(response.content)
+        os.replace(part_path, path)
+
+        return response.content
+
+    def clear(self, baseurl):
+        '''Remove the documents of a service'''
+        for name in VOSI_DOCUMENTS:
+            try:
+                os.remove(self.path(baseurl, name))
+            except OSError:
+                pass
+
+
+class _LazyTables(object):
+    '''The tables of a service, parsed from the cached VOSI document on first use
+
+    Stands in for the `pyvo.dal.vosi.VOSITables` pyvo keeps in
+    `TAPService._tables`.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self._tables = None
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('_client', '_tables'):
+            raise AttributeError(name)
+        return getattr(self.tables, name)
+
+    def __iter__(self):
+        return iter(self.tables)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    @property
+    def tables(self):
+        '''The `pyvo.dal.vosi.VOSITables`'''
+
+        if self._tables is None:
+            from pyvo.dal.vosi import VOSITables
+            from pyvo.io import vosi
+
+            url = self._client.baseurl + '/tables'
+            self._tables = VOSITables(vosi.parse_tables(io.BytesIO(self._client.vosi_document('tables'))), url)
+
+        return self._tables
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_job_list(content):
+    '''The JobRefs of a UWS job list document'''
+
+    jobs = []
+    for element in ElementTree.fromstring(content):
+        if _local(element.tag) != 'jobref':
+            continue
+        values = {_local(child.tag): (child.text or '').strip() for child in element}
+        jobs.append(JobRef(element.get('id'), values.get('runId') or None, values.get('ownerId') or None,
+                           values.get('phase'), values.get('creationTime') or None))
+    return jobs
+
+
+class TAPClient(object):
+    '''A TAP service whose pyvo part is only built when needed
+
+    The attributes and methods of `pyvo.dal.TAPService` not defined here
+    are the ones of the underlying service, created (and pyvo imported) on
+    first access.
+
+    Parameters:
+    -----------
+    baseurl: str, default: URL
+        The url of the TAP service
+
+    token: str, default: None
+        The `Authorization` header, e.g. `Token <your-token>`
+
+    session: requests.Session, default: None
+        The session (default: `cosmosim_session.tap_session(token)`)
+
+    cache: VOSICache, default: None
+        The cache of the VOSI documents (none by default)
+    '''
+
+    def __init__(self, baseurl=URL, token=None, session=None, cache=None):
+        self._tap_service = None
+        self.baseurl = baseurl.rstrip('/')
+        self._session = session if session is not None else tap_session(token)
+        self.cache = cache
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == '_tap_service':
+            raise AttributeError(name)
+        return getattr(self.tap_service, name)
+
+    def __repr__(self):
+        return '<TAPClient %s%s>' % (self.baseurl, '' if self._tap_service is None else ' (pyvo loaded)')
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def tap_service(self):
+        '''The underlying pyvo.dal.TAPService'''
+
+        if self._tap_service is None:
+            import pyvo
+
+            tap_service = pyvo.dal.TAPService(self.baseurl, session=self._session)
+            if self.cache is not None:
+                # pyvo reads the capabilities through this method
+                tap_service._capabilities = self._cached_document('capabilities')
+                # and keeps the parsed tables in this attribute, filled on first access
+                tap_service._tables = _LazyTables(self)
+            self._tap_service = tap_service
+
+        return self._tap_service
+
+    def _cached_document(self, name):
+        def document():
+            return io.BytesIO(self.vosi_document(name))
+        return document
+
+    def vosi_document(self, name, refresh=False):
+        '''The raw VOSI document `name` (capabilities, tables), from the cache if any'''
+
+        if self.cache is not None:
+            return self.cache.get(self._session, self.baseurl, name, refresh=refresh)
+
+        response = self._session.get('%s/%s' % (self.baseurl, name), timeout=60)
+        response.raise_for_status()
+        return response.content
+
+    def capabilities_summary(self):
+        '''The query languages, output formats, upload methods and limits of the service
+
+        Read from the (cached) capabilities document, without pyvo.
+
+        Returns:
+        --------
+        dict
+        '''
+
+        root = ElementTree.fromstring(self.vosi_document('capabilities'))
+        summary = {'languages': [], 'output_formats': [], 'upload_methods': [], 'output_limit': None,
+                   'upload_limit': None}
+
+        for element in root.iter():
+            tag = _local(element.tag)
+            children = {_local(child.tag): child for child in element}
+            if tag == 'language' and 'name' in children:
+                summary['languages'].append(children['name'].text.strip())
+            elif tag == 'outputFormat' and 'mime' in children:
+                summary['output_formats'].append(children['mime'].text.strip())
+            elif tag == 'uploadMethod':
+                summary['upload_methods'].append(element.get('ivo-id'))
+            elif tag in ('outputLimit', 'uploadLimit'):
+                limit = children.get('hard', children.get('default'))
+                if limit is not None and limit.text:
+                    key = 'output_limit' if tag == 'outputLimit' else 'upload_limit'
+                    summary[key] = (int(float(limit.text)), limit.get('unit', 'row'))
+
+        return summary
+
+    def get_job_list(self, phases=None, after=None, last=None):
+        '''List the jobs of the user, without pyvo
+
+        Parameters:
+        -----------
+        phases: str or list(str), default: None
+            Only the jobs in these phases (ARCHIVED jobs are only listed on demand)
+
+        after: datetime.datetime or str, default: None
+            Only the jobs created after this time (UTC)
+
+        last: int, default: None
+            Only the `last` most recent jobs
+
+        Returns:
+        --------
+        list(JobRef)
+            Their `creationtime` is an ISO 8601 string
+        '''
+
+        parameters = {}
+        if phases:
+            parameters['PHASE'] = [phases] if isinstance(phases, str) else list(phases)
+        if after is not None:
+            parameters['AFTER'] = after if isinstance(after, str) else after.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        if last is not None:
+            parameters['LAST'] = int(last)
+
+        response = self._session.get(self.baseurl + '/async', params=parameters, timeout=300)
+        response.raise_for_status()
+        return parse_job_list(response.content)
+
+
+def connect(url=URL, token=None, session=None, cache=True):
+    '''Set up the client of a TAP service (see `TAPClient`)
+
+    Parameters:
+    -----------
+    url: str, default: URL
+        The url of the TAP service
+
+    token: str, default: None
+        The `Authorization` header, e.g. `Token <your-token>`
+
+    session: requests.Session, default: None
+        The session (default: `cosmosim_session.tap_session(token)`)
+
+    cache: bool or VOSICache, default: True
+        Cache the VOSI documents on disk (in CACHE_DIRECTORY if True)
+
+    Returns:
+    --------
+    TAPClient
+    '''
+
+    if cache is True:
+        cache = VOSICache()
+    return TAPClient(url, token=token, session=session, cache=cache or None)
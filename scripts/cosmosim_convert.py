@@ -0,0 +1,590 @@
+'''Convert VOTable results to columnar Parquet / Arrow IPC files
+
+`tap_results.to_table()` parses the whole VOTable in memory before it can be
+written in another format. The functions of this module read the rows of a
+TABLEDATA, BINARY or BINARY2 VOTable incrementally, in batches of
+`batch_size` rows, and write each batch to a Parquet or Arrow IPC (feather
+v2) file, so the peak memory stays bounded whatever the size of the result.
+The unit, UCD and datatype of each VOTable column are kept in the metadata
+of the schema. FITS serialized VOTables (and streams not embedded in base64)
+are still parsed as a whole by astropy.
+
+Reading a Parquet file back is much faster than parsing the XML again:
+
+    import pyarrow.parquet
+
+    table = pyarrow.parquet.read_table('bdmv.parquet')
+    df = table.to_pandas()
+
+Writing requires `pyarrow`:
+
+    pip install pyarrow
+'''
+
+import base64
+import gzip
+import json
+import shutil
+import struct
+import tempfile
+import xml.etree.ElementTree as ElementTree
+import xml.parsers.expat
+
+import numpy as np
+
+# Number of rows converted at once
+BATCH_SIZE = 100000
+
+#
+# VOTable datatype -> numpy dtype
+#
+NUMPY_DTYPES = {
+    'boolean': np.bool_,
+    'bit': np.bool_,
+    'unsignedByte': np.uint8,
+    'short': np.int16,
+    'int': np.int32,
+    'long': np.int64,
+    'float': np.float32,
+    'double': np.float64,
+    'char': np.str_,
+    'unicodeChar': np.str_,
+}
+
+#
+# VOTable datatype -> big-endian numpy dtype of its BINARY serialization
+#
+BINARY_DTYPES = {
+    'boolean': '>u1',
+    'unsignedByte': '>u1',
+    'short': '>i2',
+    'int': '>i4',
+    'long': '>i8',
+    'float': '>f4',
+    'double': '>f8',
+    'char': '>u1',
+    'unicodeChar': '>u2',
+}
+
+# Bytes of a BINARY or BINARY2 VOTable read and decoded at once
+STREAM_CHUNK_SIZE = 1 << 20
+
+FORMATS = ('parquet', 'arrow')
+
+
+class VOTableField(object):
+    '''Description of a column (FIELD) of a VOTable'''
+
+    def __init__(self, name, datatype, arraysize=None, unit=None, ucd=None, description=None, null=None):
+        self.name = name
+        self.datatype = datatype
+        self.arraysize = arraysize
+        self.unit = unit
+        self.ucd = ucd
+        self.description = description
+        # the value standing for null in the integer columns (VALUES null)
+        self.null = null
+
+    @property
+    def dtype(self):
+        '''The numpy dtype of the column'''
+        if self.datatype not in NUMPY_DTYPES:
+            raise ValueError('Unsupported VOTable datatype %s for column %s' % (self.datatype, self.name))
+        if self.arraysize and self.datatype not in ('char', 'unicodeChar'):
+            raise ValueError('Array column %s (arraysize=%s) is not supported' % (self.name, self.arraysize))
+        return NUMPY_DTYPES[self.datatype]
+
+    def metadata(self):
+        '''The VOTable attributes worth keeping in other formats'''
+        return {key: value for key, value in (('unit', self.unit), ('ucd', self.ucd),
+                                              ('datatype', self.datatype), ('description', self.description))
+                if value}
+
+
+def _local(tag):
+    '''Strip the namespace of an xml tag'''
+    return tag.rsplit('}', 1)[-1]
+
+
+def _open(source):
+    '''Open a file name (gzipped or not), or pass a file object through'''
+    if hasattr(source, 'read'):
+        return source, False
+    if str(source).endswith('.gz'):
+        return gzip.open(source, 'rb'), True
+    return open(source, 'rb'), True
+
+
+class _Spool(object):
+    '''A stream whose bytes are copied to a temporary file as they are read
+
+    The copy stops with `stop()`, once the serialization is known to be
+    TABLEDATA. Otherwise `rest()` adds the unread bytes to the copy and
+    returns it, to be parsed by astropy.
+    '''
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.copy = tempfile.TemporaryFile(prefix='cosmosim_votable_')
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        if self.copy is not None:
+            self.copy.write(data)
+        return data
+
+    def stop(self):
+        if self.copy is not None:
+            self.copy.close()
+            self.copy = None
+
+    def rest(self):
+        shutil.copyfileobj(self.fd, self.copy)
+        self.copy.seek(0)
+        return self.copy
+
+
+def to_array(values, field):
+    '''Convert the text of the cells of a column into a (values, mask) pair
+
+    Empty cells are null: `mask` is a boolean array flagging them, or None
+    if the column has no null.
+    '''
+
+    values = np.array(values, dtype=np.str_) if len(values) else np.array([], dtype=np.str_)
+    dtype = field.dtype
+
+    if dtype is np.str_:
+        return values, None
+
+    mask = values == ''
+    if field.datatype in ('boolean', 'bit'):
+        mask |= values == '?'
+        converted = np.isin(np.char.lower(values), ('t', 'true', '1'))
+    else:
+        converted = np.where(mask, '0', values).astype(dtype)
+
+    return converted, (mask if mask.any() else None)
+
+
+def iter_votable_batches(source, batch_size=BATCH_SIZE):
+    '''Read the rows of a TABLEDATA, BINARY or BINARY2 VOTable in batches
+
+    The TABLEDATA rows are parsed as they come, the base64 stream of the
+    BINARY and BINARY2 serializations is decoded block by block (a stream
+    is first written to a temporary file). FITS VOTables can not be read
+    incrementally: they are parsed by astropy and sliced into batches.
+
+    Parameters:
+    -----------
+    source: str or file object
+        The VOTable file (`.gz` files are decompressed) or a binary stream,
+        e.g. the raw body of a streamed HTTP response
+
+    batch_size: int, default: BATCH_SIZE
+        The number of rows per batch
+
+    Yields:
+    -------
+    (list(VOTableField), list((numpy.ndarray, numpy.ndarray or None)))
+        The fields of the table, and the (values, mask) of each column
+    '''
+
+    fd, close = _open(source)
+    if not close:
+        source = fd = _Spool(fd)
+
+    fields = []
+    rows = []
+    row = []
+    data = None
+    serialization = None
+    yielded = False
+
+    try:
+        for event, element in ElementTree.iterparse(fd, events=('start', 'end')):
+            tag = _local(element.tag)
+
+            if event == 'start':
+                if tag == 'TABLEDATA':
+                    data = element
+                    if not close:
+                        fd.stop()
+                elif tag in ('BINARY', 'BINARY2', 'FITS'):
+                    serialization = tag
+                    break
+                elif tag == 'TABLE' and fields:
+                    # only the first table of the file is read
+                    break
+                continue
+
+            if tag == 'TD':
+                row.append(element.text or '')
+            elif tag == 'TR':
+                rows.append(row)
+                row = []
+                # drop the parsed rows to keep the memory bounded
+                data.clear()
+                if len(rows) == batch_size:
+                    yield fields, _columns(fields, rows)
+                    yielded = True
+                    rows = []
+            elif tag == 'FIELD':
+                description = element.find('{*}DESCRIPTION')
+                values = element.find('{*}VALUES')
+                fields.append(VOTableField(element.get('name'), element.get('datatype'),
+                                           arraysize=element.get('arraysize'), unit=element.get('unit'),
+                                           ucd=element.get('ucd'),
+                                           description=description.text if description is not None else None,
+                                           null=values.get('null') if values is not None else None))
+            elif tag == 'TABLEDATA':
+                break
+
+        if fields and serialization in ('BINARY', 'BINARY2') and all(field.datatype in BINARY_DTYPES
+                                                                      for field in fields):
+            for batch in _iter_binary_batches(source if close else fd.rest(), fields,
+                                              serialization == 'BINARY2', batch_size):
+                yield batch
+        elif fields and data is None:
+            # not a TABLEDATA table: let astropy parse it
+            for batch in _iter_astropy_batches(source if close else fd.rest(), batch_size):
+                yield batch
+        elif rows or not yielded:
+            yield fields, _columns(fields, rows)
+
+    finally:
+        if close:
+            fd.close()
+        else:
+            fd.stop()
+
+
+class _BinaryRows(object):
+    '''Decode the rows of a BINARY or BINARY2 stream into typed columns
+
+    The rows are read with one structured numpy dtype, unless a string
+    column has a variable length (`arraysize="*"`): the rows are then read
+    cell by cell.
+    '''
+
+    def __init__(self, fields, binary2):
+        self.fields = fields
+        # unsupported columns raise a ValueError, as with TABLEDATA
+        self.dtypes = [field.dtype for field in fields]
+        # BINARY2: one bit per column flags the nulls, in front of each row
+        self.flag_size = (len(fields) + 7) // 8 if binary2 else 0
+
+        self.lengths = []
+        for field in fields:
+            arraysize = field.arraysize or '1'
+            if 'x' in arraysize:
+                raise ValueError('Array column %s (arraysize=%s) is not supported' % (field.name, field.arraysize))
+            self.lengths.append(None if arraysize.endswith('*') else int(arraysize))
+
+        self.row_dtype = None
+        if None not in self.lengths:
+            cells = [('flags', 'u1', (self.flag_size,))] if self.flag_size else []
+            for i, (field, length) in enumerate(zip(fields, self.lengths)):
+                if field.datatype == 'char':
+                    cells.append(('c%d' % i, 'S%d' % length))
+                elif field.datatype == 'unicodeChar':
+                    cells.append(('c%d' % i, '>u2', (length,)))
+                else:
+                    cells.append(('c%d' % i, BINARY_DTYPES[field.datatype]))
+            self.row_dtype = np.dtype(cells)
+
+    def decode(self, data):
+        '''Decode the complete rows at the start of `data`
+
+        Returns:
+        --------
+        (list((numpy.ndarray, numpy.ndarray)), int)
+            The (values, mask) of each column, and the number of bytes read
+        '''
+
+        if self.row_dtype is not None:
+            read = len(data) - len(data) % self.row_dtype.itemsize
+            rows = np.frombuffer(bytes(data[:read]), dtype=self.row_dtype)
+            cells = [rows['c%d' % i] for i in range(len(self.fields))]
+            flags = rows['flags'] if self.flag_size else None
+        else:
+            cells, flags, read = self._decode_cells(memoryview(data))
+
+        nulls = None
+        if flags is not None:
+            nulls = np.unpackbits(flags, axis=1, count=len(self.fields)).astype(bool)
+
+        columns = [self._column(field, dtype, values, nulls[:, i] if nulls is not None else None)
+                   for i, (field, dtype, values) in enumerate(zip(self.fields, self.dtypes, cells))]
+        return columns, read
+
+    def _decode_cells(self, data):
+        '''Read the rows cell by cell (variable-length strings)'''
+
+        cells = [[] for field in self.fields]
+        flags = []
+        read = 0
+
+        while True:
+            offset = read + self.flag_size
+            row = []
+            for field, length in zip(self.fields, self.lengths):
+                if length is None:
+                    if offset + 4 > len(data):
+                        break
+                    length = struct.unpack_from('>i', data, offset)[0]
+                    offset += 4
+                size = np.dtype(BINARY_DTYPES[field.datatype]).itemsize
+                if field.datatype in ('char', 'unicodeChar'):
+                    size *= length
+                if offset + size > len(data):
+                    break
+                row.append(bytes(data[offset:offset + size]))
+                offset += size
+
+            if len(row) < len(self.fields) or offset > len(data):
+                # the rest of the row is in the next block
+                break
+
+            for column, cell in zip(cells, row):
+                column.append(cell)
+            flags.append(bytes(data[read:read + self.flag_size]))
+            read = offset
+
+        columns = []
+        for field, column in zip(self.fields, cells):
+            if field.datatype == 'char':
+                columns.append(np.array(column, dtype=np.bytes_) if column else np.array([], dtype='S1'))
+            elif field.datatype == 'unicodeChar':
+                columns.append(np.array([cell.decode('utf_16_be') for cell in column], dtype=np.str_)
+                               if column else np.array([], dtype=np.str_))
+            else:
+                columns.append(np.frombuffer(b''.join(column), dtype=BINARY_DTYPES[field.datatype]))
+
+        if self.flag_size:
+            return columns, np.frombuffer(b''.join(flags), dtype=np.uint8).reshape(-1, self.flag_size), read
+        return columns, None, read
+
+    @staticmethod
+    def _column(field, dtype, values, nulls):
+        '''The (values, mask) of a column, nulls included'''
+
+        if field.datatype == 'boolean':
+            mask = np.isin(values, list(b'? \0'))
+            values = np.isin(values, list(b'Tt1'))
+        elif field.datatype == 'char':
+            values = np.char.decode(values, 'latin-1')
+            mask = np.zeros(len(values), dtype=bool)
+        elif field.datatype == 'unicodeChar':
+            if values.dtype.kind != 'U':
+                # UCS-2 code units -> numpy unicode strings (trailing nulls are dropped)
+                codes = np.ascontiguousarray(values, dtype=np.uint32)
+                values = codes.view('U%d' % codes.shape[1]).reshape(len(values))
+            mask = np.zeros(len(values), dtype=bool)
+        else:
+            values = values.astype(dtype)
+            if field.datatype in ('float', 'double'):
+                mask = np.isnan(values)
+            elif field.null is not None:
+                mask = values == int(field.null)
+            else:
+                mask = np.zeros(len(values), dtype=bool)
+
+        if nulls is not None:
+            mask |= nulls
+        return values, mask
+
+
+def _iter_binary_batches(source, fields, binary2, batch_size):
+    '''Decode the base64 STREAM of a BINARY or BINARY2 VOTable block by block
+
+    Streams not embedded as base64 (e.g. `href` links) are left to astropy.
+    '''
+
+    fd, close = _open(source)
+    rows = _BinaryRows(fields, binary2)
+
+    state = {'stream': None}
+    text = []
+
+    def start(name, attributes):
+        if _local(name) == 'STREAM' and state['stream'] is None:
+            embedded = attributes.get('encoding') == 'base64' and not attributes.get('href')
+            state['stream'] = 'open' if embedded else 'unsupported'
+
+    def end(name):
+        if _local(name) == 'STREAM' and state['stream'] == 'open':
+            state['stream'] = 'closed'
+
+    def characters(content):
+        if state['stream'] == 'open':
+            text.append(content)
+
+    parser = xml.parsers.expat.ParserCreate(namespace_separator='}')
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = characters
+
+    encoded = ''
+    data = bytearray()
+    # the decoded columns not yielded yet (after empty ones, for their types), and their number of rows
+    parts = [rows.decode(b'')[0]]
+    pending = 0
+    yielded = False
+
+    try:
+        finished = False
+        while not finished:
+            block = fd.read(STREAM_CHUNK_SIZE)
+            parser.Parse(block, not block)
+            finished = not block or state['stream'] in ('closed', 'unsupported')
+            if state['stream'] == 'unsupported':
+                break
+
+            # decode the complete groups of 4 base64 characters
+            encoded += ''.join(''.join(text).split())
+            del text[:]
+            complete = len(encoded) - len(encoded) % 4
+            data += base64.b64decode(encoded[:complete])
+            encoded = encoded[complete:]
+
+            columns, read = rows.decode(data)
+            del data[:read]
+            if read:
+                parts.append(columns)
+                pending += len(columns[0][0])
+
+            while pending >= batch_size or (finished and (pending or not yielded)):
+                merged = [(np.concatenate([part[i][0] for part in parts]), np.concatenate([part[i][1] for part in parts]))
+                          for i in range(len(fields))]
+                batch = [(values[:batch_size], mask[:batch_size] if mask[:batch_size].any() else None)
+                         for values, mask in merged]
+                yield fields, batch
+                yielded = True
+                parts = [[(values[batch_size:], mask[batch_size:]) for values, mask in merged]]
+                pending = max(pending - batch_size, 0)
+
+        if state['stream'] == 'unsupported':
+            fd.seek(0)
+            for batch in _iter_astropy_batches(fd, batch_size):
+                yield batch
+        elif data or encoded:
+            raise ValueError('The BINARY stream ends in the middle of a row')
+
+    finally:
+        if close:
+            fd.close()
+
+
+def _iter_astropy_batches(source, batch_size):
+    '''Parse a (binary) VOTable with astropy and slice it into batches'''
+
+    from astropy.io import votable
+
+    table = votable.parse_single_table(source)
+    fields = [VOTableField(field.name, field.datatype, arraysize=field.arraysize,
+                           unit=str(field.unit) if field.unit is not None else None, ucd=field.ucd,
+                           description=field.description)
+              for field in table.fields]
+
+    array = table.array
+    for start in range(0, max(len(array), 1), batch_size):
+        columns = []
+        for field in fields:
+            column = array[field.name][start:start + batch_size]
+            mask = np.ma.getmaskarray(column)
+            columns.append((np.ma.getdata(column), mask if mask.any() else None))
+        yield fields, columns
+
+
+def _columns(fields, rows):
+    '''Transpose rows of text cells into typed columns'''
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    return [to_array(list(values), field) for values, field in zip(columns, fields)]
+
+
+def arrow_schema(fields):
+    '''The Arrow schema of the VOTable fields, with units and UCDs as metadata'''
+
+    import pyarrow
+
+    arrow_types = {
+        np.bool_: pyarrow.bool_(),
+        np.uint8: pyarrow.uint8(),
+        np.int16: pyarrow.int16(),
+        np.int32: pyarrow.int32(),
+        np.int64: pyarrow.int64(),
+        np.float32: pyarrow.float32(),
+        np.float64: pyarrow.float64(),
+        np.str_: pyarrow.string(),
+    }
+
+    schema_fields = [pyarrow.field(field.name, arrow_types[field.dtype], metadata=field.metadata())
+                     for field in fields]
+    metadata = {'votable.fields': json.dumps([dict(field.metadata(), name=field.name) for field in fields])}
+
+    return pyarrow.schema(schema_fields, metadata=metadata)
+
+
+def votable_to_arrow(source, filename, format='parquet', batch_size=BATCH_SIZE, compression=None):
+    '''Convert a VOTable into a Parquet or Arrow IPC file, batch by batch
+
+    Parameters:
+    -----------
+    source: str or file object
+        The VOTable file or binary stream (see `iter_votable_batches`)
+
+    filename: str
+        The output file
+
+    format: str, default: parquet
+        Either `parquet` or `arrow` (Arrow IPC file format)
+
+    batch_size: int, default: BATCH_SIZE
+        The number of rows converted at once, it bounds the memory used
+
+    compression: str, default: None
+        The compression codec of the output file (default: snappy for
+        Parquet, uncompressed for Arrow)
+
+    Returns:
+    --------
+    int
+        The number of rows written
+    '''
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('pyarrow is required to write Parquet or Arrow files: pip install pyarrow')
+
+    if format not in FORMATS:
+        raise ValueError('format must be one of %s, not %s' % (', '.join(FORMATS), format))
+
+    writer = None
+    nrows = 0
+
+    try:
+        for fields, columns in iter_votable_batches(source, batch_size=batch_size):
+
+            if writer is None:
+                schema = arrow_schema(fields)
+                if format == 'parquet':
+                    writer = pyarrow.parquet.ParquetWriter(filename, schema, compression=compression or 'snappy')
+                else:
+                    options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+                    writer = pyarrow.ipc.new_file(filename, schema, options=options)
+
+            arrays = [pyarrow.array(values, type=schema.field(i).type, mask=mask)
+                      for i, (values, mask) in enumerate(columns)]
+            batch = pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+            writer.write_batch(batch)
+            nrows += batch.num_rows
+
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return nrows
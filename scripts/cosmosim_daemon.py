@@ -0,0 +1,535 @@
+'''Long-running daemon polling, downloading and converting the results of jobs
+
+`fetch_results_of_complete_jobs()` of the tutorial is run again by hand until
+every job is done, and one process polls, downloads and parses in series:
+the parsing of a large VOTable (CPU bound) holds up the downloads, and
+nothing happens between two runs. This daemon runs the three steps in
+separate pools of processes, linked by a local work queue:
+
+- pollers check the phases of the due jobs with one job list request per
+  batch, with the backoff of their queue (`cosmosim_poller.QUEUE_BACKOFF`),
+- downloaders stream the results of the COMPLETED jobs to disk, resuming
+  interrupted transfers (`cosmosim_fetch.download_result()`),
+- converters turn the VOTables into Parquet or Arrow files
+  (`cosmosim_convert.votable_to_arrow()`), one process per core.
+
+The work queue is a SQLite table (`WorkQueue`): each task is a job url and
+its stage (poll, download, convert, done or failed). An idle process takes
+the next due task of its stage with a lease; the tasks of a process which
+died are taken over by the others once their lease expires, and the dead
+process is replaced.
+
+On SIGTERM or SIGINT (Ctrl-C) the processes finish their current task and
+stop; the daemon started again resumes from the queue, and the partial
+downloads from their `.part` files. Only one daemon runs on a work queue at
+a time (`<database>.lock`): a second one stops with an error.
+
+Usage:
+------
+
+    python cosmosim_daemon.py --token 'Token <your-token>' --urls jobs_url.txt --directory results --format parquet
+
+    # jobs can be added while the daemon runs, from another process
+    from cosmosim_daemon import WorkQueue
+    WorkQueue('daemon.sqlite').add(job_urls, queue='1h')
+'''
+
+import argparse
+import collections
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import uuid
+
+from cosmosim_ledger import SQLiteDatabase
+from cosmosim_poller import QUEUE_BACKOFF, job_id
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    url TEXT PRIMARY KEY,
+    runid TEXT,
+    queue TEXT,
+    stage TEXT NOT NULL,
+    owner TEXT,
+    lease REAL,
+    due REAL NOT NULL,
+    delay REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    phase TEXT,
+    result_path TEXT,
+    output_path TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_stage_due ON tasks (stage, due);
+'''
+
+COLUMNS = ['url', 'runid', 'queue', 'stage', 'owner', 'lease', 'due', 'delay', 'attempts', 'phase', 'result_path',
+           'output_path', 'error', 'updated']
+
+# The stages worked on, in order
+STAGES = ('poll', 'download', 'convert')
+
+# Seconds a task is reserved for the process which took it
+LEASES = {
+    'poll': 120.0,
+    'download': 3 * 3600.0,
+    'convert': 3 * 3600.0,
+}
+
+# Jobs polled with one job list request
+POLL_BATCH = 500
+
+# Attempts of a download or a conversion before the task fails
+MAX_ATTEMPTS = 5
+
+# Seconds an idle process waits before looking for work again
+IDLE_SLEEP = 1.0
+
+# Seconds the processes have to finish their task on shutdown
+SHUTDOWN_TIMEOUT = 60.0
+
+# One task of the queue
+Task = collections.namedtuple('Task', COLUMNS)
+
+
+class WorkQueue(SQLiteDatabase):
+    '''The tasks of the daemon, in a SQLite database shared by its processes
+
+    Parameters:
+    -----------
+    path: str, default: daemon.sqlite
+        The database file
+    '''
+
+    def __init__(self, path='daemon.sqlite'):
+        SQLiteDatabase.__init__(self, path, SCHEMA)
+
+    def add(self, urls, queue='1m', runid=None):
+        '''Add jobs to poll (the jobs already queued are left as they are)
+
+        Returns:
+        --------
+        int
+            The number of jobs added
+        '''
+
+        now = time.time()
+        rows = [(url.strip(), runid, queue, 'poll', now, now) for url in urls if url.strip()]
+        before = self.connection.total_changes
+        self._write('INSERT OR IGNORE INTO tasks (url, runid, queue, stage, due, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                    rows)
+        return self.connection.total_changes - before
+
+    def claim(self, stage, owner, limit=1):
+        '''Take the next due tasks of a stage, free or with an expired lease
+
+        Returns:
+        --------
+        list(Task)
+        '''
+
+        now = time.time()
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute('SELECT %s FROM tasks WHERE stage = ? AND due <= ? '
+                                      'AND (owner IS NULL OR lease < ?) ORDER BY due LIMIT ?' % (', '.join(COLUMNS),),
+                                      (stage, now, now, limit)).fetchall()
+            connection.executemany('UPDATE tasks SET owner = ?, lease = ? WHERE url = ?',
+                                   [(owner, now + LEASES[stage], row[0]) for row in rows])
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+        return [Task(*row) for row in rows]
+
+    def advance(self, url, stage, **values):
+        '''Move a task to another stage, and free it'''
+
+        values.update(stage=stage, owner=None, lease=None, due=time.time(), attempts=0, updated=time.time())
+        names = sorted(values)
+        self._write('UPDATE tasks SET %s WHERE url = ?' % (', '.join('%s = ?' % (name,) for name in names),),
+                    [tuple(values[name] for name in names) + (url,)])
+
+    def reschedule(self, delays):
+        '''Free tasks and make them due again after a delay
+
+        Parameters:
+        -----------
+        delays: dict
+            The delay in seconds of each url
+        '''
+
+        now = time.time()
+        self._write('UPDATE tasks SET owner = NULL, lease = NULL, due = ?, delay = ?, updated = ? WHERE url = ?',
+                    [(now + delay, delay, now, url) for url, delay in delays.items()])
+
+    def retry(self, task, error, max_attempts=MAX_ATTEMPTS):
+        '''Record a failed attempt: the task is due again later, or failed after `max_attempts`'''
+
+        attempts = task.attempts + 1
+        if attempts >= max_attempts:
+            self.advance(task.url, 'failed', error=error)
+            return
+
+        now = time.time()
+        self._write('UPDATE tasks SET owner = NULL, lease = NULL, due = ?, attempts = ?, error = ?, updated = ? '
+                    'WHERE url = ?', [(now + min(2 ** attempts * 5.0, 600.0), attempts, error, now, task.url)])
+
+    def release(self, owner=None):
+        '''Free the tasks of an owner (of every owner if None)'''
+
+        if owner is None:
+            self._write('UPDATE tasks SET owner = NULL, lease = NULL WHERE owner IS NOT NULL', [()])
+        else:
+            self._write('UPDATE tasks SET owner = NULL, lease = NULL WHERE owner = ?', [(owner,)])
+
+    def tasks(self, stage=None):
+        '''The tasks, of one stage or all'''
+
+        sql = 'SELECT %s FROM tasks' % (', '.join(COLUMNS),)
+        parameters = ()
+        if stage is not None:
+            sql += ' WHERE stage = ?'
+            parameters = (stage,)
+        return [Task(*row) for row in self.connection.execute(sql + ' ORDER BY due', parameters)]
+
+    def counts(self):
+        '''The number of tasks of each stage'''
+        return dict(self.connection.execute('SELECT stage, COUNT(*) FROM tasks GROUP BY stage').fetchall())
+
+    def pending(self):
+        '''The number of tasks not done nor failed'''
+        counts = self.counts()
+        return sum(counts.get(stage, 0) for stage in STAGES)
+
+
+#
+# The work of each stage, run in the worker processes
+#
+
+class _Poller(object):
+
+    def __init__(self, config):
+        from cosmosim_client import connect
+
+        self.tap_service = connect(config['url'], config['token'], cache=False)
+        self.ledger = _ledger(config)
+
+    def __call__(self, queue, tasks):
+        from cosmosim_poller import fetch_phases, listed_after
+
+        after = None
+        if self.ledger is not None:
+            # the job list only goes back to the oldest of these jobs
+            entries = [self.ledger.job(task.url) for task in tasks]
+            after = listed_after([entry.submitted if entry is not None else None for entry in entries])
+
+        try:
+            statuses = fetch_phases(self.tap_service, [task.url for task in tasks], after=after)
+        except Exception as e:
+            print('Polling %d jobs failed: %s' % (len(tasks), e))
+            queue.reschedule({task.url: max(task.delay or 0.0, 30.0) for task in tasks})
+            return
+
+        delays = {}
+        for task in tasks:
+            phase, error = statuses[task.url].phase, statuses[task.url].error
+            if phase == 'COMPLETED':
+                queue.advance(task.url, 'download', phase=phase, runid=task.runid or statuses[task.url].runid)
+            elif phase in ('ERROR', 'ABORTED', 'ARCHIVED'):
+                # ARCHIVED with an error: the job does not exist (anymore)
+                queue.advance(task.url, 'failed', phase=phase, error=str(error or 'job %s' % (phase,)))
+                print('JOB %s: %s' % (task.runid or job_id(task.url), error or phase))
+            elif error is not None:
+                # only this job could not be read: failed after MAX_ATTEMPTS
+                print('JOB %s: polling failed (%s)' % (task.runid or job_id(task.url), error))
+                queue.retry(task, 'poll: %s' % (error,))
+            else:
+                first, growth, maximum = QUEUE_BACKOFF.get(task.queue, QUEUE_BACKOFF['1m'])
+                delays[task.url] = first if task.delay is None else min(task.delay * growth, maximum)
+        queue.reschedule(delays)
+
+        if self.ledger is not None:
+            self.ledger.update_phases({url: status.phase for url, status in statuses.items() if status.error is None})
+
+
+class _Downloader(object):
+
+    def __init__(self, config):
+        from cosmosim_session import tap_session
+
+        self.session = tap_session(config['token'])
+        self.directory = config['directory']
+        self.format = config['format']
+        self.ledger = _ledger(config)
+
+    def __call__(self, queue, tasks):
+        from cosmosim_fetch import download_result
+
+        for task in tasks:
+            filename = os.path.join(self.directory, result_name(task) + '.xml')
+            start = time.time()
+            try:
+                size, sha256, resumed = download_result(self.session, task.url, filename)
+            except Exception as e:
+                print('JOB %s: download failed (%s)' % (task.runid or job_id(task.url), e))
+                queue.retry(task, 'download: %s' % (e,))
+                continue
+
+            if self.ledger is not None:
+                self.ledger.record_result(task.url, filename, size, sha256, time.time() - start)
+            queue.advance(task.url, 'convert' if self.format else 'done', result_path=filename, error=None)
+            print('JOB %s: %d bytes downloaded' % (task.runid or job_id(task.url), size))
+
+
+class _Converter(object):
+
+    def __init__(self, config):
+        self.format = config['format']
+        self.keep_votable = config['keep_votable']
+
+    def __call__(self, queue, tasks):
+        from cosmosim_convert import votable_to_arrow
+
+        for task in tasks:
+            output = os.path.splitext(task.result_path)[0] + '.' + self.format
+            try:
+                rows = votable_to_arrow(task.result_path, output + '.part', format=self.format)
+                os.replace(output + '.part', output)
+            except Exception as e:
+                print('JOB %s: conversion failed (%s)' % (task.runid or job_id(task.url), e))
+                queue.retry(task, 'convert: %s' % (e,))
+                continue
+
+            if not self.keep_votable:
+                os.remove(task.result_path)
+            queue.advance(task.url, 'done', output_path=output, error=None)
+            print('JOB %s: %d rows converted to %s' % (task.runid or job_id(task.url), rows, output))
+
+
+def result_name(task):
+    '''The name of the result files of a task: the runid is not unique, the jobid is'''
+    return '%s_%s' % (task.runid, job_id(task.url)) if task.runid else job_id(task.url)
+
+
+WORKERS = {
+    'poll': (_Poller, POLL_BATCH),
+    'download': (_Downloader, 1),
+    'convert': (_Converter, 1),
+}
+
+
+def _ledger(config):
+    if not config.get('ledger'):
+        return None
+
+    from cosmosim_ledger import JobLedger
+    return JobLedger(config['ledger'])
+
+
+def _signal_flag():
+    '''A list which becomes true on SIGINT or SIGTERM
+
+    The handlers only append to it: setting a multiprocessing.Event from a
+    handler interrupting a wait on the same Event would deadlock.
+    '''
+
+    flag = []
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: flag.append(signum))
+    return flag
+
+
+def _lock_queue(database):
+    '''Take the lock of a work queue for the life of the daemon
+
+    The lock file (`<database>.lock`) is locked by the operating system: a
+    daemon which died does not hold it anymore.
+
+    Returns:
+    --------
+    file
+        The locked file, closing it releases the lock
+    '''
+
+    fd = open(database + '.lock', 'a+')
+    fd.seek(0)
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(fd.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        raise RuntimeError('Another daemon is running on %s' % (database,))
+    return fd
+
+
+def _worker(stage, config, stop):
+    '''The loop of a worker process: take tasks of its stage until stopped'''
+
+    # finish the current task on SIGINT/SIGTERM, whoever receives it
+    stopping = _signal_flag()
+
+    owner = '%s-%d-%s' % (stage, os.getpid(), uuid.uuid4().hex[:6])
+    queue = WorkQueue(config['database'])
+    worker_class, batch = WORKERS[stage]
+    work = worker_class(config)
+
+    try:
+        while not stopping and not stop.is_set():
+            tasks = queue.claim(stage, owner, limit=batch)
+            if not tasks:
+                time.sleep(IDLE_SLEEP)
+                continue
+            work(queue, tasks)
+    finally:
+        queue.release(owner)
+
+
+def run_daemon(url, token, database='daemon.sqlite', directory='.', format=None, pollers=1, downloaders=2,
+               converters=None, keep_votable=False, ledger=None, exit_when_done=False, report_every=60.0):
+    '''Run the poller, downloader and converter processes until stopped
+
+    Parameters:
+    -----------
+    url: str
+        The url of the TAP service
+
+    token: str
+        The `Authorization` header, e.g. `Token <your-token>`
+
+    database: str, default: daemon.sqlite
+        The work queue (see `WorkQueue`)
+
+    directory: str, default: .
+        Where the results are written (`<runid>_<jobid>.xml`, `<runid>_<jobid>.<format>`)
+
+    format: str, default: None
+        Convert the results to `parquet` or `arrow` (keep the VOTables if None)
+
+    pollers, downloaders, converters: int, default: 1, 2, cores - 1
+        The number of processes of each stage
+
+    keep_votable: bool, default: False
+        Keep the VOTables once converted
+
+    ledger: str, default: None
+        Record the phases and results in this `cosmosim_ledger.JobLedger`
+
+    exit_when_done: bool, default: False
+        Stop once no task is left, instead of waiting for new ones
+
+    report_every: float, default: 60
+        Seconds between two progress reports
+
+    Raises:
+    -------
+    RuntimeError
+        If another daemon runs on `database`
+    '''
+
+    if converters is None:
+        converters = max(1, (os.cpu_count() or 2) - 1)
+    os.makedirs(directory, exist_ok=True)
+
+    queue = WorkQueue(database)
+    # one daemon per work queue: the leases of a previous run are void, its processes are gone
+    lock = _lock_queue(database)
+    queue.release()
+
+    config = dict(url=url, token=token, database=database, directory=directory, format=format,
+                  keep_votable=keep_votable, ledger=ledger)
+    counts = {'poll': pollers, 'download': downloaders, 'convert': converters if format else 0}
+
+    stop = multiprocessing.Event()
+    stopping = _signal_flag()
+
+    def start(stage):
+        process = multiprocessing.Process(target=_worker, args=(stage, config, stop), name='cosmosim-%s' % (stage,))
+        process.start()
+        return process
+
+    processes = [(stage, start(stage)) for stage in STAGES for i in range(counts[stage])]
+    print('Daemon started: %s' % (', '.join('%d %s' % (counts[stage], stage) for stage in STAGES),))
+
+    last_report = 0.0
+    try:
+        while not stopping:
+            time.sleep(1.0)
+
+            # replace the processes which died, their tasks are taken over when their lease expires
+            for i, (stage, process) in enumerate(processes):
+                if not process.is_alive() and not stopping:
+                    print('Process %s %d exited with %s, restarting it' % (stage, process.pid, process.exitcode))
+                    processes[i] = (stage, start(stage))
+
+            if time.time() - last_report >= report_every:
+                print('Tasks: %s' % (', '.join('%s %d' % item for item in sorted(queue.counts().items())),))
+                last_report = time.time()
+
+            if exit_when_done and not queue.pending():
+                break
+    finally:
+        stop.set()
+        print('Stopping: waiting for the current tasks')
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for stage, process in processes:
+            process.join(max(0.0, deadline - time.time()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        queue.release()
+        print('Tasks: %s' % (', '.join('%s %d' % item for item in sorted(queue.counts().items())),))
+        lock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Poll, download and convert the results of CosmoSim TAP jobs')
+    parser.add_argument('--url', default='https://www.cosmosim.org/tap', help='the url of the TAP service')
+    parser.add_argument('--token', default=os.environ.get('COSMOSIM_TOKEN'),
+                        help='the Authorization header, "Token <your-token>" (default: $COSMOSIM_TOKEN)')
+    parser.add_argument('--database', default='daemon.sqlite', help='the work queue')
+    parser.add_argument('--directory', default='.', help='where the results are written')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], help='convert the results to this format')
+    parser.add_argument('--keep-votable', action='store_true', help='keep the VOTables once converted')
+    parser.add_argument('--urls', help='add the jobs of this file (one url per line)')
+    parser.add_argument('--queue', default='1m', help='the queue of the added jobs (sets their polling backoff)')
+    parser.add_argument('--ledger', help='add the unfetched jobs of this ledger, and record the results in it')
+    parser.add_argument('--pollers', type=int, default=1, help='number of polling processes')
+    parser.add_argument('--downloaders', type=int, default=2, help='number of downloading processes')
+    parser.add_argument('--converters', type=int, default=None, help='number of converting processes')
+    parser.add_argument('--exit-when-done', action='store_true', help='stop once every job is done')
+    arguments = parser.parse_args()
+
+    queue = WorkQueue(arguments.database)
+    if arguments.urls:
+        from cosmosim_fetch import read_job_urls
+        print('%d jobs added' % (queue.add(read_job_urls(arguments.urls), queue=arguments.queue),))
+    if arguments.ledger:
+        from cosmosim_ledger import JobLedger
+        added = 0
+        for job in JobLedger(arguments.ledger).unfetched():
+            added += queue.add([job.url], queue=job.queue or arguments.queue, runid=job.runid)
+        print('%d jobs added from the ledger' % (added,))
+
+    run_daemon(arguments.url, arguments.token, database=arguments.database, directory=arguments.directory,
+               format=arguments.format, pollers=arguments.pollers, downloaders=arguments.downloaders,
+               converters=arguments.converters, keep_votable=arguments.keep_votable, ledger=arguments.ledger,
+               exit_when_done=arguments.exit_when_done)
+
+    failed = queue.tasks('failed')
+    for task in failed:
+        print('FAILED %s: %s' % (task.url, task.error))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+'''Incremental (delta) queries: only fetch the ranges not fetched yet
+
+When a query is widened (a larger `mvir` range, more snapnums than
+`snapnum=416`), running it again transfers and computes again all the rows
+already fetched. A `DeltaQuery` is a base query with a `{chunk}` placeholder
+for a range condition on one column, as for `cosmosim_chunking`:
+
+    SELECT bdmid, mvir, rvir FROM mdr1.bdmv
+     WHERE snapnum=416 AND {chunk}
+
+The ranges already fetched for a base query are recorded in an index next
+to an `cosmosim_store.ExtractStore`, each range being kept as one extract.
+For the ranges asked, only the uncovered parts are submitted as jobs, and
+the result is assembled from the stored extracts: the server time and the
+transfer volume grow with the new rows only.
+
+The ranges are half-open, `[low, high)`. For an integer column use
+`value_ranges()` to turn a list of values into ranges.
+
+Example:
+--------
+
+    from cosmosim_delta import DeltaQuery, value_ranges
+    from cosmosim_store import ExtractStore
+
+    delta = DeltaQuery(tap_service, query, 'mvir', ExtractStore('~/extracts'), queue='1m')
+
+    table = delta.fetch([(1e13, 1e14)])
+    table = delta.fetch([(1e12, 1e15)])      # submits [1e12, 1e13) and [1e14, 1e15) only
+
+    snapshots = DeltaQuery(tap_service, query2, 'snapnum', store)
+    table = snapshots.fetch(value_ranges([416, 415, 414]))
+'''
+
+import concurrent.futures
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from cosmosim_cache import cache_key
+from cosmosim_chunking import Chunk, chunk_queries
+from cosmosim_fetch import stream_result
+from cosmosim_merge import merge_order, parse_order_by
+from cosmosim_poller import JobPoller
+from cosmosim_submission import submit_queries
+
+INDEX_FILENAME = 'delta.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS ranges (
+    base TEXT NOT NULL,
+    low NUMERIC NOT NULL,
+    high NUMERIC NOT NULL,
+    extract TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ranges_base ON ranges (base, low);
+'''
+
+
+#
+# Interval arithmetic on half-open ranges [low, high)
+#
+
+def merge_ranges(ranges):
+    '''The union of ranges, as sorted disjoint ranges'''
+
+    merged = []
+    for low, high in sorted((low, high) for low, high in ranges if high > low):
+        if merged and low <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def subtract_ranges(ranges, covered):
+    '''The parts of `ranges` not in `covered`, as sorted disjoint ranges'''
+
+    missing = []
+    covered = merge_ranges(covered)
+
+    for low, high in merge_ranges(ranges):
+        for covered_low, covered_high in covered:
+            if covered_high <= low:
+                continue
+            if covered_low >= high:
+                break
+            if covered_low > low:
+                missing.append((low, covered_low))
+            low = max(low, covered_high)
+            if low >= high:
+                break
+        if low < high:
+            missing.append((low, high))
+
+    return missing
+
+
+def value_ranges(values):
+    '''The ranges holding a set of integer values, e.g. [414, 415, 416, 420] -> [(414, 417), (420, 421)]'''
+    return merge_ranges((int(value), int(value) + 1) for value in values)
+
+
+class DeltaIndex(object):
+    '''The ranges fetched for each base query, in a SQLite file
+
+    Parameters:
+    -----------
+    filename: str
+        The SQLite file
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def ranges(self, base):
+        '''The (low, high, extract) fetched for a base query, by increasing low'''
+        return self._connect().execute('SELECT low, high, extract FROM ranges WHERE base = ? ORDER BY low',
+                                       (base,)).fetchall()
+
+    def add(self, base, low, high, extract):
+        '''Record a fetched range'''
+        with self._connect() as connection:
+            connection.execute('INSERT INTO ranges (base, low, high, extract, created) VALUES (?, ?, ?, ?, ?)',
+                               (base, low, high, extract, time.time()))
+
+    def remove(self, base):
+        '''Forget the ranges of a base query
+
+        Returns:
+        --------
+        list(str)
+            The extracts of the ranges
+        '''
+
+        with self._connect() as connection:
+            extracts = [row[0] for row in connection.execute('SELECT extract FROM ranges WHERE base = ?', (base,))]
+            connection.execute('DELETE FROM ranges WHERE base = ?', (base,))
+        return extracts
+
+
+class DeltaQuery(object):
+    '''A base query fetched range by range, each range only once
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    query: str
+        The base query, with a `{chunk}` placeholder for the range condition
+
+    column: str
+        The column of the range condition (as written in the query)
+
+    store: cosmosim_store.ExtractStore
+        The store of the fetched ranges
+
+    language: str, default: PostgreSQL
+        The query language
+
+    queue: str, default: 1m
+        The queue of the jobs
+
+    result_column: str, default: None
+        The name of the column in the result (default: `column` without
+        its table prefix)
+    '''
+
+    def __init__(self, tap_service, query, column, store, language='PostgreSQL', queue='1m', result_column=None):
+        if '{chunk}' not in query:
+            raise ValueError('The query has no {chunk} placeholder')
+
+        self.tap_service = tap_service
+        self.query = query
+        self.column = column
+        self.store = store
+        self.language = language
+        self.queue = queue
+        self.result_column = result_column or column.rsplit('.', 1)[-1].strip('"')
+
+        self.key = cache_key(tap_service.baseurl, query, language, column=column)
+        self.index = DeltaIndex(os.path.join(store.directory, INDEX_FILENAME))
+
+    def covered(self):
+        '''The ranges already fetched, as sorted disjoint ranges'''
+        return merge_ranges((low, high) for low, high, extract in self.index.ranges(self.key))
+
+    def missing(self, ranges):
+        '''The parts of `ranges` not fetched yet'''
+        return subtract_ranges(ranges, self.covered())
+
+    def update(self, ranges, dry_run=False):
+        '''Submit and fetch the parts of `ranges` not fetched yet
+
+        The ranges fetched are recorded as soon as they are stored, so that
+        after a failure only the failed ranges are submitted again.
+
+        Returns:
+        --------
+        list((low, high))
+            The ranges submitted
+        '''
+
+        missing = self.missing(ranges)
+        if not missing or dry_run:
+            return missing
+
+        chunks = {}
+        for low, high in missing:
+            name = '%s_%s' % (self.key[:16], uuid.uuid4().hex[:8])
+            chunks[name] = Chunk(name, low, high, False)
+        print('Submitting %d ranges of %s' % (len(chunks), self.column))
+
+        session = self.tap_service._session
+        poller = JobPoller(session, tap_service=self.tap_service).start()
+        pending = {}
+        failed = []
+
+        try:
+            queries = [(name, query, self.queue, self.language)
+                       for name, query in chunk_queries(self.query, self.column, list(chunks.values()))]
+            for result in submit_queries(self.tap_service, queries):
+                if result.error:
+                    failed.append((chunks[result.name], result.error))
+                else:
+                    pending[poller.track(result.url, queue=self.queue)] = chunks[result.name]
+
+            for future in concurrent.futures.as_completed(pending):
+                chunk = pending[future]
+                try:
+                    job_url, phase = future.result()
+                except Exception as e:
+                    # the job could not be polled (e.g. it does not exist anymore)
+                    failed.append((chunk, e))
+                    continue
+                if phase != 'COMPLETED':
+                    failed.append((chunk, phase))
+                    continue
+
+                filename = os.path.join(self.store.directory, '.%s.xml' % (chunk.name,))
+                try:
+                    stream_result(session, job_url, filename)
+                    self.store.put_votables(chunk.name, filename, order_by=self.query, query=self.query,
+                                            language=self.language, column=self.column, low=chunk.low,
+                                            high=chunk.high, url=job_url)
+                except Exception as e:
+                    # the other ranges are still stored, this one is submitted again next time
+                    failed.append((chunk, e))
+                    continue
+                finally:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+
+                self.index.add(self.key, chunk.low, chunk.high, chunk.name)
+                print('JOB %s: [%r, %r) stored' % (chunk.name, chunk.low, chunk.high))
+        finally:
+            poller.stop()
+
+        if failed:
+            raise RuntimeError('The following ranges failed: %s'
+                               % (', '.join('[%r, %r) (%s)' % (chunk.low, chunk.high, reason)
+                                            for chunk, reason in failed),))
+
+        return missing
+
+    def table(self, ranges):
+        '''The rows of `ranges` from the stored extracts
+
+        The rows are selected from the memory maps of the extracts, and put
+        back in the order of the ORDER BY of the query.
+
+        Returns:
+        --------
+        astropy.table.Table
+        '''
+
+        from astropy.table import Column, MaskedColumn, Table
+
+        ranges = merge_ranges(ranges)
+        pieces = [(low, high, extract) for low, high, extract in self.index.ranges(self.key)
+                  if any(low < range_high and high > range_low for range_low, range_high in ranges)]
+        if not pieces:
+            raise KeyError('No range of %s fetched in %s' % (self.column, ranges))
+
+        extracts = [self.store.open(extract) for low, high, extract in pieces]
+        names = extracts[0].columns
+
+        #
+        # Select the rows of the ranges in each extract
+        #
+        selections = []
+        for extract in extracts:
+            values = np.ma.getdata(extract[self.result_column])
+            selected = np.zeros(len(values), dtype=bool)
+            for low, high in ranges:
+                selected |= (values >= low) & (values < high)
+            selections.append(selected)
+
+        counts = [int(selected.sum()) for selected in selections]
+        columns = {}
+        masks = {}
+        for name in names:
+            parts = [extract[name][selected] for extract, selected in zip(extracts, selections)]
+            columns[name] = np.concatenate([np.ma.getdata(part) for part in parts])
+            masks[name] = (np.concatenate([np.ma.getmaskarray(part) for part in parts])
+                           if any(isinstance(part, np.ma.MaskedArray) for part in parts) else None)
+
+        order = parse_order_by(self.query)
+        if order:
+            order = [(names[item - 1] if isinstance(item, int) else item, descending, nulls_first)
+                     for item, descending, nulls_first in order]
+            if all(name in columns for name, descending, nulls_first in order):
+                permutation = merge_order(columns, masks, order, counts)
+                if permutation is not None:
+                    columns = {name: values[permutation] for name, values in columns.items()}
+                    masks = {name: mask[permutation] if mask is not None else None for name, mask in masks.items()}
+
+        meta = {column['name']: column for column in extracts[0].meta['columns']}
+        table = Table([MaskedColumn(columns[name], name=name, mask=masks[name], unit=meta[name].get('unit'))
+                       if masks[name] is not None else
+                       Column(columns[name], name=name, unit=meta[name].get('unit'))
+                       for name in names], copy=False)
+        table.meta.update(query=self.query, ranges=ranges)
+        return table
+
+    def fetch(self, ranges):
+        '''Fetch the missing parts of `ranges`, then return all their rows
+
+        Returns:
+        --------
+        astropy.table.Table
+        '''
+
+        self.update(ranges)
+        return self.table(ranges)
+
+    def clear(self):
+        '''Forget and remove all the fetched ranges of the base query'''
+        for extract in self.index.remove(self.key):
+            self.store.remove(extract)
@@ -0,0 +1,581 @@
+'''Fetch the results of the jobs listed in a `jobs_url.txt` file
+
+This is the `fetch_results_of_complete_jobs()` function of the tutorial,
+with a bulk status refresh: instead of recreating one `AsyncTAPJob` (one or
+more HTTP requests) per url on every pass, the phases of all tracked jobs
+are read from a single `tap_service.get_job_list()` request and matched by
+jobid. Only the jobs which reached a terminal phase are opened individually.
+
+With `stream=True` the results are not parsed into a `TAPResults` object:
+the raw VOTable is streamed in chunks straight to disk (optionally gzipped on
+the fly), so the memory used does not depend on the size of the result.
+Parsing is a separate, optional step done with `parse_result()`.
+
+With `format='parquet'` (or `'arrow'`) the streamed VOTable is converted
+batch by batch into a columnar file (see `cosmosim_convert`), which is much
+faster to load again than the XML.
+
+Example:
+--------
+
+    from cosmosim_fetch import fetch_results_of_complete_jobs, parse_result
+
+    running = fetch_results_of_complete_jobs(tap_service, 'jobs_url.txt', stream=True, compress=True)
+
+    tap_results = parse_result('radial_prof_massive_bdmv.xml.gz')
+
+Instead of a urls file, the jobs can be tracked in a `cosmosim_ledger.JobLedger`
+shared by several processes:
+
+    running = fetch_results_of_complete_jobs(tap_service, ledger=ledger, format='parquet')
+
+With `workers=N` the completed results are downloaded by a separate stage of
+N threads (`fetch_results()`), so one large result does not hold up the
+others. Interrupted downloads are resumed with HTTP Range requests, and the
+size, sha256 and duration of every file are recorded:
+
+    running = fetch_results_of_complete_jobs(tap_service, 'jobs_url.txt', workers=4,
+                                             max_bytes_per_second=50 * 1024**2, manifest='results.tsv')
+'''
+
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+import requests
+
+# pyvo and cosmosim_convert (astropy, numpy) are imported by the functions
+# using them: most helper modules import this one for stream_result() only
+from cosmosim_poller import TERMINAL_PHASES, fetch_phases, listed_after
+from cosmosim_submission import pool_session
+
+
+def read_job_urls(urls_filename):
+    '''Read the job urls stored in a file, one per line'''
+
+    with open(urls_filename, 'r') as fd:
+        return [line.strip() for line in fd if line.strip()]
+
+
+def write_job_urls(urls_filename, job_urls):
+    '''Replace the content of the urls file, atomically'''
+
+    tmp_filename = urls_filename + '.tmp'
+    with open(tmp_filename, 'w') as fd:
+        for job_url in job_urls:
+            fd.write(job_url + '\n')
+    os.replace(tmp_filename, urls_filename)
+
+
+# Size of the pieces in which results are streamed to disk
+CHUNK_SIZE = 1024 * 1024
+
+
+def result_url(job_url):
+    '''The url of the standard TAP result of a job'''
+    return job_url.strip().rstrip('/') + '/results/result'
+
+
+def stream_result(session, job_url, filename, compress=False, chunk_size=CHUNK_SIZE):
+    '''Stream the raw result of a job to a file, chunk by chunk
+
+    The result is written to `<filename>.part` and renamed once complete,
+    so an interrupted download never leaves a truncated result behind.
+
+    Parameters:
+    -----------
+    session: requests.Session
+        The session holding the authorization token
+
+    job_url: str
+        The url of the (COMPLETED) job
+
+    filename: str
+        The file the result is written to
+
+    compress: bool, default: False
+        Gzip the result on the fly
+
+    chunk_size: int, default: CHUNK_SIZE
+        The number of bytes held in memory at once
+
+    Returns:
+    --------
+    int
+        The number of bytes of the (uncompressed) result
+    '''
+
+    size = 0
+    part_filename = filename + '.part'
+
+    with session.get(result_url(job_url), stream=True, timeout=60) as response:
+        response.raise_for_status()
+
+        with (gzip.open if compress else open)(part_filename, 'wb') as fd:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                fd.write(chunk)
+                size += len(chunk)
+
+    os.replace(part_filename, filename)
+
+    return size
+
+
+def convert_result(session, job_url, filename, format='parquet', batch_size=None):
+    '''Stream the result of a job into a Parquet or Arrow IPC file
+
+    The VOTable is converted while it is downloaded, `batch_size` rows at a
+    time (default: `cosmosim_convert.BATCH_SIZE`), without ever being
+    written to disk or held in memory as a whole.
+
+    Returns:
+    --------
+    int
+        The number of rows written
+    '''
+
+    from cosmosim_convert import BATCH_SIZE, votable_to_arrow
+
+    batch_size = batch_size or BATCH_SIZE
+    part_filename = filename + '.part'
+
+    with session.get(result_url(job_url), stream=True, timeout=60) as response:
+        response.raise_for_status()
+        # let urllib3 undo a Content-Encoding: gzip
+        response.raw.decode_content = True
+        nrows = votable_to_arrow(response.raw, part_filename, format=format, batch_size=batch_size)
+
+    os.replace(part_filename, filename)
+
+    return nrows
+
+
+def parse_result(filename):
+    '''Parse a result written by `stream_result()` (gzipped or not)
+
+    Returns:
+    --------
+    pyvo.dal.TAPResults
+        The same object `job.fetch_result()` returns
+    '''
+
+    import pyvo
+    from astropy.io import votable
+
+    return pyvo.dal.TAPResults(votable.parse(filename))
+
+
+# Outcome of the download of one result, `error` is None on success
+Download = collections.namedtuple('Download', ['url', 'filename', 'bytes', 'sha256', 'seconds', 'resumed', 'error'])
+
+# Errors after which a download is resumed
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout)
+
+
+class BandwidthLimiter(object):
+    '''Token bucket capping the total download rate of several threads
+
+    Parameters:
+    -----------
+    bytes_per_second: float
+        The maximum rate of all downloads together
+    '''
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.capacity = max(self.rate, CHUNK_SIZE)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        '''Wait until `nbytes` may be transferred'''
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # the bucket may go in debt, the callers wait for it to refill
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _hash_file(digest, filename):
+    '''Feed the content of a file to a hashlib digest'''
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+
+def download_result(session, job_url, filename, limiter=None, retries=5, chunk_size=CHUNK_SIZE, timeout=60):
+    '''Download the raw result of a job, resuming after network errors
+
+    The result is written to `<filename>.part`. When the transfer breaks
+    (or a previous run was interrupted), it is resumed from the size of the
+    part file with a `Range` request; servers answering with the whole
+    result restart it from zero.
+
+    Parameters:
+    -----------
+    session: requests.Session
+        The session holding the authorization token
+
+    job_url: str
+        The url of the (COMPLETED) job
+
+    filename: str
+        The file the result is written to
+
+    limiter: BandwidthLimiter, default: None
+        Shared cap of the download rate
+
+    retries: int, default: 5
+        How many times a broken transfer is resumed
+
+    Returns:
+    --------
+    (int, str, int)
+        The size and sha256 of the result, and the number of bytes which
+        were not downloaded again thanks to resuming
+    '''
+
+    part_filename = filename + '.part'
+    digest = None
+    resumed = 0
+    attempt = 0
+
+    while True:
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        # the offsets are the ones of the raw bytes: no content encoding
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % (offset,)
+
+        try:
+            with session.get(result_url(job_url), headers=headers, stream=True, timeout=timeout) as response:
+
+                if response.status_code == 416:
+                    # the part file is complete, or does not match the result anymore
+                    if offset and response.headers.get('Content-Range', '').rpartition('/')[2] == str(offset):
+                        resumed += offset
+                        digest = None
+                        break
+                    if offset:
+                        os.remove(part_filename)
+                        continue
+                    # nothing was resumed: a genuine error of the service
+
+                if response.status_code >= 500 and attempt < retries:
+                    raise requests.exceptions.ConnectionError('%d %s' % (response.status_code, response.reason))
+                response.raise_for_status()
+
+                digest = hashlib.sha256()
+                if offset and response.status_code == 206:
+                    _hash_file(digest, part_filename)
+                    resumed += offset
+                    mode = 'ab'
+                else:
+                    mode = 'wb'
+
+                with open(part_filename, mode) as fd:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        fd.write(chunk)
+                        digest.update(chunk)
+                        if limiter is not None:
+                            limiter.consume(len(chunk))
+            break
+
+        except TRANSIENT_ERRORS as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            print('JOB %s: %s, resuming the download' % (job_url, e))
+            time.sleep(min(2 ** attempt, 30))
+
+    if digest is None:
+        digest = hashlib.sha256()
+        _hash_file(digest, part_filename)
+
+    size = os.path.getsize(part_filename)
+    os.replace(part_filename, filename)
+
+    return size, digest.hexdigest(), resumed
+
+
+def fetch_results(session, jobs, directory='.', workers=4, max_bytes_per_second=None, retries=5, ledger=None,
+                  manifest=None):
+    '''Download the results of completed jobs with a pool of threads
+
+    Parameters:
+    -----------
+    session: requests.Session
+        The session holding the authorization token
+
+    jobs: list((str, str))
+        The (job_url, runid) of the completed jobs, the results are written
+        to `<directory>/<runid>.xml`
+
+    workers: int, default: 4
+        The number of downloads (and connections) at the same time
+
+    max_bytes_per_second: float, default: None
+        Cap of the total download rate (no cap by default)
+
+    retries: int, default: 5
+        How many times a broken download is resumed
+
+    ledger: cosmosim_ledger.JobLedger, default: None
+        If given, the results (size, sha256, duration) are recorded in it
+
+    manifest: str, default: None
+        If given, a line `filename, bytes, sha256, seconds, resumed bytes,
+        job url` (tab separated) is appended to this file for each result
+
+    Returns:
+    --------
+    list(Download)
+        One entry per job, in the order of `jobs`
+    '''
+
+    limiter = BandwidthLimiter(max_bytes_per_second) if max_bytes_per_second else None
+    pool_session(session, workers)
+
+    def fetch(job_url, runid):
+        filename = os.path.join(directory, '%s.xml' % (runid,))
+        start = time.time()
+        try:
+            size, sha256, resumed = download_result(session, job_url, filename, limiter=limiter, retries=retries)
+        except Exception as e:
+            if ledger is not None:
+                ledger.release_fetch(job_url)
+            return Download(job_url, filename, None, None, time.time() - start, 0, str(e))
+
+        seconds = time.time() - start
+        if ledger is not None:
+            ledger.record_result(job_url, filename, size, sha256=sha256, seconds=seconds)
+        print('JOB %s: %d bytes written to %s in %.1f s' % (job_url, size, filename, seconds))
+
+        return Download(job_url, filename, size, sha256, seconds, resumed, None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch, job_url, runid) for job_url, runid in jobs]
+        downloads = [future.result() for future in futures]
+
+    if manifest is not None:
+        with open(manifest, 'a') as fd:
+            for download in downloads:
+                if download.error is None:
+                    fd.write('%s\t%d\t%s\t%.3f\t%d\t%s\n' % (download.filename, download.bytes, download.sha256,
+                                                             download.seconds, download.resumed, download.url))
+
+    return downloads
+
+
+def fetch_results_of_complete_jobs(tap_service, urls_filename=None, directory='.', bulk=True, stream=False,
+                                   compress=False, format='votable', ledger=None, workers=None,
+                                   max_bytes_per_second=None, manifest=None):
+    '''Fetch the results of complete jobs
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service to which the query will be submitted
+
+    urls_filename: str
+        The filename of the file holding the urls of the jobs (not used
+        when a ledger is given)
+
+    directory: str, default: .
+        The directory where the `<runid>.xml` results are written
+
+    bulk: bool, default: True
+        Read all phases from a single job list request, instead of
+        recreating every job to ask for its phase
+
+    stream: bool, default: False
+        Stream the raw results to disk instead of parsing them in memory
+
+    compress: bool, default: False
+        Gzip the streamed results (written as `<runid>.xml.gz`)
+
+    format: str, default: votable
+        Write the results as `votable` (`<runid>.xml`), or convert them in
+        row batches while streaming to `parquet` or `arrow` (`<runid>.parquet`,
+        `<runid>.arrow`)
+
+    ledger: cosmosim_ledger.JobLedger, default: None
+        Track the jobs in the ledger instead of the urls file: phases and
+        result files are recorded, and each result is fetched by one process
+        only
+
+    workers: int, default: None
+        Download the completed results with `fetch_results()` and this many
+        threads, resuming interrupted downloads (raw VOTables only)
+
+    max_bytes_per_second: float, default: None
+        Cap of the total download rate of the workers
+
+    manifest: str, default: None
+        The file recording the size, sha256 and duration of the downloads
+        of the workers (see `fetch_results()`)
+
+    Returns:
+    --------
+    list(str)
+        The urls of the jobs still executing (kept in `urls_filename` or
+        in the ledger)
+    '''
+
+    import pyvo
+    from cosmosim_convert import FORMATS
+
+    if format != 'votable' and format not in FORMATS:
+        raise ValueError('Unknown format %s' % (format,))
+    if workers and (compress or format != 'votable'):
+        raise ValueError('The workers download raw VOTables, convert or compress them afterwards')
+
+    session = tap_service._session
+    if ledger is not None:
+        unfetched = ledger.unfetched()
+        job_urls = [job.url for job in unfetched]
+        # the job list only goes back to the oldest of these jobs
+        after = listed_after([job.submitted for job in unfetched])
+    else:
+        job_urls = read_job_urls(urls_filename)
+        after = None
+
+    # the results are not parsed by pyvo (nor by the workers)
+    stream = stream or format in FORMATS or bool(workers)
+
+    #
+    # Query the status of all jobs
+    #
+    if bulk:
+        statuses = fetch_phases(tap_service, job_urls, after=after)
+        for status in statuses.values():
+            if status.error is not None:
+                print('JOB {url}: {error}'.format(url=status.url, error=status.error))
+        phases = {job_url: status.phase for job_url, status in statuses.items()}
+        runids = {job_url: status.runid for job_url, status in statuses.items()}
+    else:
+        phases, runids = {}, {}
+        for job_url in job_urls:
+            job = pyvo.dal.AsyncTAPJob(job_url, session=session)
+            phases[job_url], runids[job_url] = job.job.phase, job.job.runid
+
+    if ledger is not None:
+        ledger.update_phases(phases)
+
+    running_job_urls = []
+    completed = []
+
+    for job_url in job_urls:
+
+        print('JOB {url}: {status}'.format(url=job_url, status=phases[job_url]))
+
+        if phases[job_url] == 'ARCHIVED':
+            print('the job was archived, its results can not be fetched anymore\n')
+            continue
+
+        # if still running --> keep it for the next pass
+        if phases[job_url] not in TERMINAL_PHASES:
+            running_job_urls.append(job_url)
+            continue
+
+        # another process may already be fetching this result
+        if ledger is not None and not ledger.claim_fetch(job_url):
+            continue
+
+        runid = runids[job_url]
+
+        #
+        # Recreate the finished job (not needed to stream a COMPLETED result)
+        #
+        if not (stream and phases[job_url] == 'COMPLETED' and runid):
+            try:
+                job = pyvo.dal.AsyncTAPJob(job_url, session=session)
+                job.raise_if_error()
+                runid = job.job.runid
+            except pyvo.dal.DALQueryError as e:
+                # the job failed: nothing to wait for
+                print(e)
+                continue
+            except Exception as e:
+                running_job_urls.append(job_url)
+                if ledger is not None:
+                    ledger.release_fetch(job_url)
+                print(e)
+                continue
+
+        # leave the download to the workers
+        if workers:
+            completed.append((job_url, runid))
+            continue
+
+        #
+        # Fetch the results
+        #
+        if format in FORMATS:
+            filename = os.path.join(directory, '%s.%s' % (runid, format))
+        else:
+            filename = os.path.join(directory, str(runid) + ('.xml.gz' if stream and compress else '.xml'))
+
+        try:
+            if format in FORMATS:
+                print('converting the results to %s...\n' % (format,))
+                convert_result(session, job_url, filename, format=format)
+            elif stream:
+                print('streaming the results to disk...\n')
+                stream_result(session, job_url, filename, compress=compress)
+            else:
+                print('fetching the results...')
+                tap_results = job.fetch_result()
+                print('writing results to disk...\n')
+                tap_results.votable.to_xml(filename)
+
+        except Exception as e:
+            if format in FORMATS and isinstance(e, ValueError):
+                # the result can not be converted: fetching it again would fail again
+                print('JOB {url}: the result can not be converted ({error})\n'.format(url=job_url, error=e))
+                if os.path.exists(filename + '.part'):
+                    os.remove(filename + '.part')
+                if ledger is not None:
+                    ledger.record_fetch_error(job_url, e)
+                continue
+            running_job_urls.append(job_url)
+            if ledger is not None:
+                ledger.release_fetch(job_url)
+            print(e)
+            continue
+
+        if ledger is not None:
+            ledger.record_result(job_url, filename, os.path.getsize(filename))
+
+    if completed:
+        print('downloading %d results with %d workers...\n' % (len(completed), workers))
+        downloads = fetch_results(session, completed, directory=directory, workers=workers,
+                                  max_bytes_per_second=max_bytes_per_second, ledger=ledger, manifest=manifest)
+        for download in downloads:
+            if download.error is not None:
+                # a partial download is resumed on the next pass
+                running_job_urls.append(download.url)
+                print('JOB %s: %s' % (download.url, download.error))
+
+    print('...DONE\n')
+
+    # Output still running jobs
+    if running_job_urls:
+        print('The following jobs are still executing: {}'.format(running_job_urls))
+
+    if ledger is None:
+        write_job_urls(urls_filename, running_job_urls)
+
+    return running_job_urls
@@ -0,0 +1,486 @@
+'''Timing and tracing of every request of the TAP session
+
+The scripts only print phases, so it is hard to tell whether a slow
+pipeline waits for the server queues, for our polling, or for downloads.
+`Instrumentation` hooks into the `requests.Session` shared by the
+`TAPService` and its jobs (`tap_session`) and records, for every request,
+the UWS operation (submit, run, phase, job, job_list, parameters, results,
+delete, sync), the latency until the headers, the bytes and time of the
+transfer of the body, and the HTTP status.
+
+For each job, `job_timings()` splits the time into the wait in the queue
+and the execution (from the UWS document of the job), the lag between the
+end of the job and the start of the download (our polling cadence), and
+the transfer of the result.
+
+The measures can be exported as Prometheus text (`prometheus()`) or as
+OpenTelemetry-style spans (`spans()`, one trace per job).
+
+Example:
+--------
+
+    from cosmosim_instrument import Instrumentation
+
+    instrumentation = Instrumentation().instrument(tap_session)
+
+    ...  # submit, poll, fetch
+
+    print(instrumentation.prometheus())
+    for timing in instrumentation.job_timings(job_urls):
+        print(timing)
+    instrumentation.write_spans('spans.jsonl')
+'''
+
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+# Upper bounds of the buckets of the latency histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Number of individual requests kept for the spans and the job timings
+MAX_RECORDS = 100000
+
+# Path of the UWS resources: .../async[/<jobid>[/<rest>]]
+UWS_PATH = re.compile(r'/(async|sync)(?:/([^/]+)(?:/(.*))?)?/?$')
+
+# Times, in the UWS document of a job
+UWS_TIMES = ('creationTime', 'startTime', 'endTime')
+
+# Breakdown of the time spent on one job, in seconds (None if unknown)
+JobTiming = collections.namedtuple('JobTiming', ['url', 'jobid', 'phase', 'created', 'queue_wait', 'execution',
+                                                 'poll_lag', 'transfer', 'transfer_bytes'])
+
+# Stages of a job, in their order
+STAGES = ('queue_wait', 'execution', 'poll_lag', 'transfer')
+
+
+class RequestRecord(object):
+    '''Measures of one HTTP request'''
+
+    __slots__ = ('operation', 'method', 'url', 'jobid', 'status', 'start', 'headers', 'end', 'bytes', 'error')
+
+    def __init__(self, operation, method, url, jobid, start):
+        self.operation = operation
+        self.method = method
+        self.url = url
+        self.jobid = jobid
+        self.status = None
+        self.start = start
+        self.headers = None
+        self.end = None
+        self.bytes = 0
+        self.error = None
+
+    @property
+    def latency(self):
+        '''Seconds until the headers of the response were received'''
+        return (self.headers or self.end or self.start) - self.start
+
+    @property
+    def transfer(self):
+        '''Seconds spent reading the body'''
+        return max((self.end or self.headers or self.start) - (self.headers or self.start), 0.0)
+
+
+def classify(method, url, body=None):
+    '''The UWS operation of a request, and the jobid it concerns
+
+    Returns:
+    --------
+    (str, str or None)
+    '''
+
+    match = UWS_PATH.search(urllib.parse.urlsplit(url).path)
+    if match is None:
+        return 'other', None
+
+    endpoint, jobid, rest = match.groups()
+    if endpoint == 'sync':
+        return 'sync', None
+
+    if jobid is None:
+        return ('submit' if method == 'POST' else 'job_list'), None
+
+    text = body.decode('utf-8', 'replace') if isinstance(body, bytes) else (body or '')
+    text = text.upper()
+
+    if method == 'DELETE' or (method == 'POST' and 'ACTION=DELETE' in text):
+        return 'delete', jobid
+    if rest is None or rest == '':
+        return 'job', jobid
+    if rest == 'phase':
+        if method == 'POST':
+            return ('abort' if 'ABORT' in text else 'run'), jobid
+        return 'phase', jobid
+    if rest.startswith('results'):
+        return ('result_size' if method == 'HEAD' else 'results'), jobid
+    if rest == 'parameters':
+        return 'parameters', jobid
+
+    return rest.split('/')[0], jobid
+
+
+def _unix(text):
+    '''Seconds since the epoch of an ISO 8601 UWS time'''
+
+    import datetime
+
+    if not text:
+        return None
+    text = text.strip().replace('Z', '+00:00')
+    value = datetime.datetime.fromisoformat(text)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def _id(text, length):
+    '''A stable hexadecimal identifier (trace and span ids)'''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:length]
+
+
+class Instrumentation(object):
+    '''Record the requests of a session
+
+    Parameters:
+    -----------
+    max_records: int, default: MAX_RECORDS
+        The number of individual requests kept (the counters of the
+        Prometheus export cover all of them)
+    '''
+
+    def __init__(self, max_records=MAX_RECORDS):
+        self.records = collections.deque(maxlen=max_records)
+        self.session = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        # aggregates per operation
+        self._counts = collections.Counter()          # (operation, status) -> requests
+        self._bytes = collections.Counter()           # operation -> bytes received
+        self._latency = {}                            # operation -> [bucket counts, sum, count]
+        self._transfer = collections.Counter()        # operation -> seconds reading bodies
+
+    #
+    # Hooks
+    #
+
+    def instrument(self, session):
+        '''Record every request sent by `session` (returns self)'''
+
+        if getattr(session, '_instrumentation', None) is not None:
+            raise ValueError('The session is already instrumented')
+
+        send = session.send
+
+        def instrumented_send(request, **keywords):
+            return self._send(send, request, **keywords)
+
+        session.send = instrumented_send
+        session._instrumentation = self
+        self.session = session
+        return self
+
+    @staticmethod
+    def uninstrument(session):
+        '''Stop recording the requests of a session'''
+
+        if getattr(session, '_instrumentation', None) is not None:
+            del session.send
+            session._instrumentation = None
+
+    def _send(self, send, request, **keywords):
+        # the requests of the instrumentation itself are not recorded, and
+        # the redirections followed by `send` belong to the request which
+        # led to them
+        if getattr(self._local, 'quiet', False) or getattr(self._local, 'sending', False):
+            return send(request, **keywords)
+
+        operation, jobid = classify(request.method, request.url, request.body)
+        record = RequestRecord(operation, request.method, request.url, jobid, time.time())
+
+        self._local.sending = True
+        try:
+            response = send(request, **keywords)
+        except Exception as e:
+            record.end = time.time()
+            record.error = type(e).__name__
+            self._record(record)
+            raise
+        finally:
+            self._local.sending = False
+
+        # the headers of the first response, before any redirection and body
+        record.end = time.time()
+        first = response.history[0] if response.history else response
+        record.headers = min(record.start + first.elapsed.total_seconds(), record.end)
+        record.status = response.status_code
+        if operation == 'submit':
+            # the jobid of a new job is in the redirection to it
+            location = response.url if response.history else response.headers.get('Location', '')
+            record.jobid = classify('GET', location)[1]
+
+        if response._content_consumed:
+            # not streamed: the body was read by `send`
+            with self._lock:
+                record.bytes = len(response.content or b'')
+                self._bytes[operation] += record.bytes
+                self._transfer[operation] += record.end - record.headers
+            self._record(record)
+            return response
+
+        self._record(record)
+
+        # count the bytes of the body as they are read
+        raw = response.raw
+        read = raw.read
+
+        def instrumented_read(*args, **keywords):
+            data = read(*args, **keywords)
+            now = time.time()
+            with self._lock:
+                record.bytes += len(data or b'')
+                self._bytes[operation] += len(data or b'')
+                self._transfer[operation] += now - record.end
+                record.end = now
+            return data
+
+        try:
+            raw.read = instrumented_read
+        except AttributeError:
+            pass
+
+        return response
+
+    def _record(self, record):
+        with self._lock:
+            self.records.append(record)
+            self._counts[(record.operation, str(record.status or record.error))] += 1
+
+            histogram = self._latency.setdefault(record.operation, [[0] * len(BUCKETS), 0.0, 0])
+            latency = record.latency
+            for i, bound in enumerate(BUCKETS):
+                if latency <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += latency
+            histogram[2] += 1
+
+    #
+    # Per job
+    #
+
+    def job_timings(self, job_urls, session=None):
+        '''Break down the time spent on each job
+
+        The creation, start and end times of each job are read from its
+        UWS document (with `session`, default: the instrumented session,
+        without recording the request), the download of its result from
+        the recorded requests.
+
+        Returns:
+        --------
+        list(JobTiming)
+        '''
+
+        with self._lock:
+            records = list(self.records)
+
+        downloads = collections.defaultdict(list)
+        for record in records:
+            if record.operation == 'results' and record.jobid:
+                downloads[record.jobid].append(record)
+
+        timings = []
+        for url in job_urls:
+            jobid = url.strip().rstrip('/').rsplit('/', 1)[-1]
+            phase, times = self._job_times(url, session)
+            created, started, ended = (times.get(name) for name in UWS_TIMES)
+
+            transfers = downloads.get(jobid, [])
+            first = min((record.start for record in transfers), default=None)
+            last = max((record.end for record in transfers if record.end), default=None)
+
+            timings.append(JobTiming(
+                url, jobid, phase, created,
+                started - created if started and created else None,
+                ended - started if ended and started else None,
+                first - ended if first and ended else None,
+                last - first if first and last else None,
+                sum(record.bytes for record in transfers)))
+
+        return timings
+
+    def _job_times(self, url, session):
+        '''The phase and the UWS times of a job, without recording the request'''
+
+        session = session or self.session
+
+        self._local.quiet = True
+        try:
+            response = session.get(url, timeout=60)
+            response.raise_for_status()
+        finally:
+            self._local.quiet = False
+
+        root = ElementTree.fromstring(response.content)
+        values = {element.tag.rsplit('}', 1)[-1]: (element.text or '').strip() for element in root}
+        return values.get('phase'), {name: _unix(values.get(name)) for name in UWS_TIMES}
+
+    #
+    # Exports
+    #
+
+    def summary(self):
+        '''Requests, mean latency, bytes and transfer time per operation'''
+
+        with self._lock:
+            summary = {}
+            for operation, (buckets, total, count) in self._latency.items():
+                summary[operation] = {
+                    'requests': count,
+                    'mean_latency': total / count if count else 0.0,
+                    'bytes': self._bytes[operation],
+                    'transfer_seconds': self._transfer[operation],
+                }
+            return summary
+
+    def prometheus(self, prefix='cosmosim_tap', timings=None):
+        '''The measures in the Prometheus text exposition format
+
+        Parameters:
+        -----------
+        prefix: str, default: cosmosim_tap
+            The prefix of the metric names
+
+        timings: list(JobTiming), default: None
+            Job timings (see `job_timings()`) exported as summaries
+        '''
+
+        lines = []
+
+        with self._lock:
+            lines.append('# HELP %s_requests_total HTTP requests by UWS operation and status' % (prefix,))
+            lines.append('# TYPE %s_requests_total counter' % (prefix,))
+            for (operation, status), count in sorted(self._counts.items()):
+                lines.append('%s_requests_total{operation="%s",status="%s"} %d' % (prefix, operation, status, count))
+
+            lines.append('# HELP %s_request_latency_seconds Time until the response headers' % (prefix,))
+            lines.append('# TYPE %s_request_latency_seconds histogram' % (prefix,))
+            for operation, (buckets, total, count) in sorted(self._latency.items()):
+                for bound, bucket in zip(BUCKETS, buckets):
+                    lines.append('%s_request_latency_seconds_bucket{operation="%s",le="%g"} %d'
+                                 % (prefix, operation, bound, bucket))
+                lines.append('%s_request_latency_seconds_bucket{operation="%s",le="+Inf"} %d'
+                             % (prefix, operation, count))
+                lines.append('%s_request_latency_seconds_sum{operation="%s"} %.6f' % (prefix, operation, total))
+                lines.append('%s_request_latency_seconds_count{operation="%s"} %d' % (prefix, operation, count))
+
+            lines.append('# HELP %s_response_bytes_total Bytes of the response bodies' % (prefix,))
+            lines.append('# TYPE %s_response_bytes_total counter' % (prefix,))
+            for operation, value in sorted(self._bytes.items()):
+                lines.append('%s_response_bytes_total{operation="%s"} %d' % (prefix, operation, value))
+
+            lines.append('# HELP %s_transfer_seconds_total Time spent reading the response bodies' % (prefix,))
+            lines.append('# TYPE %s_transfer_seconds_total counter' % (prefix,))
+            for operation, value in sorted(self._transfer.items()):
+                lines.append('%s_transfer_seconds_total{operation="%s"} %.6f' % (prefix, operation, value))
+
+        if timings:
+            lines.append('# HELP %s_job_seconds Time spent by the jobs in each stage' % (prefix,))
+            lines.append('# TYPE %s_job_seconds summary' % (prefix,))
+            for stage in STAGES:
+                values = [getattr(timing, stage) for timing in timings if getattr(timing, stage) is not None]
+                lines.append('%s_job_seconds_sum{stage="%s"} %.6f' % (prefix, stage, sum(values)))
+                lines.append('%s_job_seconds_count{stage="%s"} %d' % (prefix, stage, len(values)))
+
+        return '\n'.join(lines) + '\n'
+
+    def spans(self, timings=None, service_name='cosmosim-tap'):
+        '''The requests as OpenTelemetry-style spans
+
+        The requests of a job share the trace id derived from its jobid;
+        with `timings`, each job also gets a root span and child spans for
+        its queue wait, execution, poll lag and transfer.
+
+        Returns:
+        --------
+        list(dict)
+        '''
+
+        with self._lock:
+            records = list(self.records)
+
+        def nanoseconds(seconds):
+            return int(seconds * 1e9)
+
+        spans = []
+        for i, record in enumerate(records):
+            trace_id = _id(record.jobid or 'session-%d' % (os.getpid(),), 32)
+            attributes = {
+                'http.method': record.method,
+                'http.url': record.url,
+                'uws.operation': record.operation,
+                'http.response_content_length': record.bytes,
+            }
+            if record.status is not None:
+                attributes['http.status_code'] = record.status
+            if record.jobid:
+                attributes['uws.jobid'] = record.jobid
+
+            spans.append({
+                'trace_id': trace_id,
+                'span_id': _id('%s-%d-%r' % (record.url, i, record.start), 16),
+                'parent_span_id': _id('job-' + record.jobid, 16) if record.jobid and timings else None,
+                'name': 'UWS %s' % (record.operation,),
+                'start_time_unix_nano': nanoseconds(record.start),
+                'end_time_unix_nano': nanoseconds(record.end or record.start),
+                'attributes': attributes,
+                'status': {'code': 'ERROR' if record.error or (record.status or 0) >= 400 else 'OK'},
+                'resource': {'service.name': service_name},
+            })
+
+        for timing in timings or []:
+            if timing.created is None:
+                continue
+
+            trace_id, job_span = _id(timing.jobid, 32), _id('job-' + timing.jobid, 16)
+            ends = [record.end or record.start for record in records if record.jobid == timing.jobid]
+            end = max(ends + [timing.created + sum(getattr(timing, stage) or 0.0 for stage in STAGES)])
+
+            spans.append({'trace_id': trace_id, 'span_id': job_span, 'parent_span_id': None,
+                          'name': 'job %s' % (timing.jobid,),
+                          'start_time_unix_nano': nanoseconds(timing.created),
+                          'end_time_unix_nano': nanoseconds(end),
+                          'attributes': {'uws.jobid': timing.jobid, 'uws.phase': timing.phase},
+                          'status': {'code': 'ERROR' if timing.phase == 'ERROR' else 'OK'},
+                          'resource': {'service.name': service_name}})
+
+            # the stages follow each other from the creation of the job
+            position = timing.created
+            for stage in STAGES:
+                duration = getattr(timing, stage)
+                if duration is None:
+                    continue
+                spans.append({'trace_id': trace_id, 'span_id': _id('%s-%s' % (timing.jobid, stage), 16),
+                              'parent_span_id': job_span, 'name': stage,
+                              'start_time_unix_nano': nanoseconds(position),
+                              'end_time_unix_nano': nanoseconds(position + duration),
+                              'attributes': {'uws.jobid': timing.jobid}, 'status': {'code': 'OK'},
+                              'resource': {'service.name': service_name}})
+                position += duration
+
+        return spans
+
+    def write_spans(self, filename, timings=None):
+        '''Write the spans to a file, one JSON object per line'''
+
+        with open(filename, 'w') as fd:
+            for span in self.spans(timings):
+                fd.write(json.dumps(span) + '\n')
@@ -0,0 +1,351 @@
+'''Durable ledger of submitted jobs, in a local SQLite database
+
+The tutorial keeps track of the submitted jobs in flat files (`job_url.txt`,
+`jobs_url.txt`) which are rewritten in full on every pass. A crash while
+rewriting loses jobs, and only one process can use them at a time. The
+`JobLedger` of this module records each job (runid, url, hash of the query,
+queue, phase, timestamps, result file, size and checksum) in an indexed SQLite
+database in WAL mode: updates are incremental, and one submitting process
+and many fetching processes can share it safely.
+
+Example:
+--------
+
+    from cosmosim_ledger import JobLedger
+    from cosmosim_submission import submit_queries
+    from cosmosim_fetch import fetch_results_of_complete_jobs
+
+    ledger = JobLedger('jobs.sqlite')
+    submit_queries(tap_service, queries, queue='1h', ledger=ledger)
+
+    # later, in any number of processes
+    fetch_results_of_complete_jobs(tap_service, ledger=ledger)
+
+    for job in ledger.jobs(queue='1h', pending=True):
+        print(job.runid, job.phase)
+'''
+
+import collections
+import hashlib
+import sqlite3
+import threading
+import time
+
+from cosmosim_cache import normalize_query
+from cosmosim_poller import TERMINAL_PHASES
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    url TEXT PRIMARY KEY,
+    jobid TEXT,
+    runid TEXT,
+    query_hash TEXT,
+    queue TEXT,
+    phase TEXT,
+    submitted REAL,
+    updated REAL,
+    finished REAL,
+    result_path TEXT,
+    result_bytes INTEGER,
+    result_sha256 TEXT,
+    fetch_seconds REAL,
+    fetch_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_queue_phase ON jobs (queue, phase);
+CREATE INDEX IF NOT EXISTS jobs_query_hash ON jobs (query_hash);
+CREATE INDEX IF NOT EXISTS jobs_runid ON jobs (runid);
+CREATE TABLE IF NOT EXISTS runtimes (
+    fingerprint TEXT,
+    route TEXT,
+    seconds REAL,
+    outcome TEXT,
+    recorded REAL
+);
+CREATE INDEX IF NOT EXISTS runtimes_fingerprint ON runtimes (fingerprint, recorded);
+'''
+
+COLUMNS = ['url', 'jobid', 'runid', 'query_hash', 'queue', 'phase', 'submitted', 'updated', 'finished',
+           'result_path', 'result_bytes', 'result_sha256', 'fetch_seconds', 'fetch_error']
+
+# One past run of a query shape (see `cosmosim_router`)
+Runtime = collections.namedtuple('Runtime', ['route', 'seconds', 'outcome', 'recorded'])
+
+# One row of the ledger
+LedgerEntry = collections.namedtuple('LedgerEntry', COLUMNS)
+
+
+def query_hash(query, language='PostgreSQL'):
+    '''A sha256 identifying a query whatever its comments and white spaces'''
+    text = language.lower() + '\n' + normalize_query(query)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class SQLiteDatabase(object):
+    '''A SQLite database shared by threads and processes
+
+    Each thread uses its own connection; SQLite serializes the writers
+    and, in WAL mode, never blocks the readers.
+
+    Parameters:
+    -----------
+    path: str
+        The database file
+
+    schema: str
+        The statements creating the tables (if they do not exist yet)
+    '''
+
+    def __init__(self, path, schema):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self.connection
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(schema)
+
+    @property
+    def connection(self):
+        '''The connection of the current thread'''
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # isolation_level=None: autocommit, transactions are explicit
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        '''Close the connection of the current thread'''
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _write(self, sql, rows):
+        '''Run a statement for many rows in a single transaction'''
+
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(sql, rows)
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+class JobLedger(SQLiteDatabase):
+    '''Indexed, crash-safe record of the async jobs (see `SQLiteDatabase`)
+
+    Parameters:
+    -----------
+    path: str, default: jobs.sqlite
+        The database file
+    '''
+
+    def __init__(self, path='jobs.sqlite'):
+        SQLiteDatabase.__init__(self, path, SCHEMA)
+
+    #
+    # Updates
+    #
+
+    def record_submissions(self, submissions):
+        '''Record submitted jobs
+
+        Parameters:
+        -----------
+        submissions: list(dict)
+            One dict per job with the keys `url` and, optionally, `runid`,
+            `query_hash`, `queue` and `phase` (default: QUEUED)
+        '''
+
+        now = time.time()
+        rows = [(item['url'], item['url'].rstrip('/').rsplit('/', 1)[-1], item.get('runid'), item.get('query_hash'),
+                 item.get('queue'), item.get('phase', 'QUEUED'), now, now)
+                for item in submissions]
+
+        self._write('INSERT OR REPLACE INTO jobs (url, jobid, runid, query_hash, queue, phase, submitted, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def record_submission(self, url, runid=None, query_hash=None, queue=None, phase='QUEUED'):
+        '''Record one submitted job'''
+        self.record_submissions([{'url': url, 'runid': runid, 'query_hash': query_hash, 'queue': queue,
+                                  'phase': phase}])
+
+    def update_phases(self, phases):
+        '''Record the phases of many jobs
+
+        Parameters:
+        -----------
+        phases: dict
+            The phase of each job url
+        '''
+
+        now = time.time()
+        rows = [(phase, now, now if phase in TERMINAL_PHASES else None, url.strip()) for url, phase in phases.items()]
+
+        self._write('UPDATE jobs SET phase = ?, updated = ?, finished = COALESCE(finished, ?) '
+                    'WHERE url = ? AND phase IS NOT ?', [row + (row[0],) for row in rows])
+
+    def record_result(self, url, result_path, result_bytes, sha256=None, seconds=None):
+        '''Record the file holding the fetched result of a job (with its checksum and download time)'''
+
+        self._write('UPDATE jobs SET result_path = ?, result_bytes = ?, result_sha256 = ?, fetch_seconds = ?, '
+                    'updated = ? WHERE url = ?',
+                    [(result_path, result_bytes, sha256, seconds, time.time(), url.strip())])
+
+    def claim_fetch(self, url, stale=3600.0):
+        '''Reserve the fetching of the result of a job for the calling process
+
+        The claim is an empty `result_path`; claims older than `stale`
+        seconds (left by a crashed process) can be taken over.
+
+        Returns:
+        --------
+        bool
+            True if the caller must fetch the result
+        '''
+
+        now = time.time()
+        cursor = self.connection.execute(
+            "UPDATE jobs SET result_path = '', updated = ? "
+            "WHERE url = ? AND fetch_error IS NULL AND (result_path IS NULL OR (result_path = '' AND updated < ?))",
+            (now, url.strip(), now - stale))
+        return cursor.rowcount == 1
+
+    def release_fetch(self, url):
+        '''Give up a claim taken with `claim_fetch()` (e.g. after a failed download)'''
+        self._write("UPDATE jobs SET result_path = NULL WHERE url = ? AND result_path = ''", [(url.strip(),)])
+
+    def record_fetch_error(self, url, error):
+        '''Give up the result of a job for good (e.g. it can not be converted): it is not fetched again'''
+        self._write("UPDATE jobs SET result_path = NULL, fetch_error = ?, updated = ? WHERE url = ?",
+                    [(str(error), time.time(), url.strip())])
+
+    def record_runtime(self, fingerprint, route, seconds, outcome='COMPLETED'):
+        '''Record how long a query shape ran on a route (sync or a queue), or that it timed out'''
+        self._write('INSERT INTO runtimes (fingerprint, route, seconds, outcome, recorded) VALUES (?, ?, ?, ?, ?)',
+                    [(fingerprint, route, seconds, outcome, time.time())])
+
+    def forget(self, urls):
+        '''Remove jobs from the ledger'''
+        self._write('DELETE FROM jobs WHERE url = ?', [(url.strip(),) for url in urls])
+
+    def import_urls(self, urls_filename, queue=None):
+        '''Import the jobs of a `jobs_url.txt` file (phase unknown until the next check)'''
+
+        with open(urls_filename, 'r') as fd:
+            urls = [line.strip() for line in fd if line.strip()]
+
+        self._write('INSERT OR IGNORE INTO jobs (url, jobid, queue, phase, submitted, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [(url, url.rstrip('/').rsplit('/', 1)[-1], queue, 'UNKNOWN', time.time(), time.time())
+                     for url in urls])
+        return len(urls)
+
+    #
+    # Queries
+    #
+
+    def jobs(self, queue=None, phase=None, pending=False, fetched=None, query_hash=None, runid=None):
+        '''Select jobs
+
+        Parameters:
+        -----------
+        queue: str, default: None
+            Only the jobs of this queue
+
+        phase: str or list(str), default: None
+            Only the jobs in these phases
+
+        pending: bool, default: False
+            Only the jobs not finished yet
+
+        fetched: bool, default: None
+            Only the jobs whose result was (True) or was not (False) fetched
+
+        query_hash: str, default: None
+            Only the jobs of this query (see `query_hash()`)
+
+        runid: str, default: None
+            Only the jobs with this runid
+
+        Returns:
+        --------
+        list(LedgerEntry)
+        '''
+
+        conditions, parameters = [], []
+
+        if queue is not None:
+            conditions.append('queue = ?')
+            parameters.append(queue)
+        if phase is not None:
+            phases = [phase] if isinstance(phase, str) else list(phase)
+            conditions.append('phase IN (%s)' % (', '.join('?' * len(phases)),))
+            parameters.extend(phases)
+        if pending:
+            conditions.append("phase NOT IN ('COMPLETED', 'ERROR', 'ABORTED', 'ARCHIVED')")
+        if fetched is not None:
+            conditions.append("result_path IS NOT NULL AND result_path != ''" if fetched else
+                              "(result_path IS NULL OR result_path = '')")
+        if query_hash is not None:
+            conditions.append('query_hash = ?')
+            parameters.append(query_hash)
+        if runid is not None:
+            conditions.append('runid = ?')
+            parameters.append(runid)
+
+        sql = 'SELECT %s FROM jobs' % (', '.join(COLUMNS),)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY submitted'
+
+        return [LedgerEntry(*row) for row in self.connection.execute(sql, parameters)]
+
+    def unfetched(self):
+        '''The jobs whose result still has to be fetched (running or COMPLETED)'''
+
+        sql = ("SELECT %s FROM jobs WHERE phase NOT IN ('ERROR', 'ABORTED', 'ARCHIVED') AND fetch_error IS NULL "
+               "AND (result_path IS NULL OR result_path = '') ORDER BY submitted" % (', '.join(COLUMNS),))
+        return [LedgerEntry(*row) for row in self.connection.execute(sql)]
+
+    def known_hashes(self, hashes):
+        '''The subset of `hashes` already recorded (see `query_hash()`)'''
+
+        hashes = list(hashes)
+        known = set()
+        # stay below the limit of SQLite on the number of parameters
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start:start + 500]
+            known.update(row[0] for row in self.connection.execute(
+                'SELECT DISTINCT query_hash FROM jobs WHERE query_hash IN (%s)' % (', '.join('?' * len(batch)),),
+                batch))
+        return known
+
+    def job(self, url):
+        '''The entry of one job, or None'''
+
+        row = self.connection.execute('SELECT %s FROM jobs WHERE url = ?' % (', '.join(COLUMNS),),
+                                      (url.strip(),)).fetchone()
+        return LedgerEntry(*row) if row else None
+
+    def runtimes(self, fingerprint, last=20):
+        '''The `last` runs recorded for a query shape, the most recent first
+
+        Returns:
+        --------
+        list(Runtime)
+        '''
+
+        return [Runtime(*row) for row in self.connection.execute(
+            'SELECT route, seconds, outcome, recorded FROM runtimes WHERE fingerprint = ? '
+            'ORDER BY recorded DESC LIMIT ?', (fingerprint, last))]
+
+    def counts(self):
+        '''Number of jobs per (queue, phase)'''
+        return {(queue, phase): count for queue, phase, count in
+                self.connection.execute('SELECT queue, phase, COUNT(*) FROM jobs GROUP BY queue, phase')}
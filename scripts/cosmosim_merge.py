@@ -0,0 +1,466 @@
+'''Merge the results of the chunks of a query into one table
+
+Merging many chunk results with `to_table()` and `vstack` parses every
+file into its own table, then copies all of them again into the merged
+one, growing the memory and time with each chunk. `merge_chunks()` counts
+the rows of all chunks first (a byte scan of the files, no parsing), then
+allocates one NumPy buffer per column and copies each chunk into its slice
+of the buffers. The cells of the chunks are extracted at once by a regular
+expression rather than by walking the XML elements, and with `workers` the
+chunks are parsed in parallel processes.
+
+The `ORDER BY` of the original query is restored without a full sort:
+
+- when the chunks cover disjoint ranges of the ordering column (as the
+  chunks of `cosmosim_chunking` do), the chunks are only put in the order
+  of their ranges,
+- otherwise each chunk is a sorted run, and the runs are merged with a
+  stable sort which detects and merges them (k-way merge).
+
+The merged table can be written to a single Parquet, Arrow, VOTable or
+FITS file.
+
+Example:
+--------
+
+    from cosmosim_merge import merge_chunks
+
+    table = merge_chunks(sorted(glob.glob('mvir_*.xml')), order_by=query, output='mvir.parquet')
+'''
+
+import concurrent.futures
+import html
+import re
+from xml.etree import ElementTree
+
+import numpy as np
+
+from cosmosim_convert import (BATCH_SIZE, FORMATS, VOTableField, _local, _open, arrow_schema, iter_votable_batches,
+                              to_array)
+
+# Bytes read at once when counting rows
+SCAN_SIZE = 4 * 1024 * 1024
+
+# The string literals and quoted identifiers of SQL text
+SQL_QUOTED = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+
+# A cell of TABLEDATA: <TD>text</TD> or <TD/>
+TD_PATTERN = re.compile(rb'<TD(?:\s[^>]*)?(?:/>|>(.*?)</TD>)', re.DOTALL)
+
+ORDER_ITEM = re.compile(r'^(?:[\w"]+\.)*"?(\w+)"?(?:\s+(ASC|DESC))?(?:\s+NULLS\s+(FIRST|LAST))?$', re.IGNORECASE)
+
+
+def count_rows(filename):
+    '''Count the rows of a TABLEDATA VOTable without parsing it
+
+    Returns:
+    --------
+    int or None
+        The number of `<TR>` elements, None if the table is not serialized
+        as TABLEDATA (BINARY, BINARY2, FITS)
+    '''
+
+    fd, close = _open(filename)
+    count = 0
+    tail = b''
+    tabledata = False
+
+    try:
+        while True:
+            block = fd.read(SCAN_SIZE)
+            if not block:
+                break
+            # a tag may be cut between two blocks
+            data = tail + block
+            count += data.count(b'<TR>') + data.count(b'<TR ') - tail.count(b'<TR>') - tail.count(b'<TR ')
+            if not tabledata:
+                if b'<TABLEDATA' in data:
+                    tabledata = True
+                elif b'<BINARY' in data or b'<FITS' in data:
+                    return None
+            tail = data[-16:]
+    finally:
+        if close:
+            fd.close()
+
+    return count if tabledata or count == 0 else None
+
+
+def outer_sql(query):
+    '''The text of the outer level of a query: sub-queries, literals and comments removed'''
+
+    text = SQL_QUOTED.sub("''", query)
+    text = re.sub(r'--[^\n]*', ' ', text)
+
+    depth = 0
+    outer = []
+    for character in text:
+        if character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif depth == 0:
+            outer.append(character)
+
+    return ' '.join(''.join(outer).split())
+
+
+def parse_order_by(query):
+    '''The ordering of the result of a query, from its outer ORDER BY
+
+    Returns:
+    --------
+    list((str or int, bool, bool)) or None
+        The (column name or 1-based position, descending, nulls first) of
+        each ordering item, None if the query has no ORDER BY or orders by
+        an expression
+    '''
+
+    outer = outer_sql(query)
+    matches = list(re.finditer(r'\bORDER\s+BY\s+(.*?)(?=\s+LIMIT\b|\s+OFFSET\b|\s+FETCH\b|;|$)', outer,
+                               re.IGNORECASE))
+    if not matches:
+        return None
+
+    order = []
+    for item in matches[-1].group(1).split(','):
+        item = item.strip()
+        match = ORDER_ITEM.match(item)
+        if match is None:
+            return None
+
+        name, direction, nulls = match.groups()
+        descending = (direction or '').upper() == 'DESC'
+        # PostgreSQL puts the nulls last in ascending order, first in descending order
+        nulls_first = nulls.upper() == 'FIRST' if nulls else descending
+        order.append((int(name) if name.isdigit() else name, descending, nulls_first))
+
+    return order
+
+
+def _sort_keys(values, mask, descending, nulls_first):
+    '''The numeric keys ordering a column (least significant first, for numpy.lexsort)'''
+
+    if values.dtype.kind in 'USO':
+        # strings are replaced by their rank
+        key = np.unique(values.astype(str), return_inverse=True)[1].astype(np.int64)
+    elif values.dtype.kind in 'bu':
+        key = values.astype(np.int64) if values.dtype.itemsize < 8 else values.astype(np.float64)
+    else:
+        key = values
+
+    if descending:
+        key = -key
+
+    keys = [key]
+    if mask is not None:
+        keys.append(~mask if nulls_first else mask)
+    return keys
+
+
+def merge_order(columns, masks, order, run_lengths):
+    '''The permutation putting the concatenated sorted runs in order
+
+    Parameters:
+    -----------
+    columns: dict
+        The values of each column, by name
+
+    masks: dict
+        The null mask of each column, or None
+
+    order: list((str, bool, bool))
+        The ordering (see `parse_order_by()`), with column names
+
+    run_lengths: list(int)
+        The number of rows of each run (chunk), each sorted by `order`
+
+    Returns:
+    --------
+    numpy.ndarray or None
+        The indices of the rows in order, None if they already are
+    '''
+
+    starts = np.concatenate([[0], np.cumsum(run_lengths)]).astype(np.int64)
+    runs = [(start, end) for start, end in zip(starts[:-1], starts[1:]) if end > start]
+    if len(runs) < 2:
+        return None
+
+    keys = []
+    for name, descending, nulls_first in reversed(order):
+        keys.extend(_sort_keys(columns[name], masks.get(name), descending, nulls_first))
+
+    primary = keys[-1]
+    if len(keys) == 1:
+        #
+        # Disjoint runs: only order the runs
+        #
+        firsts = np.array([primary[start] for start, end in runs])
+        lasts = np.array([primary[end - 1] for start, end in runs])
+        ranking = np.argsort(firsts, kind='stable')
+        if np.all(lasts[ranking[:-1]] <= firsts[ranking[1:]]):
+            if np.all(ranking == np.arange(len(runs))):
+                return None
+            return np.concatenate([np.arange(*runs[i]) for i in ranking])
+
+    #
+    # Overlapping runs: the stable sort merges the sorted runs
+    #
+    if len(keys) == 1:
+        return np.argsort(primary, kind='stable')
+    return np.lexsort(keys)
+
+
+def _read_fields(header):
+    '''The VOTableFields declared in the text of a VOTable before its TABLEDATA'''
+
+    parser = ElementTree.XMLPullParser(events=('end',))
+    parser.feed(header)
+
+    fields = []
+    for event, element in parser.read_events():
+        if _local(element.tag) == 'FIELD':
+            description = element.find('{*}DESCRIPTION')
+            fields.append(VOTableField(element.get('name'), element.get('datatype'),
+                                       arraysize=element.get('arraysize'), unit=element.get('unit'),
+                                       ucd=element.get('ucd'),
+                                       description=description.text if description is not None else None))
+    return fields
+
+
+def parse_tabledata(filename):
+    '''Parse a whole TABLEDATA VOTable at once
+
+    The cells are extracted by a regular expression into one array of
+    text, and converted column by column: much faster than walking the
+    elements of the document, for files which fit in memory.
+
+    Returns:
+    --------
+    (list(VOTableField), list((numpy.ndarray, numpy.ndarray or None))) or None
+        As a batch of `cosmosim_convert.iter_votable_batches()`, None if the
+        table can not be read this way (not TABLEDATA, CDATA sections)
+    '''
+
+    fd, close = _open(filename)
+    try:
+        data = fd.read()
+    finally:
+        if close:
+            fd.close()
+
+    start = data.find(b'<TABLEDATA')
+    end = data.find(b'</TABLEDATA>', start)
+    # only the first table of the file is read
+    if start < 0 or end < 0 or data.find(b'<![CDATA[', start, end) >= 0:
+        return None
+
+    fields = _read_fields(data[:start])
+    nrows = data.count(b'<TR', start, end)
+    cells = TD_PATTERN.findall(data, start, end)
+    if not fields or len(cells) != nrows * len(fields):
+        return None
+
+    cells = np.array(cells, dtype=bytes).reshape(nrows, len(fields)) if nrows else np.empty((0, len(fields)), bytes)
+
+    columns = []
+    for i, field in enumerate(fields):
+        values = np.char.strip(np.char.decode(cells[:, i], 'utf-8'))
+        if field.dtype is np.str_:
+            escaped = np.char.find(values, '&') >= 0
+            if escaped.any():
+                values = values.astype(object)
+                values[escaped] = [html.unescape(value) for value in values[escaped]]
+                values = values.astype(str)
+        columns.append(to_array(values, field))
+
+    return fields, columns
+
+
+def _parse_chunk(filename, batch_size=BATCH_SIZE):
+    '''The fields and the (values, mask) of the columns of a whole chunk'''
+
+    parsed = parse_tabledata(filename)
+    if parsed is not None:
+        return parsed
+
+    fields = None
+    batches = []
+    for fields, batch in iter_votable_batches(filename, batch_size=batch_size):
+        batches.append(batch)
+
+    columns = []
+    for i in range(len(fields)):
+        values = np.concatenate([batch[i][0] for batch in batches])
+        masks = [batch[i][1] for batch in batches]
+        mask = None
+        if any(batch_mask is not None for batch_mask in masks):
+            mask = np.concatenate([batch_mask if batch_mask is not None else np.zeros(len(batch[i][0]), dtype=bool)
+                                   for batch, batch_mask in zip(batches, masks)])
+        columns.append((values, mask))
+
+    return fields, columns
+
+
+def _iter_chunks(filenames, batch_size, workers):
+    '''Yield the (index, fields, columns) of the chunks, in order'''
+
+    if not workers or workers < 2:
+        for index, filename in enumerate(filenames):
+            fields, columns = _parse_chunk(filename, batch_size)
+            yield index, fields, columns
+        return
+
+    # parsing is CPU bound: the chunks are parsed in parallel processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = executor.map(_parse_chunk, filenames, [batch_size] * len(filenames))
+        for index, (fields, columns) in enumerate(parsed):
+            yield index, fields, columns
+
+
+def merge_chunks(filenames, order_by=None, output=None, format=None, batch_size=BATCH_SIZE, workers=None):
+    '''Merge the VOTable results of the chunks of a query
+
+    Parameters:
+    -----------
+    filenames: list(str)
+        The results of the chunks (`.xml` or `.xml.gz`), in the order of
+        their ranges if the query is not ordered
+
+    order_by: str or list, default: None
+        The query (its outer ORDER BY is used) or an ordering as returned
+        by `parse_order_by()`; without ordering the chunks are concatenated
+        in the order of `filenames`
+
+    output: str, default: None
+        Write the merged table to this file
+
+    format: str, default: None
+        The format of the output file: `parquet`, `arrow`, `votable` or
+        `fits` (default: from the extension of `output`)
+
+    batch_size: int, default: BATCH_SIZE
+        The number of rows parsed at once
+
+    workers: int, default: None
+        Parse the chunks in this many processes
+
+    Returns:
+    --------
+    astropy.table.Table
+    '''
+
+    from astropy.table import Column, MaskedColumn, Table
+
+    #
+    # Count the rows to size the buffers
+    #
+    counts = [count_rows(filename) for filename in filenames]
+    for i, filename in enumerate(filenames):
+        if counts[i] is None:
+            from astropy.io import votable
+
+            counts[i] = len(votable.parse_single_table(filename).array)
+
+    total = int(sum(counts))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    #
+    # Parse each chunk into its slice of the buffers
+    #
+    fields = None
+    columns = None
+    masks = None
+
+    positions = offsets[:-1].copy()
+    for index, batch_fields, batch in _iter_chunks(filenames, batch_size, workers):
+        filename, position = filenames[index], positions[index]
+
+        if fields is None:
+            fields = batch_fields
+            columns = [np.empty(total, dtype=object if field.dtype is np.str_ else field.dtype)
+                       for field in fields]
+            masks = [None] * len(fields)
+        elif [field.name for field in batch_fields] != [field.name for field in fields]:
+            raise ValueError('The columns of %s differ from the ones of %s' % (filename, filenames[0]))
+
+        nrows = len(batch[0][0]) if batch else 0
+        if position + nrows > offsets[index + 1]:
+            raise ValueError('%s holds more rows than counted' % (filename,))
+
+        for i, (values, mask) in enumerate(batch):
+            if values.dtype.kind == 'S':
+                values = np.char.decode(values, 'utf-8')
+            columns[i][position:position + nrows] = values
+            if mask is not None:
+                if masks[i] is None:
+                    masks[i] = np.zeros(total, dtype=bool)
+                masks[i][position:position + nrows] = mask
+
+        positions[index] += nrows
+
+    if fields is None:
+        raise ValueError('No chunk to merge')
+
+    for i, field in enumerate(fields):
+        if field.dtype is np.str_:
+            columns[i] = columns[i].astype(str) if total else np.array([], dtype=str)
+
+    #
+    # Restore the order of the query
+    #
+    order = parse_order_by(order_by) if isinstance(order_by, str) else order_by
+    if order:
+        names = [field.name for field in fields]
+        order = [(names[item - 1] if isinstance(item, int) else item, descending, nulls_first)
+                 for item, descending, nulls_first in order]
+
+        if all(name in names for name, descending, nulls_first in order):
+            permutation = merge_order(dict(zip(names, columns)), dict(zip(names, masks)), order, counts)
+            if permutation is not None:
+                columns = [column[permutation] for column in columns]
+                masks = [mask[permutation] if mask is not None else None for mask in masks]
+        else:
+            print('WARNING: the result is not ordered, unknown columns in %s' % (order,))
+
+    table = Table([MaskedColumn(column, name=field.name, mask=mask, unit=field.unit, description=field.description)
+                   if mask is not None else
+                   Column(column, name=field.name, unit=field.unit, description=field.description)
+                   for field, column, mask in zip(fields, columns, masks)], copy=False)
+    for field in fields:
+        if field.ucd:
+            table[field.name].meta['ucd'] = field.ucd
+
+    if output is not None:
+        write_table(table, fields, columns, masks, output, format)
+
+    return table
+
+
+def write_table(table, fields, columns, masks, output, format=None):
+    '''Write merged columns to a Parquet, Arrow, VOTable or FITS file'''
+
+    if format is None:
+        extension = output.rsplit('.', 1)[-1].lower()
+        format = {'xml': 'votable', 'vot': 'votable', 'fit': 'fits', 'fits': 'fits'}.get(extension, extension)
+
+    if format in FORMATS:
+        import pyarrow
+        import pyarrow.parquet
+
+        schema = arrow_schema(fields)
+        arrays = [pyarrow.array(column, type=schema.field(i).type, mask=mask)
+                  for i, (column, mask) in enumerate(zip(columns, masks))]
+        arrow_table = pyarrow.Table.from_arrays(arrays, schema=schema)
+
+        if format == 'parquet':
+            pyarrow.parquet.write_table(arrow_table, output, compression='snappy')
+        else:
+            with pyarrow.ipc.new_file(output, schema) as writer:
+                writer.write_table(arrow_table)
+
+    elif format in ('votable', 'fits'):
+        table.write(output, format=format, overwrite=True)
+
+    else:
+        raise ValueError('Unknown output format %s' % (format,))
@@ -0,0 +1,403 @@
+'''Merger tree walks: the histories of many halos from a few range queries
+
+The 5 hours queue example of the tutorial reads the mass accretion history
+of one halo with a self-join of `mdr1.fofmtree`: in the depth-first order
+of the tree, the main branch of a halo is the range of `foftreeid` between
+its own `foftreeid` and its `mainleafid`. Run for thousands of `fofid`s,
+this is thousands of jobs, most of them reading again the same branches:
+the main branch of a progenitor lies inside the one of its descendant.
+
+`MergerTree` walks the trees of many roots at once:
+
+1. the `foftreeid` and `mainleafid` of the roots are resolved with a few
+   sync queries (`fofid IN (...)`), and kept,
+2. the ranges of `foftreeid` already fetched are kept in an interval index
+   (`cosmosim_delta.DeltaIndex`) next to an `cosmosim_store.ExtractStore`:
+   only the parts of the branches not covered yet are fetched, nested and
+   overlapping branches never twice,
+3. the missing ranges are packed into a few range queries (`foftreeid >= a
+   AND foftreeid < b OR ...`), sized for the queue, and run as async jobs,
+4. the histories are cut from the memory maps of the stored extracts with
+   sorted searches: one set of numpy columns for all the roots, and the
+   offsets of each root, without a python object per row.
+
+Example:
+--------
+
+    from cosmosim_mergertree import MergerTree
+    from cosmosim_store import ExtractStore
+
+    tree = MergerTree(tap_service, ExtractStore('~/extracts'), queue='1m')
+    histories = tree.histories([85000000000, 85000000001, 85000000002])
+
+    history = histories[0]                  # dict of numpy arrays, by treesnapnum
+    print(history['treesnapnum'], history['mass'])
+'''
+
+import concurrent.futures
+import os
+import uuid
+
+import numpy as np
+
+from cosmosim_cache import cache_key
+from cosmosim_chunking import rows_per_chunk
+from cosmosim_delta import DeltaIndex, merge_ranges, subtract_ranges
+from cosmosim_fetch import stream_result
+from cosmosim_poller import JobPoller
+from cosmosim_submission import submit_queries
+
+TREE_TABLE = 'mdr1.fofmtree'
+
+# The columns of the histories
+HISTORY_COLUMNS = ('foftreeid', 'treesnapnum', 'mass', 'np')
+
+INDEX_FILENAME = 'mergertree.sqlite'
+
+# Roots resolved by one sync query
+ROOTS_PER_QUERY = 1000
+
+# Ranges of foftreeid in one query
+RANGES_PER_QUERY = 200
+
+ROOTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS roots (
+    base TEXT NOT NULL,
+    root INTEGER NOT NULL,
+    treeid INTEGER NOT NULL,
+    leafid INTEGER NOT NULL,
+    PRIMARY KEY (base, root)
+);
+'''
+
+
+class TreeIndex(DeltaIndex):
+    '''The fetched ranges of a tree table, and the resolved roots'''
+
+    def __init__(self, filename):
+        DeltaIndex.__init__(self, filename)
+        with self._connect() as connection:
+            connection.executescript(ROOTS_SCHEMA)
+
+    def roots(self, base, roots):
+        '''The (root, treeid, leafid) known among `roots`'''
+
+        rows = []
+        roots = [int(root) for root in roots]
+        for start in range(0, len(roots), 500):
+            batch = roots[start:start + 500]
+            rows += self._connect().execute('SELECT root, treeid, leafid FROM roots WHERE base = ? AND root IN (%s)'
+                                            % (', '.join('?' * len(batch)),), [base] + batch).fetchall()
+        return rows
+
+    def add_roots(self, base, rows):
+        '''Record resolved (root, treeid, leafid)'''
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO roots (base, root, treeid, leafid) VALUES (?, ?, ?, ?)',
+                                   [(base, int(root), int(treeid), int(leafid)) for root, treeid, leafid in rows])
+
+
+class Histories(object):
+    '''The histories of many roots, as concatenated numpy columns
+
+    `columns[name][offsets[i]:offsets[i + 1]]` are the rows of the root
+    `roots[i]`; `histories[i]` returns them as a dict of views.
+    '''
+
+    def __init__(self, roots, offsets, columns):
+        self.roots = roots
+        self.offsets = offsets
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.roots)
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {name: values[start:end] for name, values in self.columns.items()}
+
+    @property
+    def lengths(self):
+        '''The number of rows of each history'''
+        return np.diff(self.offsets)
+
+    def root_index(self):
+        '''The index of the root of each row'''
+        return np.repeat(np.arange(len(self.roots)), self.lengths)
+
+
+def range_condition(column, ranges):
+    '''The SQL condition selecting integer ranges [low, high) of a column'''
+    return ' OR '.join('(%s >= %d AND %s < %d)' % (column, low, column, high) for low, high in ranges)
+
+
+def plan_range_queries(ranges, max_rows, max_ranges=RANGES_PER_QUERY):
+    '''Pack integer ranges into groups of at most `max_rows` ids and `max_ranges` ranges
+
+    The ids of a depth-first tree are dense, the span of a range is its
+    number of rows. Ranges larger than `max_rows` are cut.
+    '''
+
+    groups = []
+    group, rows = [], 0
+    for low, high in merge_ranges(ranges):
+        while low < high:
+            take = min(high - low, max_rows)
+            if group and (rows + take > max_rows or len(group) >= max_ranges):
+                groups.append(group)
+                group, rows = [], 0
+            group.append((low, low + take))
+            rows += take
+            low += take
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+class MergerTree(object):
+    '''Histories of halos along the main branch of their merger tree, fetched range by range
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    store: cosmosim_store.ExtractStore
+        The store of the fetched ranges
+
+    table: str, default: TREE_TABLE
+        The merger tree table
+
+    columns: list(str), default: HISTORY_COLUMNS
+        The columns of the histories
+
+    root_column: str, default: fofid
+        The column identifying the roots
+
+    id_column: str, default: foftreeid
+        The depth-first id of the tree
+
+    leaf_column: str, default: mainleafid
+        The last id of the range of a root (`mainleafid` for the main
+        branch, `lastprogid` for the whole subtree if the table has it)
+
+    snapshot_column: str, default: treesnapnum
+        The histories are sorted by this column (None: depth-first order)
+
+    language: str, default: PostgreSQL
+        The query language
+
+    queue: str, default: 1m
+        The queue of the range queries
+    '''
+
+    def __init__(self, tap_service, store, table=TREE_TABLE, columns=HISTORY_COLUMNS, root_column='fofid',
+                 id_column='foftreeid', leaf_column='mainleafid', snapshot_column='treesnapnum',
+                 language='PostgreSQL', queue='1m'):
+        self.tap_service = tap_service
+        self.store = store
+        self.table = table
+        self.columns = list(columns) if id_column in columns else [id_column] + list(columns)
+        self.root_column = root_column
+        self.id_column = id_column
+        self.leaf_column = leaf_column
+        self.snapshot_column = snapshot_column
+        self.language = language
+        self.queue = queue
+
+        self.query = 'SELECT %s FROM %s WHERE {chunk}' % (', '.join(self.columns), table)
+        self.key = cache_key(tap_service.baseurl, self.query, language, column=id_column)
+        self.index = TreeIndex(os.path.join(store.directory, INDEX_FILENAME))
+
+    def resolve(self, roots):
+        '''The range of ids of each root
+
+        Returns:
+        --------
+        (numpy.ndarray, numpy.ndarray)
+            The first and last id of each root (-1 for the roots not found)
+        '''
+
+        roots = np.asarray(roots, dtype=np.int64)
+        known = {root: (treeid, leafid) for root, treeid, leafid in self.index.roots(self.key, np.unique(roots))}
+
+        unknown = [int(root) for root in np.unique(roots) if int(root) not in known]
+        for start in range(0, len(unknown), ROOTS_PER_QUERY):
+            batch = unknown[start:start + ROOTS_PER_QUERY]
+            query = 'SELECT %s, %s, %s FROM %s WHERE %s IN (%s)' % (
+                self.root_column, self.id_column, self.leaf_column, self.table, self.root_column,
+                ', '.join(str(root) for root in batch))
+            result = self.tap_service.run_sync(query, language=self.language).to_table()
+            rows = [(int(row[0]), int(row[1]), int(row[2])) for row in
+                    zip(result[self.root_column], result[self.id_column], result[self.leaf_column])]
+            self.index.add_roots(self.key, rows)
+            known.update((root, (treeid, leafid)) for root, treeid, leafid in rows)
+
+        first = np.array([known.get(int(root), (-1, -1))[0] for root in roots], dtype=np.int64)
+        last = np.array([known.get(int(root), (-1, -1))[1] for root in roots], dtype=np.int64)
+
+        missing = int((first < 0).sum())
+        if missing:
+            print('WARNING: %d roots not found in %s' % (missing, self.table))
+
+        return first, last
+
+    def _ranges(self, first, last):
+        found = first >= 0
+        return merge_ranges(zip(first[found].tolist(), (last[found] + 1).tolist()))
+
+    def covered(self):
+        '''The ranges of ids already fetched, as sorted disjoint ranges'''
+        return merge_ranges((low, high) for low, high, extract in self.index.ranges(self.key))
+
+    def missing(self, roots):
+        '''The ranges of ids of `roots` not fetched yet'''
+        return subtract_ranges(self._ranges(*self.resolve(roots)), self.covered())
+
+    def update(self, roots, dry_run=False):
+        '''Fetch the ranges of the roots not fetched yet
+
+        Returns:
+        --------
+        list((low, high))
+            The ranges submitted
+        '''
+
+        missing = self.missing(roots)
+        if not missing or dry_run:
+            return missing
+
+        groups = {}
+        for ranges in plan_range_queries(missing, rows_per_chunk(self.queue)):
+            groups['%s_%s' % (self.key[:16], uuid.uuid4().hex[:8])] = ranges
+        print('Submitting %d range queries for %d ranges of %s' % (len(groups), len(missing), self.id_column))
+
+        session = self.tap_service._session
+        poller = JobPoller(session, tap_service=self.tap_service).start()
+        pending = {}
+        failed = []
+
+        try:
+            queries = [(name, self.query.replace('{chunk}', '(%s)' % (range_condition(self.id_column, ranges),)),
+                        self.queue, self.language) for name, ranges in groups.items()]
+            for result in submit_queries(self.tap_service, queries):
+                if result.error:
+                    failed.append((result.name, result.error))
+                else:
+                    pending[poller.track(result.url, queue=self.queue)] = result.name
+
+            for future in concurrent.futures.as_completed(pending):
+                name = pending[future]
+                job_url, phase = future.result()
+                if phase != 'COMPLETED':
+                    failed.append((name, phase))
+                    continue
+
+                filename = os.path.join(self.store.directory, '.%s.xml' % (name,))
+                try:
+                    stream_result(session, job_url, filename)
+                    self.store.put_votables(name, filename, query=self.query, language=self.language,
+                                            column=self.id_column, ranges=groups[name], url=job_url)
+                finally:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+
+                for low, high in groups[name]:
+                    self.index.add(self.key, low, high, name)
+                print('JOB %s: %d ranges stored' % (name, len(groups[name])))
+        finally:
+            poller.stop()
+
+        if failed:
+            raise RuntimeError('The following range queries failed: %s'
+                               % (', '.join('%s (%s)' % (name, reason) for name, reason in failed),))
+
+        return missing
+
+    def _rows(self, ranges, columns):
+        '''The stored rows of `ranges`, sorted by id'''
+
+        ranges = merge_ranges(ranges)
+        lows = np.array([low for low, high in ranges], dtype=np.int64)
+        highs = np.array([high for low, high in ranges], dtype=np.int64)
+
+        extracts = sorted(set(extract for low, high, extract in self.index.ranges(self.key)
+                              if any(low < range_high and high > range_low for range_low, range_high in ranges)))
+
+        ids, parts = [], {name: [] for name in columns}
+        for name in extracts:
+            extract = self.store.open(name)
+            values = np.asarray(np.ma.getdata(extract[self.id_column]))
+            position = np.searchsorted(lows, values, side='right') - 1
+            selected = (position >= 0) & (values < highs[np.maximum(position, 0)])
+            ids.append(values[selected])
+            for column in columns:
+                parts[column].append(np.ma.getdata(extract[column])[selected])
+
+        if not ids:
+            return np.zeros(0, dtype=np.int64), {name: np.zeros(0) for name in columns}
+
+        ids = np.concatenate(ids)
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        # rows stored twice (e.g. by concurrent updates) are kept once
+        unique = np.ones(len(ids), dtype=bool)
+        unique[1:] = ids[1:] != ids[:-1]
+
+        return ids[unique], {name: np.concatenate(parts[name])[order][unique] for name in columns}
+
+    def histories(self, roots, columns=None, update=True):
+        '''The histories of the roots
+
+        Parameters:
+        -----------
+        roots: list(int) or numpy.ndarray
+            The roots (`fofid`)
+
+        columns: list(str), default: None
+            The columns of the histories (default: all the columns)
+
+        update: bool, default: True
+            Fetch the ranges not fetched yet first
+
+        Returns:
+        --------
+        Histories
+        '''
+
+        roots = np.asarray(roots, dtype=np.int64)
+        columns = list(columns or self.columns)
+        if update:
+            self.update(roots)
+
+        first, last = self.resolve(roots)
+        needed = columns + [self.snapshot_column] if self.snapshot_column in self.columns else columns
+        ids, values = self._rows(self._ranges(first, last), sorted(set(needed)))
+
+        #
+        # The rows of each root: a slice of the sorted ids, gathered at once
+        #
+        found = first >= 0
+        starts = np.where(found, np.searchsorted(ids, first, side='left'), 0)
+        ends = np.where(found, np.searchsorted(ids, last, side='right'), 0)
+        lengths = ends - starts
+
+        offsets = np.zeros(len(roots) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+        if self.snapshot_column in values:
+            root_index = np.repeat(np.arange(len(roots)), lengths)
+            gather = gather[np.lexsort((values[self.snapshot_column][gather], root_index))]
+
+        return Histories(roots, offsets, {name: values[name][gather] for name in columns})
+
+    def history(self, root, update=True):
+        '''The history of one root, as a dict of numpy arrays'''
+        return self.histories([root], update=update)[0]
+
+    def clear(self):
+        '''Forget and remove all the fetched ranges of the table'''
+        for extract in set(self.index.remove(self.key)):
+            self.store.remove(extract)
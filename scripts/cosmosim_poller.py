@@ -0,0 +1,394 @@
+'''Event-driven polling of many async TAP jobs at once
+
+The tutorial scripts wait for each job in its own blocking loop, either with
+`job.wait()` or with a fixed `time.sleep(3600.0)` between two phase checks.
+The `JobPoller` of this module tracks any number of job urls at once. The
+phases of the jobs of a queue are checked together, in one batch of
+concurrent requests to the light-weight `<job_url>/phase` endpoint (or in a
+single `get_job_list()` request when a TAP service is given), with a delay
+that starts short and grows up to a cap. Callbacks are fired and
+futures resolved as soon as a job reaches COMPLETED, ERROR, ABORTED or
+ARCHIVED.
+
+Example:
+--------
+
+    import concurrent.futures
+    from cosmosim_poller import JobPoller
+
+    poller = JobPoller(tap_session)
+    futures = [poller.track(result.url, queue='1m') for result in results]
+    poller.start()
+
+    for future in concurrent.futures.as_completed(futures):
+        url, phase = future.result()
+        print('JOB %s: %s' % (url, phase))
+
+    poller.stop()
+'''
+
+import collections
+import concurrent.futures
+import datetime
+import threading
+import time
+
+# ARCHIVED jobs do not change anymore either: their results are gone
+TERMINAL_PHASES = ('COMPLETED', 'ERROR', 'ABORTED', 'ARCHIVED')
+
+#
+# Delay between two phase checks of a queue: (first delay, growth factor, maximum delay) in seconds
+#
+QUEUE_BACKOFF = {
+    '1m': (1.0, 1.5, 10.0),
+    '1h': (5.0, 1.5, 120.0),
+    '5h': (15.0, 1.5, 600.0),
+}
+
+# The phases read from the job list: the jobs which may still change, and the
+# finished ones not archived yet (ARCHIVED jobs are only listed on demand)
+LISTED_PHASES = ('PENDING', 'QUEUED', 'EXECUTING', 'HELD', 'SUSPENDED', 'COMPLETED', 'ERROR', 'ABORTED')
+
+# Seconds the clock of the service may be behind the local one
+CLOCK_SKEW = 3600.0
+
+# Outcome of the polling of one job
+PollResult = collections.namedtuple('PollResult', ['url', 'phase'])
+
+# Status of a job as listed by the job list of the service (error: why the phase could not be read)
+JobStatus = collections.namedtuple('JobStatus', ['url', 'jobid', 'runid', 'phase', 'error'])
+
+# The job does not exist (anymore): purged, mistyped or owned by another user
+MISSING_JOB_STATUS = (403, 404, 410)
+
+
+def job_id(job_url):
+    '''The jobid is the last part of the job url'''
+    return job_url.strip().rstrip('/').rsplit('/', 1)[-1]
+
+
+def listed_after(submitted):
+    '''The creation time from which on the job list holds the jobs submitted at these times
+
+    Parameters:
+    -----------
+    submitted: list(float)
+        The local times (seconds since the epoch) the jobs were submitted at
+
+    Returns:
+    --------
+    datetime.datetime or None
+        UTC, `CLOCK_SKEW` before the oldest job; None if a time is unknown
+    '''
+
+    if not submitted or any(timestamp is None for timestamp in submitted):
+        return None
+
+    oldest = datetime.datetime.fromtimestamp(min(submitted) - CLOCK_SKEW, tz=datetime.timezone.utc)
+    return oldest.replace(tzinfo=None)
+
+
+def fetch_phases(tap_service, job_urls, session=None, after=None):
+    '''Get the phases of many jobs with a single request to the job list
+
+    Only the `LISTED_PHASES` of the jobs created after `after` are listed,
+    not the whole history of the account. The jobs are matched by jobid. Jobs missing from the list (e.g. ARCHIVED
+    jobs, which are not listed by default) are looked up one by one. A
+    failing lookup does not stop the others: a job which does not exist
+    (anymore) is reported as ARCHIVED, as its results can not be fetched
+    either, other failures as UNKNOWN, to be checked again later. The
+    `error` of both holds the exception.
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service to which the jobs were submitted
+
+    job_urls: list(str)
+        The urls of the jobs
+
+    session: requests.Session, default: the session of the TAP service
+        The session used for the individual lookups
+
+    after: datetime.datetime, default: None
+        List only the jobs created after this time (UTC), see `listed_after()`
+
+    Returns:
+    --------
+    dict
+        A `JobStatus` for each job url
+    '''
+
+    session = session or tap_service._session
+    job_urls = [job_url.strip() for job_url in job_urls]
+    if not job_urls:
+        return {}
+
+    listed = {job.jobid: job for job in tap_service.get_job_list(phases=list(LISTED_PHASES), after=after)}
+
+    statuses = {}
+    for job_url in job_urls:
+        job = listed.get(job_id(job_url))
+        if job is not None:
+            statuses[job_url] = JobStatus(job_url, job.jobid, job.runid, job.phase, None)
+            continue
+
+        try:
+            response = session.get(job_url + '/phase', timeout=30)
+            response.raise_for_status()
+        except Exception as e:
+            status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+            phase = 'ARCHIVED' if status_code in MISSING_JOB_STATUS else 'UNKNOWN'
+            statuses[job_url] = JobStatus(job_url, job_id(job_url), None, phase, e)
+            continue
+
+        statuses[job_url] = JobStatus(job_url, job_id(job_url), None, response.text.strip().upper(), None)
+
+    return statuses
+
+
+class JobPoller(object):
+    '''Track the phases of many async jobs with one adaptive backoff per queue
+
+    Parameters:
+    -----------
+    session: requests.Session
+        The session holding the authorization token
+
+    backoff: dict, default: QUEUE_BACKOFF
+        (first delay, growth factor, maximum delay) in seconds per queue
+
+    max_workers: int, default: 8
+        The number of phase requests sent at the same time
+
+    tap_service: pyvo.dal.tap.TAPService, default: None
+        If given, the phases of a batch are read from one `get_job_list()`
+        request instead of one request per job
+    '''
+
+    def __init__(self, session, backoff=None, max_workers=8, tap_service=None):
+        self.session = session
+        self.tap_service = tap_service
+        self.backoff = dict(QUEUE_BACKOFF)
+        self.backoff.update(backoff or {})
+        self.max_workers = max_workers
+
+        # queue -> {url: (future, callback)}
+        self._jobs = collections.defaultdict(dict)
+        # queue -> [delay, time of the next check]
+        self._schedule = {}
+
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(jobs) for jobs in self._jobs.values())
+
+    def track(self, url, queue='1m', callback=None):
+        '''Start tracking a job
+
+        Parameters:
+        -----------
+        url: str
+            The url of the job
+
+        queue: str, default: 1m
+            The queue the job was submitted to, it selects the backoff
+
+        callback: callable, default: None
+            Called with a `PollResult` once the job is finished
+
+        Returns:
+        --------
+        concurrent.futures.Future
+            Resolved with a `PollResult` once the job is finished
+        '''
+
+        future = concurrent.futures.Future()
+
+        with self._condition:
+            self._jobs[queue][url.strip()] = (future, callback)
+
+            # a new job may be a short one: check its queue again soon, without
+            # resetting the delay the other jobs of the queue have reached
+            first_delay = self.backoff.get(queue, self.backoff['1m'])[0]
+            first_check = time.time() + first_delay
+            if queue in self._schedule:
+                self._schedule[queue][1] = min(self._schedule[queue][1], first_check)
+            else:
+                self._schedule[queue] = [first_delay, first_check]
+            self._condition.notify()
+
+        return future
+
+    def poll(self, queue=None):
+        '''Check the phases of all jobs of a queue (or of all queues) once
+
+        Returns:
+        --------
+        list(PollResult)
+            The jobs which reached a terminal phase during this check
+        '''
+
+        with self._condition:
+            queues = [queue] if queue is not None else list(self._jobs)
+            batch = [(name, url) for name in queues for url in self._jobs.get(name, {})]
+
+        if self.tap_service is not None and batch:
+            phases = self._fetch_phases([url for name, url in batch])
+        else:
+            phases = self._executor.map(lambda item: self._fetch_phase(item[1]), batch)
+
+        finished = []
+        for (name, url), phase in zip(batch, phases):
+            if isinstance(phase, Exception) or phase in TERMINAL_PHASES:
+                result = self._resolve(name, url, phase)
+                if result is not None:
+                    finished.append(result)
+        return finished
+
+    def run(self, timeout=None):
+        '''Poll until all tracked jobs are finished (or `timeout` seconds elapsed)
+
+        Returns:
+        --------
+        bool
+            True if all jobs are finished
+        '''
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            with self._condition:
+                if not any(self._jobs.values()):
+                    return True
+
+                due = self._wait_for_due_queues(deadline)
+
+            if due is None:
+                return False
+
+            for queue in due:
+                self.poll(queue)
+                self._reschedule(queue)
+
+    def start(self):
+        '''Poll in a background thread until `stop()` is called'''
+
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the background thread'''
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self._executor.shutdown(wait=True)
+
+    #
+    # Internals
+    #
+
+    def _serve(self):
+        while True:
+            with self._condition:
+                while not self._stopped and not any(self._jobs.values()):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+
+                due = self._wait_for_due_queues(None)
+
+            for queue in due or []:
+                self.poll(queue)
+                self._reschedule(queue)
+
+    def _wait_for_due_queues(self, deadline):
+        '''Sleep until a queue is due, return the due queues (None on timeout)
+
+        The caller must hold the condition.
+        '''
+
+        while not self._stopped:
+            now = time.time()
+            pending = [queue for queue, jobs in self._jobs.items() if jobs]
+            due = [queue for queue in pending if self._schedule[queue][1] <= now]
+            if due:
+                return due
+
+            wake_up = min(self._schedule[queue][1] for queue in pending) if pending else now + 1.0
+            if deadline is not None:
+                if now >= deadline:
+                    return None
+                wake_up = min(wake_up, deadline)
+
+            self._condition.wait(wake_up - now)
+
+        return []
+
+    def _reschedule(self, queue):
+        with self._condition:
+            first_delay, factor, max_delay = self.backoff.get(queue, self.backoff['1m'])
+            delay = self._schedule[queue][0]
+            delay = min(delay * factor, max_delay)
+            self._schedule[queue] = [delay, time.time() + delay]
+
+    def _fetch_phase(self, url):
+        '''Read the phase of a job, exceptions are returned (not raised)'''
+
+        try:
+            response = self.session.get(url + '/phase', timeout=30)
+            if response.status_code >= 500:
+                # transient server problem: try again at the next check
+                return 'UNKNOWN'
+            response.raise_for_status()
+            return response.text.strip().upper()
+        except Exception as e:
+            if getattr(getattr(e, 'response', None), 'status_code', 500) < 500:
+                return e
+            return 'UNKNOWN'
+
+    def _fetch_phases(self, urls):
+        '''Read the phases of a batch from the job list'''
+
+        try:
+            statuses = fetch_phases(self.tap_service, urls, session=self.session)
+        except Exception:
+            # transient problem: try again at the next check
+            return ['UNKNOWN'] * len(urls)
+
+        # a job which does not exist fails its future, as in `_fetch_phase()`
+        return [statuses[url].error if statuses[url].error is not None and statuses[url].phase == 'ARCHIVED'
+                else statuses[url].phase for url in urls]
+
+    def _resolve(self, queue, url, phase):
+        with self._condition:
+            entry = self._jobs[queue].pop(url, None)
+        if entry is None:
+            return None
+
+        future, callback = entry
+        if isinstance(phase, Exception):
+            future.set_exception(phase)
+            return None
+
+        result = PollResult(url, phase)
+        if callback is not None:
+            try:
+                callback(result)
+            except Exception as e:
+                future.set_exception(e)
+                return result
+
+        future.set_result(result)
+        return result
@@ -0,0 +1,302 @@
+'''Route each query to sync or to the smallest async queue likely to succeed
+
+Choosing between `run_sync` and the queues 1m, 1h and 5h by hand often goes
+wrong: a long sync call times out, a short query waits behind others in an
+async queue. `QueryRouter` estimates the run time of a query before
+submitting it, from the cheapest source available:
+
+1. the history of the past runs of the same query shape (the query with
+   its literals replaced, see `fingerprint()`), kept in the runtimes table
+   of a `cosmosim_ledger.JobLedger`,
+2. a small outer `LIMIT` (or ADQL `TOP`) without ORDER BY, GROUP BY nor
+   DISTINCT, which stops the query early,
+3. an `EXPLAIN` of the query (PostgreSQL only), whose cost and row
+   estimates are turned into seconds.
+
+The query then goes to the first route (sync, 1m, 1h, 5h) whose time limit
+holds the estimate with a safety margin. A query stopped by the time limit
+of its route is run again on the next route, and the timeout is recorded so
+that the next run of the same shape starts there.
+
+Example:
+--------
+
+    from cosmosim_ledger import JobLedger
+    from cosmosim_router import QueryRouter
+
+    router = QueryRouter(tap_service, ledger=JobLedger('jobs.sqlite'))
+    routed = router.run(query, language='PostgreSQL', runid='bdmv')
+    print(routed.route, routed.seconds)
+    table = routed.result.to_table()
+'''
+
+import collections
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+import requests
+
+# pyvo and astropy are imported by the methods running the queries
+from cosmosim_cache import normalize_query
+from cosmosim_chunking import QUEUE_TIME_LIMIT, ROWS_PER_SECOND, SAFETY, TIMEOUT_PATTERN, error_summary
+from cosmosim_merge import outer_sql
+from cosmosim_poller import TERMINAL_PHASES
+from cosmosim_store import download_query
+
+# The routes, from the fastest to answer to the longest time limit
+ROUTES = ('sync', '1m', '1h', '5h')
+
+# Seconds a sync query may run before the client gives up on it
+SYNC_TIME_LIMIT = 30.0
+
+ROUTE_TIME_LIMIT = dict(QUEUE_TIME_LIMIT, sync=SYNC_TIME_LIMIT)
+
+# Planner cost units processed per second (rough, tune it for your queries)
+COST_PER_SECOND = 1.0e6
+
+# The runs of a shape taken into account
+HISTORY = 20
+
+# Literals of normalized queries: strings and numbers
+LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![\w.])[-+]?\d+(?:\.\d*)?(?:e[-+]?\d+)?(?![\w.])")
+
+# The first line of a PostgreSQL plan: (cost=0.00..1234.56 rows=789 width=40)
+PLAN_COST = re.compile(r'cost=([\d.]+)\.\.([\d.]+)\s+rows=(\d+)')
+
+# Estimated run time of a query, in seconds (None: unknown)
+Estimate = collections.namedtuple('Estimate', ['seconds', 'rows', 'source'])
+
+# Outcome of a routed query
+RoutedResult = collections.namedtuple('RoutedResult', ['route', 'estimate', 'result', 'seconds', 'url'])
+
+
+class RouteTimeout(Exception):
+    '''The query was stopped by the time limit of its route'''
+
+
+def fingerprint(query, language='PostgreSQL'):
+    '''A sha256 of the shape of a query: normalized, with its literals replaced by `?`'''
+    text = language.lower() + '\n' + LITERALS.sub('?', normalize_query(query))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def limit_rows(query):
+    '''The number of rows of a query stopped early by an outer LIMIT or TOP, None otherwise
+
+    A LIMIT after an ORDER BY, GROUP BY or DISTINCT does not stop the query
+    early: all the rows are read before the first is returned.
+    '''
+
+    outer = outer_sql(query)
+    if re.search(r'\b(ORDER\s+BY|GROUP\s+BY|DISTINCT|UNION|INTERSECT|EXCEPT)\b', outer, re.IGNORECASE):
+        return None
+
+    match = (re.search(r'\bLIMIT\s+(\d+)', outer, re.IGNORECASE) or
+             re.search(r'^\s*SELECT\s+TOP\s+(\d+)', outer, re.IGNORECASE))
+    return int(match.group(1)) if match else None
+
+
+def explain(tap_service, query, language='PostgreSQL'):
+    '''The planner estimates of a query, from a sync `EXPLAIN`
+
+    Returns:
+    --------
+    (float, int) or None
+        The total cost and the number of rows of the plan, None if the
+        service could not explain the query
+    '''
+
+    if language.lower() != 'postgresql':
+        return None
+
+    try:
+        table = tap_service.run_sync('EXPLAIN ' + query, language=language).to_table()
+    except Exception:
+        return None
+
+    if not len(table) or not len(table.colnames):
+        return None
+    match = PLAN_COST.search(str(table[table.colnames[0]][0]))
+    if match is None:
+        return None
+
+    return float(match.group(2)), int(match.group(3))
+
+
+def choose_route(estimate, safety=SAFETY, limits=ROUTE_TIME_LIMIT):
+    '''The first route whose time limit holds the estimate (1m if unknown)'''
+
+    if estimate.seconds is None:
+        return '1m'
+
+    for route in ROUTES:
+        if estimate.seconds <= limits[route] * safety:
+            return route
+    return ROUTES[-1]
+
+
+class QueryRouter(object):
+    '''Dispatch queries to sync or to an async queue, escalating on timeout
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    ledger: cosmosim_ledger.JobLedger, default: None
+        Keeps the history of the run times (no history if None)
+
+    sync_time_limit: float, default: SYNC_TIME_LIMIT
+        The seconds a sync query may run
+
+    probe: bool, default: True
+        Ask the service to EXPLAIN the queries without history
+
+    safety: float, default: SAFETY
+        The fraction of the time limit of a route an estimate may use
+    '''
+
+    def __init__(self, tap_service, ledger=None, sync_time_limit=SYNC_TIME_LIMIT, probe=True, safety=SAFETY):
+        self.tap_service = tap_service
+        self.ledger = ledger
+        self.sync_time_limit = sync_time_limit
+        self.probe = probe
+        self.safety = safety
+
+        self.limits = dict(ROUTE_TIME_LIMIT, sync=sync_time_limit)
+
+    def estimate(self, query, language='PostgreSQL'):
+        '''Estimate the run time of a query
+
+        Returns:
+        --------
+        Estimate
+        '''
+
+        #
+        # History of the shape: the slowest recent run, and at least the
+        # time limit of the routes on which it timed out
+        #
+        if self.ledger is not None:
+            runs = self.ledger.runtimes(fingerprint(query, language), last=HISTORY)
+            completed = [run.seconds for run in runs if run.outcome == 'COMPLETED' and run.seconds is not None]
+            timeouts = [self.limits.get(run.route, 0.0) for run in runs if run.outcome == 'TIMEOUT']
+            if completed or timeouts:
+                seconds = max(completed[:5] + timeouts)
+                return Estimate(seconds, None, 'history')
+
+        rows = limit_rows(query)
+        if rows is not None:
+            return Estimate(rows / ROWS_PER_SECOND, rows, 'limit')
+
+        if self.probe:
+            plan = explain(self.tap_service, query, language)
+            if plan is not None:
+                cost, rows = plan
+                return Estimate(max(cost / COST_PER_SECOND, rows / ROWS_PER_SECOND), rows, 'explain')
+
+        return Estimate(None, None, 'default')
+
+    def route(self, query, language='PostgreSQL'):
+        '''The route of a query and its estimate'''
+
+        estimate = self.estimate(query, language)
+        return choose_route(estimate, self.safety, self.limits), estimate
+
+    def run(self, query, language='PostgreSQL', runid=None, route=None):
+        '''Run a query on its route, escalating to the next route on timeout
+
+        Parameters:
+        -----------
+        query: str
+            The query
+
+        language: str, default: PostgreSQL
+            The query language
+
+        runid: str, default: None
+            The runid of the async jobs
+
+        route: str, default: None
+            Force the first route (sync, 1m, 1h or 5h)
+
+        Returns:
+        --------
+        RoutedResult
+        '''
+
+        estimate = None
+        if route is None:
+            route, estimate = self.route(query, language)
+        shape = fingerprint(query, language)
+
+        for current in ROUTES[ROUTES.index(route):]:
+            try:
+                if current == 'sync':
+                    result, seconds, url = self._run_sync(query, language)
+                else:
+                    result, seconds, url = self._run_async(query, language, runid, current)
+            except RouteTimeout as e:
+                self._record(shape, current, self.limits[current], 'TIMEOUT')
+                print('Query timed out on %s (%s), escalating' % (current, e))
+                continue
+
+            self._record(shape, current, seconds, 'COMPLETED')
+            return RoutedResult(current, estimate, result, seconds, url)
+
+        raise RouteTimeout('The query timed out on every route')
+
+    def _record(self, shape, route, seconds, outcome):
+        if self.ledger is not None:
+            self.ledger.record_runtime(shape, route, seconds, outcome)
+
+    def _run_sync(self, query, language):
+        '''Run a sync query within the sync time limit'''
+
+        import pyvo
+        from astropy.io import votable
+
+        descriptor, filename = tempfile.mkstemp(prefix='cosmosim_sync_', suffix='.xml')
+        os.close(descriptor)
+        try:
+            start = time.time()
+            try:
+                download_query(self.tap_service, query, filename, language=language,
+                               timeout=(10.0, self.sync_time_limit))
+            except requests.exceptions.Timeout:
+                raise RouteTimeout('no answer after %.0f s' % (self.sync_time_limit,))
+            except (pyvo.dal.DALQueryError, requests.exceptions.HTTPError) as e:
+                if TIMEOUT_PATTERN.search(str(e)):
+                    raise RouteTimeout(str(e))
+                raise pyvo.dal.DALQueryError(str(e))
+            seconds = time.time() - start
+
+            result = pyvo.dal.TAPResults(votable.parse(filename), url=self.tap_service.baseurl)
+        finally:
+            os.remove(filename)
+
+        return result, seconds, None
+
+    def _run_async(self, query, language, runid, queue):
+        '''Run an async job in a queue and wait for it'''
+
+        job = self.tap_service.submit_job(query, language=language, runid=runid, queue=queue)
+        job.run()
+        job.wait(phases=list(TERMINAL_PHASES))
+
+        if job.phase == 'ERROR':
+            message = error_summary(self.tap_service._session, job.url)
+            if TIMEOUT_PATTERN.search(message):
+                raise RouteTimeout(message)
+        job.raise_if_error()
+
+        summary = job.job
+        if summary.starttime is not None and summary.endtime is not None:
+            seconds = (summary.endtime - summary.starttime).sec
+        else:
+            seconds = None
+
+        return job.fetch_result(), seconds, job.url
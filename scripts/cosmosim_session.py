@@ -0,0 +1,151 @@
+'''A `requests.Session` tuned for the CosmoSim TAP service
+
+The tutorial builds a bare `requests.Session()` holding the token. Its
+connection pool keeps 10 connections per host and it never retries, so
+concurrent submissions and downloads open and close connections all the
+time, and a single transient 502 aborts a whole batch. `tap_session()`
+returns a session with:
+
+- connection pools sized for the concurrency of the helper modules, kept
+  alive between requests,
+- gzip/deflate negotiated for the UWS documents and VOTables,
+- retries with exponential, jittered backoff on connection errors and on
+  429/5xx answers (honouring `Retry-After`); requests which are not
+  idempotent (POST: job creation, run) are only retried when they could
+  not reach the server,
+- a default timeout, so a stalled connection never hangs a script,
+- an immediate `AuthenticationError` on 401/403: retrying a wrong or
+  expired token is pointless.
+
+Example:
+--------
+
+    from cosmosim_session import tap_session
+
+    session = tap_session('Token <your-token>')
+    tap_service = pyvo.dal.TAPService('https://www.cosmosim.org/tap', session=session)
+'''
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connections kept alive per host: the sum of QUEUE_CONCURRENCY and a few downloads
+POOL_MAXSIZE = 32
+
+# Answers worth retrying: rate limiting and transient server errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Methods retried after the request reached the server
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# (connect, read) timeout in seconds
+TIMEOUT = (10.0, 300.0)
+
+
+class AuthenticationError(requests.HTTPError):
+    '''The token was refused by the service'''
+
+
+class TAPAdapter(HTTPAdapter):
+    '''HTTPAdapter applying a default timeout to the requests without one'''
+
+    def __init__(self, timeout=TIMEOUT, **keywords):
+        self.timeout = timeout
+        self.keywords = keywords
+        HTTPAdapter.__init__(self, **keywords)
+
+    def resized(self, pool_maxsize):
+        '''A new adapter with the same settings and another pool size'''
+        return TAPAdapter(timeout=self.timeout, **dict(self.keywords, pool_maxsize=pool_maxsize))
+
+    def send(self, request, timeout=None, **keywords):
+        return HTTPAdapter.send(self, request, timeout=timeout if timeout is not None else self.timeout, **keywords)
+
+
+def retry_policy(retries=5, backoff_factor=0.5, backoff_jitter=0.5, backoff_max=60.0):
+    '''The urllib3 retry policy of the session
+
+    Parameters:
+    -----------
+    retries: int, default: 5
+        The maximum number of retries of one request
+
+    backoff_factor: float, default: 0.5
+        Sleep backoff_factor * 2 ** (retry - 1) seconds between retries
+
+    backoff_jitter: float, default: 0.5
+        Add a random delay up to this many seconds, so that the threads of
+        a batch do not retry all at once
+
+    backoff_max: float, default: 60
+        The maximum sleep between two retries
+    '''
+
+    keywords = dict(total=retries, connect=retries, read=retries, status=retries, other=0, redirect=10,
+                    allowed_methods=IDEMPOTENT_METHODS, status_forcelist=RETRY_STATUS,
+                    backoff_factor=backoff_factor, backoff_max=backoff_max,
+                    respect_retry_after_header=True, raise_on_status=False)
+
+    try:
+        return Retry(backoff_jitter=backoff_jitter, **keywords)
+    except TypeError:
+        # urllib3 < 2 has no jitter
+        keywords.pop('other')
+        keywords['method_whitelist'] = keywords.pop('allowed_methods')
+        return Retry(**keywords)
+
+
+def raise_on_auth_error(response, *args, **keywords):
+    '''Response hook failing fast when the token is refused'''
+
+    if response.status_code in (401, 403):
+        raise AuthenticationError('%d %s for %s: check your API token (Token <your-token>)'
+                                  % (response.status_code, response.reason, response.url), response=response)
+
+
+def tap_session(token=None, pool_maxsize=POOL_MAXSIZE, retries=5, backoff_factor=0.5, backoff_jitter=0.5,
+                timeout=TIMEOUT, pool_block=False):
+    '''Build a session for the TAP service
+
+    Parameters:
+    -----------
+    token: str, default: None
+        The `Authorization` header, e.g. `Token <your-token>`
+
+    pool_maxsize: int, default: POOL_MAXSIZE
+        The number of connections kept alive per host
+
+    retries, backoff_factor, backoff_jitter:
+        The retry policy (see `retry_policy()`)
+
+    timeout: float or (float, float), default: TIMEOUT
+        The default (connect, read) timeout of the requests
+
+    pool_block: bool, default: False
+        Make the threads wait for a free connection instead of opening
+        extra connections which are closed afterwards
+
+    Returns:
+    --------
+    requests.Session
+    '''
+
+    session = requests.Session()
+
+    if token is not None:
+        session.headers['Authorization'] = token
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.headers['Connection'] = 'keep-alive'
+
+    adapter = TAPAdapter(timeout=timeout, pool_connections=4, pool_maxsize=pool_maxsize, pool_block=pool_block,
+                         max_retries=retry_policy(retries, backoff_factor, backoff_jitter))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    session.hooks['response'].append(raise_on_auth_error)
+
+    # read by `cosmosim_submission.pool_session()`
+    session.pool_maxsize = pool_maxsize
+
+    return session
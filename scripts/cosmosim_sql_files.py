@@ -0,0 +1,299 @@
+'''Submit every `.sql` file of a directory tree as an async job
+
+The query files carry their parameters as `-- KEY = value` comments in their
+header, as in the tutorial:
+
+    -- Radial profile of most massive BDMV (z=0)
+
+    -- LANGUAGE = PostgreSQL
+    -- QUEUE = 1h
+
+    SELECT * FROM bolshoi.bdmvprof
+     ...
+
+The header is parsed once into a `QuerySpec`. The known keys are
+`LANGUAGE` (default: PostgreSQL), `QUEUE` (default: 1m), `RUNID` (default:
+the name of the file) and the chunking hints `CHUNK` (the chunking column),
+`CHUNK_TABLE` and `CHUNK_WHERE`: a query holding a `{chunk}` placeholder and
+a `CHUNK` hint is cut into range chunks fitting its queue (see
+`cosmosim_chunking`). The other keys are kept in `QuerySpec.parameters`.
+
+The files are read lazily while the directories are walked, and submitted
+in batches through the concurrent pool of `cosmosim_submission`. With a
+`cosmosim_ledger.JobLedger`, the files whose query (hashed once normalized)
+was already submitted are skipped, so running the submitter again over the
+same directory only sends the new or modified queries. The chunks of a
+chunked file are recorded one by one: its ranges are planned again, and
+only the chunks missing from the ledger (e.g. failed submissions) are sent.
+
+Example:
+--------
+
+    from cosmosim_ledger import JobLedger
+    from cosmosim_sql_files import submit_sql_files
+
+    results, skipped = submit_sql_files(tap_service, ['queries/'], ledger=JobLedger('jobs.sqlite'))
+'''
+
+import collections
+import fnmatch
+import os
+import re
+
+from cosmosim_ledger import query_hash
+from cosmosim_submission import QUEUE_CONCURRENCY, submit_queries
+
+# A `-- KEY = value` header line
+HEADER_PATTERN = re.compile(r'^--\s*([A-Za-z][\w.-]*)\s*=\s*(.*?)\s*$')
+
+LANGUAGES = {
+    'postgresql': 'PostgreSQL',
+    'adql': 'ADQL',
+}
+
+# Files submitted at once
+BATCH_SIZE = 200
+
+# Parameters of a query file
+QuerySpec = collections.namedtuple('QuerySpec', ['filename', 'runid', 'query', 'language', 'queue', 'chunk',
+                                                 'chunk_table', 'chunk_where', 'parameters', 'query_hash'])
+
+
+def parse_sql_header(text):
+    '''The `-- KEY = value` parameters of the header of a query
+
+    The header is the block of comments and blank lines before the first
+    line of SQL. The keys are upper-cased.
+
+    Returns:
+    --------
+    dict
+    '''
+
+    parameters = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith('--'):
+            break
+
+        match = HEADER_PATTERN.match(line)
+        if match:
+            parameters[match.group(1).upper()] = match.group(2)
+
+    return parameters
+
+
+def parse_sql_file(filename):
+    '''Read a query file into a QuerySpec
+
+    Raises:
+    -------
+    ValueError
+        If the language or queue of the header is unknown
+    '''
+
+    with open(filename, 'r') as fd:
+        query = fd.read()
+
+    parameters = parse_sql_header(query)
+
+    language = parameters.pop('LANGUAGE', 'PostgreSQL')
+    if language.lower() not in LANGUAGES:
+        raise ValueError('unknown LANGUAGE %s' % (language,))
+    language = LANGUAGES[language.lower()]
+
+    queue = parameters.pop('QUEUE', '1m')
+    if queue not in QUEUE_CONCURRENCY:
+        raise ValueError('unknown QUEUE %s' % (queue,))
+
+    runid = parameters.pop('RUNID', None) or os.path.splitext(os.path.basename(filename))[0]
+
+    return QuerySpec(filename, runid, query, language, queue, parameters.pop('CHUNK', None),
+                     parameters.pop('CHUNK_TABLE', None), parameters.pop('CHUNK_WHERE', None), parameters,
+                     query_hash(query, language))
+
+
+def iter_sql_files(paths, pattern='*.sql', recursive=True):
+    '''Yield the query files found in files and directories, in sorted order
+
+    Parameters:
+    -----------
+    paths: list(str)
+        Files and directories
+
+    pattern: str, default: *.sql
+        The pattern of the names of the query files
+
+    recursive: bool, default: True
+        Walk the sub-directories too
+    '''
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, directories, files in os.walk(path):
+            directories.sort()
+            if not recursive:
+                del directories[:]
+            for name in sorted(fnmatch.filter(files, pattern)):
+                yield os.path.join(root, name)
+
+
+def iter_query_specs(paths, pattern='*.sql', recursive=True, errors=None):
+    '''Yield the QuerySpec of the query files found in `paths`
+
+    The files whose header is invalid are skipped, and appended as
+    (filename, message) to the list `errors` if given.
+    '''
+
+    for filename in iter_sql_files(paths, pattern=pattern, recursive=recursive):
+        try:
+            yield parse_sql_file(filename)
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            if errors is None:
+                raise
+            errors.append((filename, str(e)))
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def spec_queries(tap_service, spec):
+    '''The (name, query, queue, language) of the jobs of a query file
+
+    Queries with a `{chunk}` placeholder and a `CHUNK` hint give one job per
+    range chunk (named `<runid>_0000`, ...), the others a single job.
+    '''
+
+    if not spec.chunk or '{chunk}' not in spec.query:
+        return [(spec.runid, spec.query, spec.queue, spec.language)]
+
+    from cosmosim_chunking import Chunk, chunk_queries, plan_ranges, rows_per_chunk, sample_distribution
+
+    if not spec.chunk_table:
+        raise ValueError('CHUNK needs a CHUNK_TABLE')
+
+    max_rows = rows_per_chunk(spec.queue)
+    distribution = sample_distribution(tap_service, spec.chunk_table, spec.chunk, where=spec.chunk_where,
+                                       max_bin_rows=max_rows // 2, lang=spec.language)
+    ranges = plan_ranges(distribution, max_rows)
+    chunks = [Chunk('%s_%04d' % (spec.runid, i), low, high, i == len(ranges) - 1)
+              for i, (low, high) in enumerate(ranges)]
+
+    return [(name, query, spec.queue, spec.language) for name, query in chunk_queries(spec.query, spec.chunk, chunks)]
+
+
+def submit_sql_files(tap_service, paths, ledger=None, pattern='*.sql', recursive=True, concurrency=None,
+                     batch_size=BATCH_SIZE, force=False, dry_run=False):
+    '''Submit the query files found in files and directories
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service to which the queries will be submitted
+
+    paths: list(str)
+        Query files and directories holding query files
+
+    ledger: cosmosim_ledger.JobLedger, default: None
+        Record the submitted jobs, and skip the queries already recorded
+
+    pattern: str, default: *.sql
+        The pattern of the names of the query files
+
+    recursive: bool, default: True
+        Walk the sub-directories too
+
+    concurrency: dict, default: QUEUE_CONCURRENCY
+        The maximum number of submissions running at the same time per queue
+
+    batch_size: int, default: BATCH_SIZE
+        The number of files read and submitted at once
+
+    force: bool, default: False
+        Submit the queries already recorded in the ledger too
+
+    dry_run: bool, default: False
+        Only parse the files and report what would be submitted
+
+    Returns:
+    --------
+    (list(SubmissionResult), list(QuerySpec))
+        The result of each submission, and the files skipped (already
+        submitted, or invalid: their `query_hash` is None)
+    '''
+
+    results = []
+    skipped = []
+    seen = set()
+    errors = []
+
+    for batch in _batches(iter_query_specs(paths, pattern=pattern, recursive=recursive, errors=errors), batch_size):
+
+        known = ledger.known_hashes(spec.query_hash for spec in batch) if ledger is not None and not force else set()
+
+        queries = []
+        # the hash of each query, in the order of `queries` (runids need not be unique)
+        hashes = []
+        for spec in batch:
+            # the same query twice in the tree is sent once
+            if spec.query_hash in known or spec.query_hash in seen:
+                skipped.append(spec)
+                continue
+            seen.add(spec.query_hash)
+
+            if dry_run:
+                print('> Query : %s (%s, %s)' % (spec.runid, spec.language, spec.queue))
+                continue
+
+            try:
+                spec_jobs = spec_queries(tap_service, spec)
+            except Exception as e:
+                errors.append((spec.filename, str(e)))
+                continue
+
+            if len(spec_jobs) == 1 and spec_jobs[0][1] == spec.query:
+                job_hashes = [spec.query_hash]
+            else:
+                # each chunk is recorded with its own hash: only the chunks
+                # missing from the ledger are sent (again)
+                job_hashes = [query_hash(query, language) for name, query, queue, language in spec_jobs]
+                done = ledger.known_hashes(job_hashes) if ledger is not None and not force else set()
+                pending = [(job, job_hash) for job, job_hash in zip(spec_jobs, job_hashes) if job_hash not in done]
+                if not pending:
+                    skipped.append(spec)
+                    continue
+                spec_jobs, job_hashes = [job for job, job_hash in pending], [job_hash for job, job_hash in pending]
+
+            queries.extend(spec_jobs)
+            hashes.extend(job_hashes)
+
+        if not queries:
+            continue
+
+        batch_results = submit_queries(tap_service, queries, concurrency=concurrency)
+        results.extend(batch_results)
+
+        # the jobs are recorded with the hash of their file, or of their chunk
+        if ledger is not None:
+            ledger.record_submissions([{'url': result.url, 'runid': result.runid, 'queue': result.queue,
+                                        'query_hash': query_hash}
+                                       for result, query_hash in zip(batch_results, hashes) if result.error is None])
+
+    for filename, message in errors:
+        print('SKIPPED %s: %s' % (filename, message))
+        skipped.append(QuerySpec(filename, None, None, None, None, None, None, None, {}, None))
+
+    return results, skipped
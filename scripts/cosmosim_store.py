@@ -0,0 +1,339 @@
+'''Local store of simulation extracts, opened as memory-mapped columns
+
+Analyses often read the same slices of `mdr1.bdmv`, `bolshoi.bdmvprof` or
+`mdr1.fofmtree` again and again, and parse the same VOTables on every run.
+`ExtractStore` keeps each extract as a directory of fixed-width binary
+columns (one `.npy` file per column, a `.mask.npy` file for the columns
+holding nulls) and a `meta.json` file with the query, units and UCDs:
+
+    <directory>/<name>/meta.json
+    <directory>/<name>/mvir.npy
+    <directory>/<name>/x.npy
+    ...
+
+The columns are opened with `numpy.load(mmap_mode='r')`: nothing is parsed
+nor copied, only the pages actually read are loaded, and the processes
+of a node opening the same extract share these pages in the page cache.
+
+Example:
+--------
+
+    from cosmosim_store import ExtractStore
+
+    store = ExtractStore('~/extracts')
+    extract = store.extract(tap_service, query, language='PostgreSQL', name='bdmv_z0', queue='1m')
+
+    mvir = extract['Mvir']                  # numpy.memmap, no copy
+    table = extract.to_table()              # astropy Table over the memory maps
+'''
+
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import numpy as np
+
+# pyvo is imported by the functions using it: opening the store does not need it
+from cosmosim_cache import cache_key
+from cosmosim_fetch import CHUNK_SIZE, stream_result
+
+META_FILENAME = 'meta.json'
+
+# The error status of a sync query
+QUERY_ERROR = re.compile(rb'<INFO[^>]*name="QUERY_STATUS"[^>]*value="ERROR"[^>]*>(.*?)</INFO>', re.DOTALL)
+
+# Version of the layout of the extracts
+LAYOUT_VERSION = 1
+
+
+class Extract(object):
+    '''An extract of the store: its columns are opened as read-only memory maps
+
+    Parameters:
+    -----------
+    path: str
+        The directory of the extract
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILENAME), 'r') as fd:
+            self.meta = json.load(fd)
+
+        self.columns = [column['name'] for column in self.meta['columns']]
+        self._columns = {column['name']: column for column in self.meta['columns']}
+        self._maps = {}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, name):
+        '''The values of a column: a numpy.memmap, or a masked array over memory maps for nulls'''
+
+        if name not in self._maps:
+            if name not in self._columns:
+                raise KeyError(name)
+
+            column = self._columns[name]
+            values = np.load(os.path.join(self.path, column['file']), mmap_mode='r')
+            if column.get('mask'):
+                mask = np.load(os.path.join(self.path, column['mask']), mmap_mode='r')
+                values = np.ma.MaskedArray(values, mask=mask, copy=False)
+            self._maps[name] = values
+
+        return self._maps[name]
+
+    def keys(self):
+        return list(self.columns)
+
+    def to_table(self, columns=None):
+        '''An astropy Table over the memory maps of the columns (no copy)'''
+
+        from astropy.table import Column, MaskedColumn, Table
+
+        table = Table()
+        for name in columns or self.columns:
+            values = self[name]
+            column = self._columns[name]
+            keywords = dict(name=name, unit=column.get('unit'), description=column.get('description'), copy=False)
+            if isinstance(values, np.ma.MaskedArray):
+                table.add_column(MaskedColumn(values.data, mask=values.mask, **keywords), copy=False)
+            else:
+                table.add_column(Column(values, **keywords), copy=False)
+            if column.get('ucd'):
+                table[name].meta['ucd'] = column['ucd']
+
+        table.meta.update(query=self.meta.get('query'), language=self.meta.get('language'))
+        return table
+
+
+class ExtractStore(object):
+    '''A directory of extracts stored as memory-mappable columns
+
+    Parameters:
+    -----------
+    directory: str
+        The directory of the store
+    '''
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, name):
+        '''The directory of an extract'''
+        if not name or os.sep in name or name.startswith('.'):
+            raise ValueError('Invalid extract name %r' % (name,))
+        return os.path.join(self.directory, name)
+
+    def names(self):
+        '''The names of the stored extracts'''
+        return sorted(name for name in os.listdir(self.directory)
+                      if not name.endswith(('.tmp', '.old')) and os.path.isfile(os.path.join(self.directory, name, META_FILENAME)))
+
+    def __contains__(self, name):
+        return os.path.isfile(os.path.join(self.path(name), META_FILENAME))
+
+    def open(self, name):
+        '''Open a stored extract
+
+        Returns:
+        --------
+        Extract
+        '''
+
+        if name not in self:
+            raise KeyError(name)
+        return Extract(self.path(name))
+
+    def remove(self, name):
+        '''Remove an extract (the processes having it open keep reading their maps)'''
+        shutil.rmtree(self.path(name), ignore_errors=True)
+
+    def put(self, name, table, **meta):
+        '''Store a table as an extract, replacing the extract of the same name
+
+        The columns are written in a temporary directory renamed at the end,
+        so that readers never see a partial extract.
+
+        Parameters:
+        -----------
+        name: str
+            The name of the extract
+
+        table: astropy.table.Table
+            The data; string columns are stored with the width of their
+            longest value
+
+        meta:
+            Extra entries of `meta.json` (e.g. `query`, `language`)
+
+        Returns:
+        --------
+        Extract
+        '''
+
+        path = self.path(name)
+        staging = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        os.makedirs(staging)
+
+        try:
+            columns = []
+            for column in table.columns.values():
+                values = np.ma.getdata(column)
+                if values.dtype.kind == 'O':
+                    values = values.astype(str)
+                entry = {'name': column.name, 'file': '%s.npy' % (_file_name(column.name, len(columns)),),
+                         'dtype': values.dtype.str, 'unit': str(column.unit) if column.unit is not None else None,
+                         'ucd': column.meta.get('ucd'), 'description': column.description or None}
+
+                np.save(os.path.join(staging, entry['file']), np.ascontiguousarray(values))
+
+                mask = np.ma.getmaskarray(column) if hasattr(column, 'mask') else None
+                if mask is not None and mask.any():
+                    entry['mask'] = '%s.mask.npy' % (_file_name(column.name, len(columns)),)
+                    np.save(os.path.join(staging, entry['mask']), mask)
+
+                columns.append(entry)
+
+            meta = dict(meta, name=name, rows=len(table), columns=columns, created=time.time(),
+                        layout=LAYOUT_VERSION)
+            with open(os.path.join(staging, META_FILENAME), 'w') as fd:
+                json.dump(meta, fd, indent=1)
+
+            # swap the directories: the previous extract is removed once replaced
+            previous = None
+            if os.path.exists(path):
+                previous = staging + '.old'
+                os.rename(path, previous)
+            os.rename(staging, path)
+            if previous is not None:
+                shutil.rmtree(previous, ignore_errors=True)
+
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        return Extract(path)
+
+    def put_votables(self, name, filenames, order_by=None, **meta):
+        '''Store VOTable results (e.g. the chunks of a query) as one extract
+
+        The files are merged with `cosmosim_merge.merge_chunks()`.
+        '''
+
+        from cosmosim_merge import merge_chunks
+
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        return self.put(name, merge_chunks(filenames, order_by=order_by), **meta)
+
+    def extract(self, tap_service, query, language='PostgreSQL', name=None, queue=None, refresh=False):
+        '''The extract of a query, run on the service only if not stored yet
+
+        Parameters:
+        -----------
+        tap_service: pyvo.dal.tap.TAPService
+            The TAP service
+
+        query: str
+            The query of the extract
+
+        language: str, default: PostgreSQL
+            The query language
+
+        name: str, default: None
+            The name of the extract (default: the cache key of the query); a
+            stored extract of this name made by another query is replaced
+
+        queue: str, default: None
+            Run the query as an async job in this queue (a sync query if None)
+
+        refresh: bool, default: False
+            Run the query again even if its extract is stored
+
+        Returns:
+        --------
+        Extract
+        '''
+
+        key = cache_key(tap_service.baseurl, query, language)
+        name = name or key
+
+        if not refresh and name in self:
+            extract = self.open(name)
+            if extract.meta.get('key') == key:
+                return extract
+
+        filename = os.path.join(self.directory, '.%s.%d.%d.xml' % (name, os.getpid(), threading.get_ident()))
+        try:
+            download_query(tap_service, query, filename, language=language, queue=queue)
+            return self.put_votables(name, filename, order_by=query, key=key, query=query, language=language,
+                                     service=tap_service.baseurl)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def _file_name(name, index):
+    '''A file name for a column, safe whatever its name'''
+    safe = ''.join(character if character.isalnum() or character in '_-' else '_' for character in name)
+    return '%03d_%s' % (index, safe)
+
+
+def download_query(tap_service, query, filename, language='PostgreSQL', queue=None, maxrec=None, timeout=600,
+                   **keywords):
+    '''Run a query and stream its VOTable result to a file
+
+    With a queue the query is run as an async job, waited for and fetched;
+    otherwise as a sync query, whose response is streamed to the file.
+
+    Parameters:
+    -----------
+    maxrec: int, default: None
+        The maximum number of rows of the result
+
+    timeout: float or (float, float), default: 600
+        The timeout of the sync request, see `requests`
+
+    keywords:
+        Other parameters of the query
+
+    Raises:
+    -------
+    pyvo.dal.DALQueryError
+        If the query failed (the file holds the error document)
+    '''
+
+    import pyvo
+
+    session = tap_service._session
+
+    if queue is None:
+        data = dict(keywords, REQUEST='doQuery', LANG=language, QUERY=query)
+        if maxrec:
+            data['MAXREC'] = maxrec
+        with session.post(tap_service.baseurl + '/sync', data=data, stream=True, timeout=timeout) as response:
+            with open(filename, 'wb') as fd:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    fd.write(chunk)
+
+        # errors of sync queries come as a VOTable with an error status
+        with open(filename, 'rb') as fd:
+            match = QUERY_ERROR.search(fd.read(64 * 1024))
+        if match:
+            raise pyvo.dal.DALQueryError(match.group(1).decode('utf-8', 'replace').strip() or 'Query failed')
+        response.raise_for_status()
+        return
+
+    job = tap_service.submit_job(query, language=language, queue=queue, maxrec=maxrec, **keywords)
+    job.run()
+    job.wait(phases=['COMPLETED', 'ERROR', 'ABORTED'])
+    job.raise_if_error()
+    stream_result(session, job.url, filename)
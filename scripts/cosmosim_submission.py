@@ -0,0 +1,197 @@
+'''Concurrent submission of TAP queries to www.cosmosim.org
+
+The `submit_queries()` function of the tutorial sends the queries one after
+another, so every query waits for the full set of HTTP round trips
+(create, fetch job, run) of the previous one. The `submit_queries()` function
+of this module sends them through a bounded pool of threads sharing the
+connection pool of the `requests.Session` of the TAP service.
+
+Example:
+--------
+
+    from cosmosim_submission import submit_queries
+
+    queries = [('mvir_%d' % i, query % (low, high)) for i, (low, high) in enumerate(ranges)]
+    results = submit_queries(tap_service, queries, lang='PostgreSQL', queue='1m')
+
+    failed = [result for result in results if result.error]
+'''
+
+import collections
+import concurrent.futures
+import threading
+
+import requests
+
+#
+# Maximum number of jobs submitted at the same time to each queue
+#
+QUEUE_CONCURRENCY = {
+    '1m': 8,
+    '1h': 4,
+    '5h': 2,
+}
+
+# Structured outcome of the submission of one query
+SubmissionResult = collections.namedtuple('SubmissionResult', ['name', 'queue', 'url', 'runid', 'error'])
+
+
+# Serializes the resizing of the connection pools of the sessions
+_POOL_LOCK = threading.Lock()
+
+
+def pool_session(session, maxsize):
+    '''Make sure the session can keep `maxsize` connections alive per host
+
+    The sessions of `cosmosim_session.tap_session()` are sized when they
+    are built, and usually left as they are. A smaller session gets new
+    adapters with the larger pool: the adapters in use by other threads
+    are left alone, with their connections.
+
+    Parameters:
+    -----------
+    session: requests.Session
+        The session shared by the TAP service and its jobs
+
+    maxsize: int
+        The number of connections used at the same time
+    '''
+
+    with _POOL_LOCK:
+        if getattr(session, 'pool_maxsize', requests.adapters.DEFAULT_POOLSIZE) >= maxsize:
+            return
+
+        from cosmosim_session import TAPAdapter
+
+        resized = {}
+        for prefix in ('https://', 'http://'):
+            adapter = session.get_adapter(prefix)
+            if id(adapter) not in resized:
+                if isinstance(adapter, TAPAdapter):
+                    resized[id(adapter)] = adapter.resized(maxsize)
+                else:
+                    resized[id(adapter)] = requests.adapters.HTTPAdapter(
+                        pool_maxsize=maxsize, max_retries=getattr(adapter, 'max_retries', 0))
+            session.mount(prefix, resized[id(adapter)])
+
+        session.pool_maxsize = maxsize
+
+
+def submit_query(tap_service, name, query, lang='PostgreSQL', queue='1m'):
+    '''Create and run one async job
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service to which the query will be submitted
+
+    name: str
+        The runid of the job
+
+    query: str
+        The query string
+
+    lang: str, default: PostgreSQL
+        The language in which the query is written
+
+    queue: str, default: 1m
+        The name of the queue to use
+
+    Returns:
+    --------
+    SubmissionResult
+        The url and runid of the job, `error` is None on success
+    '''
+
+    # Create the async job
+    try:
+        job = tap_service.submit_job(query, language=lang, runid=name, queue=queue)
+    except Exception as e:
+        return SubmissionResult(name, queue, None, name, 'could not create the job: %s' % (e,))
+
+    # Run the job
+    try:
+        job.run()
+    except Exception as e:
+        return SubmissionResult(name, queue, job.url, name, 'could not run the job: %s' % (e,))
+
+    return SubmissionResult(name, queue, job.url, job.job.runid or name, None)
+
+
+def submit_queries(tap_service, queries, lang='PostgreSQL', queue='1m', concurrency=None,
+                   urls_filename=None, ledger=None):
+    '''Submit a serie of tap queries concurrently
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service to which the queries will be submitted
+
+    queries: list(tuple)
+        A list consisting of (query_name, query_string) pairs, of
+        (query_name, query_string, queue) triples to mix queues, or of
+        (query_name, query_string, queue, lang) to mix languages as well
+
+    lang: str, default: PostgreSQL
+        The language of the queries which do not give one
+
+    queue: str, default: 1m
+        The name of the queue of the queries which do not give one
+
+    concurrency: dict, default: QUEUE_CONCURRENCY
+        The maximum number of submissions running at the same time per queue
+
+    urls_filename: str, default: None
+        If given, the urls of the submitted jobs are written to this file
+        (for later retrieval with `fetch_results_of_complete_jobs`)
+
+    ledger: cosmosim_ledger.JobLedger, default: None
+        If given, the submitted jobs are recorded in the ledger
+
+    Returns:
+    --------
+    list(SubmissionResult)
+        One result per query, in the order of `queries`
+    '''
+
+    limits = dict(QUEUE_CONCURRENCY)
+    limits.update(concurrency or {})
+
+    # normalize the queries into (name, query, queue, lang)
+    queries = [tuple(item) + (queue, lang)[len(item) - 2:] for item in queries]
+    if not queries:
+        return []
+
+    # one semaphore per queue bounds the jobs submitted at the same time
+    used_queues = sorted(set(item[2] for item in queries))
+    semaphores = {name: threading.BoundedSemaphore(limits.get(name, 1)) for name in used_queues}
+    max_workers = sum(limits.get(name, 1) for name in used_queues)
+
+    # all threads share the connection pool of the service session
+    pool_session(tap_service._session, max_workers)
+
+    def submit(name, query, job_queue, job_lang):
+        with semaphores[job_queue]:
+            return submit_query(tap_service, name, query, lang=job_lang, queue=job_queue)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(submit, *item) for item in queries]
+        results = [future.result() for future in futures]
+
+    # Save the submitted jobs into a file
+    if urls_filename is not None:
+        with open(urls_filename, 'a') as fd:
+            for result in results:
+                if result.error is None:
+                    fd.write(result.url + '\n')
+
+    # Record the submitted jobs in the ledger
+    if ledger is not None:
+        from cosmosim_ledger import query_hash
+
+        ledger.record_submissions([{'url': result.url, 'runid': result.runid, 'queue': result.queue,
+                                    'query_hash': query_hash(query, job_lang)}
+                                   for result, (name, query, job_queue, job_lang) in zip(results, queries)
+                                   if result.error is None])
+
+    return results
@@ -25,16 +25,14 @@
 #
 # It is useful to always print the version of pyvo you are using. Most of non-working scripts fail because of an old version of `pyvo`.
 
-from pkg_resources import parse_version
-import pyvo
+from cosmosim_client import check_version
 
 #
-# Verify the version of pyvo
+# Verify the version of pyvo (without importing it)
 #
-if parse_version(pyvo.__version__) < parse_version('1.0'):
-    raise ImportError('pyvo version must be at least than 1.0')
+pyvo_version = check_version('pyvo', '1.0')
 
-print('\npyvo version %s \n' % (pyvo.__version__,))
+print('\npyvo version %s \n' % (pyvo_version,))
 # # Authentication
 # ---
 #
@@ -50,8 +48,7 @@ print('\npyvo version %s \n' % (pyvo.__version__,))
 #
 # The connection to the TAP service can be done that way:
 
-import requests
-import pyvo
+from cosmosim_client import connect
 
 #
 # Setup tap_service connection
@@ -62,11 +59,9 @@ token = 'Token <your-token>'
 
 print('TAP service %s \n' % (service_name,))
 
-# Setup authorization
-tap_session = requests.Session()
-tap_session.headers['Authorization'] = token
-
-tap_service = pyvo.dal.TAPService(url, session=tap_session)
+# Setup authorization: pyvo is only imported when a query is run
+tap_service = connect(url, token)
+tap_session = tap_service.session
 # ## List of file queries
 #
 # Sometimes it is useful to just send all `.sql` queries present in a directory. For such purpose you can use comments to provide the proper parameters.
@@ -86,51 +81,28 @@ tap_service = pyvo.dal.TAPService(url, session=tap_session)
 #  ORDER BY rbin
 # ```
 #
-# The `language` and `queue` are prescibed as comments. The query can then be submitted in a script like the following:
+# The `language` and `queue` are prescibed as comments. The `runid` defaults to the name of the file (`-- RUNID = ...` overrides it), and a query with a `{chunk}` placeholder is cut into chunks with `-- CHUNK = <column>` and `-- CHUNK_TABLE = <table>`. The queries can then be submitted in a script like the following:
 
-import glob
+from cosmosim_ledger import JobLedger
+from cosmosim_sql_files import submit_sql_files
 
 #
-# Submit the query as an Asynchrone job
+# Submit the queries as Asynchrone jobs
 #
 
-# find all .sql files in current directory
-queries_filename = sorted(glob.glob('./*.sql'))
-print('Sending %d examples' % (len(queries_filename),))
-
-# initialize test results
-jobs = []
-failed =  []
-
-# send all queries
-for query_filename in queries_filename:
-
-    # read the .SQL file
-    with open(query_filename, 'r') as fd:
-        query = ' '.join(fd.readlines())
-
-    # Set language from comments (default: PostgreSQL)
-    if 'LANGUAGE = ADQL' in query:
-        lang = 'ADQL'
-    else:
-        lang = 'PostgreSQL'
+# the ledger remembers the submitted queries: running the script again only
+# sends the new or modified .sql files
+ledger = JobLedger('jobs.sqlite')
 
-    # Set queue from comments (default: 1m)
-    if 'QUEUE = 5h' in query:
-        queue = "5h"
-    elif 'QUEUE = 1h' in query:
-        queue = "1h"
-    elif 'QUEUE = 1m' in query:
-        queue = "1m"
-    else:
-        queue = "1m"
+# find all .sql files in the current directory (and below), and send them concurrently
+results, skipped = submit_sql_files(tap_service, ['.'], ledger=ledger)
 
+jobs = [result for result in results if result.error is None]
+failed = [result for result in results if result.error is not None]
 
-    # Set the runid from sql filename
-    base = os.path.basename(query_filename)
-    runid = os.path.splitext(base)[0]
-    
-    print('\n> Query : %s\n%s\n' % (runid, query))
+print('Sent %d jobs, %d failed, %d files skipped' % (len(jobs), len(failed), len(skipped)))
+for result in failed:
+    print('\n> Query : %s\n%s\n' % (result.name, result.error))
 
 # The rest of the submission process and retrieval can be done in any manner. An example 
 # can be found here: [cosmosim-tutorial-from-files.py](files/cosmosim-tutorial-from-files.py)
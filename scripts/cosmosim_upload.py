@@ -0,0 +1,364 @@
+'''Server-side joins against local lists of IDs, through TAP table uploads
+
+To read the rows of a local list of `bdmid` or `foftreeid`, the only way
+shown in the tutorial is to write the IDs in the query, `WHERE bdmid IN
+(...)`: large lists make huge queries, slow to send and to parse, and
+have to be cut into hundreds of jobs. `run_upload_query()` instead uploads
+the IDs as a table (`TAP_UPLOAD.<name>`) with the job, and the query joins
+against it:
+
+- the IDs (numpy array, pandas Series, list) are deduplicated and written
+  as a compact VOTable, one BINARY column encoded in base64 block by block,
+- the upload is streamed from the file with the job creation request,
+- lists larger than the upload limit of the service (read from its
+  capabilities) are cut into several uploads, one job each, whose results
+  are merged with `cosmosim_merge.merge_chunks()`.
+
+The query is written with a placeholder:
+
+- `{ids}` is replaced by `(SELECT id FROM TAP_UPLOAD.ids)`, to use in
+  place of an inline list: `WHERE bdmid IN {ids}`,
+- `{upload}` is replaced by `TAP_UPLOAD.ids`, for an explicit join.
+
+Example:
+--------
+
+    from cosmosim_upload import run_upload_query
+
+    query = \'\'\'
+    SELECT b.bdmid, b.mvir, b.rvir
+      FROM mdr1.bdmv AS b
+      JOIN {upload} AS u ON b.bdmid = u.id
+    \'\'\'
+    table, filenames = run_upload_query(tap_service, query, bdmids, language='PostgreSQL', queue='1m')
+'''
+
+import base64
+import concurrent.futures
+import os
+import re
+import urllib.parse
+
+import numpy as np
+
+from cosmosim_fetch import stream_result
+from cosmosim_merge import merge_chunks
+from cosmosim_poller import JobPoller
+
+# The IDs of one upload, if the service gives no upload limit
+UPLOAD_ROWS = 1000000
+
+# Fraction of the upload limit of the service used
+UPLOAD_SAFETY = 0.9
+
+# Rows encoded at once (a multiple of 3, so that the base64 blocks can be concatenated)
+BLOCK_ROWS = 3 * 65536
+
+# Bytes sent at once
+CHUNK_SIZE = 1024 * 1024
+
+# The upload method of files sent with the request
+INLINE_UPLOAD = 'ivo://ivoa.net/std/TAPRegExt#upload-inline'
+
+# VOTable datatypes of the supported numpy kinds and sizes
+DATATYPES = {
+    ('i', 2): 'short',
+    ('i', 4): 'int',
+    ('i', 8): 'long',
+    ('f', 4): 'float',
+    ('f', 8): 'double',
+}
+
+VOTABLE_HEAD = '''<?xml version="1.0" encoding="UTF-8"?>
+<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">
+<RESOURCE type="results">
+<TABLE name="{name}">
+<FIELD name="{column}" datatype="{datatype}"/>
+<DATA><BINARY><STREAM encoding="base64">
+'''
+
+VOTABLE_TAIL = '''</STREAM></BINARY></DATA>
+</TABLE>
+</RESOURCE>
+</VOTABLE>
+'''
+
+
+def id_array(ids, unique=True):
+    '''The IDs as a numpy array of a VOTable datatype, without masked values
+
+    Parameters:
+    -----------
+    ids: numpy.ndarray, pandas.Series, list
+        The IDs
+
+    unique: bool, default: True
+        Remove the duplicates (and sort the IDs)
+
+    Returns:
+    --------
+    numpy.ndarray
+        The IDs, as 32 bits integers if they fit
+    '''
+
+    values = np.ma.compressed(np.ma.asarray(ids)) if np.ma.isMaskedArray(ids) else np.asarray(ids)
+    values = values.ravel()
+
+    if values.dtype.kind == 'u':
+        values = values.astype(np.int64)
+    elif values.dtype.kind == 'i' and values.dtype.itemsize == 1:
+        values = values.astype(np.int16)
+    elif values.dtype.kind == 'f' and values.dtype.itemsize == 2:
+        values = values.astype(np.float32)
+    if (values.dtype.kind, values.dtype.itemsize) not in DATATYPES:
+        raise ValueError('IDs of type %s can not be uploaded, use integers or floats' % (values.dtype,))
+
+    if values.dtype.kind == 'f':
+        values = values[np.isfinite(values)]
+    if unique:
+        values = np.unique(values)
+
+    # 4 bytes per ID when they fit
+    info = np.iinfo(np.int32)
+    if values.dtype.kind == 'i' and values.dtype.itemsize == 8 and len(values) and \
+            info.min <= values.min() and values.max() <= info.max:
+        values = values.astype(np.int32)
+
+    return values
+
+
+def write_id_votable(ids, filename, name='ids', column='id'):
+    '''Write IDs as a one-column BINARY VOTable
+
+    Returns:
+    --------
+    int
+        The size of the file in bytes
+    '''
+
+    datatype = DATATYPES[(ids.dtype.kind, ids.dtype.itemsize)]
+    big_endian = ids.astype(ids.dtype.newbyteorder('>'), copy=False)
+
+    with open(filename, 'wb') as fd:
+        fd.write(VOTABLE_HEAD.format(name=name, column=column, datatype=datatype).encode('utf-8'))
+        for start in range(0, len(big_endian), BLOCK_ROWS):
+            fd.write(base64.b64encode(big_endian[start:start + BLOCK_ROWS].tobytes()))
+            fd.write(b'\n')
+        fd.write(VOTABLE_TAIL.encode('utf-8'))
+        return fd.tell()
+
+
+def upload_limit(tap_service):
+    '''The upload methods and limit of the service, from its capabilities
+
+    Returns:
+    --------
+    (list(str), (int, str))
+        The ivo-ids of the upload methods (None if unknown), and the upload
+        limit and its unit, `row` or `byte` (None if unknown)
+    '''
+
+    try:
+        if hasattr(tap_service, 'capabilities_summary'):
+            summary = tap_service.capabilities_summary()
+            return summary['upload_methods'], summary['upload_limit']
+
+        capability = tap_service.get_tap_capability()
+        methods = [method.ivo_id for method in capability.uploadmethods]
+        limit = capability.uploadlimit.hard or capability.uploadlimit.default if capability.uploadlimit else None
+        return methods, (int(limit.content), limit.unit or 'row') if limit is not None else None
+    except Exception:
+        return None, None
+
+
+def upload_rows(tap_service, itemsize, max_rows=None):
+    '''The number of IDs of one upload, within the upload limit of the service'''
+
+    methods, limit = upload_limit(tap_service)
+    if methods is not None and INLINE_UPLOAD not in methods:
+        raise ValueError('The service %s does not accept uploaded tables' % (tap_service.baseurl,))
+
+    rows = max_rows or UPLOAD_ROWS
+    if limit is not None:
+        value, unit = limit
+        if unit == 'byte':
+            # base64: 4 characters per 3 bytes
+            value = (value - len(VOTABLE_HEAD) - len(VOTABLE_TAIL) - 256) * 3 // 4 // itemsize
+        rows = min(rows, max(1, int(value * UPLOAD_SAFETY)))
+
+    return rows
+
+
+def upload_query(query, name='ids', column='id'):
+    '''Replace the `{ids}` and `{upload}` placeholders of a query'''
+
+    if '{ids}' not in query and '{upload}' not in query and not re.search(r'\bTAP_UPLOAD\.', query, re.IGNORECASE):
+        raise ValueError('The query has no {ids} nor {upload} placeholder')
+
+    return (query.replace('{ids}', '(SELECT %s FROM TAP_UPLOAD.%s)' % (column, name))
+                 .replace('{upload}', 'TAP_UPLOAD.%s' % (name,)))
+
+
+class _MultipartBody(object):
+    '''A multipart/form-data body streaming a file, with a known length'''
+
+    def __init__(self, fields, name, filename, boundary):
+        self.filename = filename
+
+        head = []
+        for key, value in fields.items():
+            head.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, key, value))
+        head.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s.xml"\r\n'
+                    'Content-Type: application/x-votable+xml\r\n\r\n' % (boundary, name, name))
+        self.head = ''.join(head).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % (boundary,)).encode('utf-8')
+
+    def __len__(self):
+        return len(self.head) + os.path.getsize(self.filename) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.filename, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+                yield chunk
+        yield self.tail
+
+
+def submit_upload_job(tap_service, query, filename, name='ids', language='PostgreSQL', runid=None, queue='1m'):
+    '''Create and run an async job with an uploaded table, streamed from a file
+
+    Returns:
+    --------
+    str
+        The url of the job
+    '''
+
+    fields = {'REQUEST': 'doQuery', 'LANG': language, 'QUERY': query, 'QUEUE': queue,
+              'UPLOAD': '%s,param:%s' % (name, name)}
+    if runid is not None:
+        fields['RUNID'] = runid
+
+    boundary = 'cosmosim-%s' % (os.urandom(12).hex(),)
+    session = tap_service._session
+    response = session.post(tap_service.baseurl + '/async', data=_MultipartBody(fields, name, filename, boundary),
+                            headers={'Content-Type': 'multipart/form-data; boundary=%s' % (boundary,)},
+                            allow_redirects=False)
+    response.raise_for_status()
+
+    location = response.headers.get('Location')
+    if not location:
+        raise IOError('The service did not return the url of the job (HTTP %d)' % (response.status_code,))
+    job_url = urllib.parse.urljoin(response.url, location)
+
+    session.post(job_url + '/phase', data={'PHASE': 'RUN'}, allow_redirects=False).raise_for_status()
+    return job_url
+
+
+def run_upload_query(tap_service, query, ids, language='PostgreSQL', queue='1m', name='upload', directory='.',
+                     table_name='ids', column='id', unique=True, max_rows=None, poller=None, output=None):
+    '''Run a query joined against a local list of IDs uploaded with the job
+
+    Parameters:
+    -----------
+    tap_service: pyvo.dal.tap.TAPService
+        The TAP service
+
+    query: str
+        The query, with an `{ids}` or `{upload}` placeholder (see the module
+        documentation)
+
+    ids: numpy.ndarray, pandas.Series, list
+        The IDs
+
+    language: str, default: PostgreSQL
+        The query language
+
+    queue: str, default: 1m
+        The queue of the jobs
+
+    name: str, default: upload
+        The prefix of the runids of the jobs and of their files
+
+    directory: str, default: .
+        Where the uploads and the results of the jobs are written
+
+    table_name: str, default: ids
+        The name of the uploaded table (`TAP_UPLOAD.<table_name>`)
+
+    column: str, default: id
+        The name of the column of the uploaded table
+
+    unique: bool, default: True
+        Remove the duplicated IDs before the upload
+
+    max_rows: int, default: None
+        The maximum number of IDs of one upload (default: UPLOAD_ROWS,
+        within the upload limit of the service)
+
+    poller: cosmosim_poller.JobPoller, default: None
+        The poller used to wait for the jobs (a new one by default)
+
+    output: str, default: None
+        Write the merged result to this file (see `cosmosim_merge.merge_chunks()`)
+
+    Returns:
+    --------
+    (astropy.table.Table, list(str))
+        The merged result, and the filenames of the results of the jobs
+    '''
+
+    query = upload_query(query, table_name, column)
+    values = id_array(ids, unique=unique)
+    if not len(values):
+        raise ValueError('No ID to upload')
+
+    rows = upload_rows(tap_service, values.dtype.itemsize, max_rows)
+    parts = ['%s_%04d' % (name, i) for i in range(0, (len(values) + rows - 1) // rows)]
+    print('Uploading %d IDs in %d tables' % (len(values), len(parts)))
+
+    session = tap_service._session
+    own_poller = poller is None
+    if own_poller:
+        poller = JobPoller(session, tap_service=tap_service).start()
+
+    filenames = {}
+    pending = {}
+    failed = []
+
+    try:
+        for i, part in enumerate(parts):
+            upload_filename = os.path.join(directory, '.%s.%s.xml' % (part, table_name))
+            try:
+                write_id_votable(values[i * rows:(i + 1) * rows], upload_filename, table_name, column)
+                job_url = submit_upload_job(tap_service, query, upload_filename, table_name, language=language,
+                                            runid=part, queue=queue)
+            except Exception as e:
+                failed.append((part, 'could not submit the job: %s' % (e,)))
+                continue
+            finally:
+                if os.path.exists(upload_filename):
+                    os.remove(upload_filename)
+
+            pending[poller.track(job_url, queue=queue)] = part
+            print('JOB %s: submitted with %d IDs' % (part, len(values[i * rows:(i + 1) * rows])))
+
+        for future in concurrent.futures.as_completed(pending):
+            part = pending[future]
+            job_url, phase = future.result()
+            if phase != 'COMPLETED':
+                failed.append((part, phase))
+                continue
+
+            filename = os.path.join(directory, part + '.xml')
+            stream_result(session, job_url, filename)
+            filenames[part] = filename
+    finally:
+        if own_poller:
+            poller.stop()
+
+    if failed:
+        raise RuntimeError('The following jobs failed: %s' % (', '.join('%s (%s)' % (part, reason)
+                                                                       for part, reason in failed),))
+
+    ordered = [filenames[part] for part in parts]
+    return merge_chunks(ordered, order_by=query, output=output), ordered